@@ -0,0 +1 @@
+"""Benchmarks, against synthetic images and loop devices. See bench.py."""
@@ -0,0 +1,342 @@
+"""Benchmark harness: synthetic image, pretend cards, numbers.
+
+    sudo python -m benchmarks.bench
+    sudo python -m benchmarks.bench --size 2048 --fill 0.3 --repeat 5
+    python -m benchmarks.bench --files --skip-pipeline
+
+Two parts, each run against a synthetic image (see
+benchmarks.synthetic) built fresh for the run:
+
+copies
+    Every copy strategy (whole image, sparse, block map ranges,
+    fan-out to two targets, a boot partition copy_range, the read back
+    verify) at every buffer size, `repeat` times each. Targets are loop
+    devices over sparse files, or just the sparse files with --files.
+
+pipeline
+    The whole thing, through raspi_maker.main: a one pair batch config
+    with a loop device "SD card" and "thumb drive", once for each set
+    of flags in VARIANTS. Per step timings come from --timings (see
+    raspi_maker.timing). Needs root, and a kernel that scans loop
+    device partitions.
+
+Everything goes into one JSON file (--output), along with what it ran
+on, so two runs can be diffed when something gets slower.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+
+import raspi_maker
+from raspi_maker import image_handlers
+from raspi_maker.bmap import get_bmap
+from raspi_maker.copy_engine import MiB
+from raspi_maker.copy_engine import copy_image
+from raspi_maker.copy_engine import copy_range
+from raspi_maker.copy_engine import copy_ranges
+from raspi_maker.debugging import PromptOnError
+from raspi_maker.fanout import fan_out
+from raspi_maker.loop import LoopDevice
+from raspi_maker.manifest import get_manifest
+from raspi_maker.manifest import partition
+from raspi_maker.timing import get_recorder
+from raspi_maker.verify import verify_ranges
+
+from .synthetic import DEFAULT_BOOT_SIZE
+from .synthetic import DEFAULT_FILL
+from .synthetic import DEFAULT_SIZE
+from .synthetic import build_image
+from .synthetic import sparse_file
+
+
+DEFAULT_BLOCK_SIZES = '1,4,16,64'
+
+# Name, and the flags main() gets for it.
+VARIANTS = (
+    ('default', []),
+    ('full', ['--full']),
+    ('verify', ['--verify']),
+    ('grow-on-boot', ['--grow-on-boot']),
+    ('wipe-full', ['--wipe', 'full']),
+    ('offline-polish', ['--offline-polish', '--no-polish-cache']),
+)
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark raspi_maker against a synthetic image.')
+    parser.add_argument(
+        '--size', type=int, default=DEFAULT_SIZE // MiB,
+        help='Image size in MiB.')
+    parser.add_argument(
+        '--boot-size', type=int, default=DEFAULT_BOOT_SIZE // MiB,
+        help='Boot partition size in MiB.')
+    parser.add_argument(
+        '--fill', type=float, default=DEFAULT_FILL,
+        help='How full the filesystems are, 0 to 1.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Same seed, same image.')
+    parser.add_argument(
+        '--block-sizes', default=DEFAULT_BLOCK_SIZES,
+        help='Buffer sizes to try, in MiB, comma separated.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Runs of each copy. The median is reported.')
+    parser.add_argument(
+        '--variants', default=','.join(name for name, _ in VARIANTS),
+        help='Pipeline variants to run, comma separated.')
+    parser.add_argument(
+        '--skip-copies', action='store_true',
+        help='Leave out the copy strategy benchmarks.')
+    parser.add_argument(
+        '--skip-pipeline', action='store_true',
+        help='Leave out the full pipeline runs.')
+    parser.add_argument(
+        '--files', action='store_true',
+        help='Copy to plain sparse files instead of loop devices.')
+    parser.add_argument(
+        '--work-dir',
+        help='Where the image and pretend cards go. Defaults to a temp '
+             'dir, removed afterwards.')
+    parser.add_argument(
+        '--output', default='bench-results.json',
+        help='Where the results go.')
+    return parser.parse_args(args)
+
+
+def drop_caches():
+    """Empty the page cache, so reads come off the disk. Root only."""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'kernel': platform.release(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'root': os.geteuid() == 0,
+        'time': time.time(),
+    }
+
+
+def _strategies(image, targets, bmap, boot):
+    """name -> run(block_size) returning copy stats."""
+    first = targets[0]
+    return [
+        ('copy_image', lambda bs: copy_image(image, first, block_size=bs)),
+        ('copy_image_sparse', lambda bs: copy_image(
+            image, first, block_size=bs, sparse=True)),
+        ('copy_ranges', lambda bs: copy_ranges(
+            image, first, bmap['ranges'], block_size=bs)),
+        ('fan_out', lambda bs: _fan_out_stats(fan_out(
+            image, targets, ranges=bmap['ranges'], block_size=bs))),
+        ('copy_range_boot', lambda bs: copy_range(
+            image, first, boot['start'], boot['end'], block_size=bs)),
+        # After copy_ranges et al, first holds the image, so this
+        # checks out.
+        ('verify', lambda bs: verify_ranges(
+            first, bmap['ranges'], block_size=bs)),
+    ]
+
+
+def _fan_out_stats(stats):
+    """Fan-out stats for the slowest target, which sets the pace."""
+    slowest = max(stats.values(), key=lambda s: s['seconds'])
+    return dict(slowest, written=sum(s['written'] for s in stats.values()))
+
+
+def bench_copies(image, targets, block_sizes, repeat):
+    """Every strategy at every buffer size.
+
+    Returns
+    -------
+    list : dicts of strategy, block_size, method (copy_range only),
+        seconds (median), runs, bytes written and MiB/s.
+    """
+    bmap = get_bmap(image)
+    boot = partition(get_manifest(image), 1)
+    results = []
+    for name, run in _strategies(image, targets, bmap, boot):
+        for block_size in block_sizes:
+            runs = []
+            stats = None
+            for _ in range(repeat):
+                drop_caches()
+                start = time.monotonic()
+                stats = run(block_size)
+                runs.append(time.monotonic() - start)
+            seconds = statistics.median(runs)
+            moved = stats.get('written', stats.get('bytes', 0))
+            result = {
+                'strategy': name,
+                'block_size': block_size,
+                'method': stats.get('method'),
+                'seconds': seconds,
+                'runs': runs,
+                'bytes': moved,
+                'mb_per_sec': moved / MiB / seconds if seconds else None,
+            }
+            print('{strategy:<18} {0:>6} MiB {seconds:>8.2f}s '
+                  '{1:>9} MiB/s'.format(
+                      block_size // MiB,
+                      '{0:.1f}'.format(result['mb_per_sec'] or 0),
+                      **result))
+            results.append(result)
+    return results
+
+
+def _batch_config(path, sd_card, thumb_drive):
+    with open(path, 'w') as f:
+        f.write(
+            '[batch]\nuser=bench\nhostname=bench-{{n:02d}}\nworkers=1\n\n'
+            '[pair.1]\nsd_card={0}\nthumb_drive={1}\n'.format(
+                sd_card, thumb_drive))
+    return path
+
+
+def bench_pipeline(image, work_dir, variants):
+    """Run main() once per variant, on fresh loop devices each time.
+
+    Returns
+    -------
+    list : dicts of variant, flags, exit code, seconds, and the steps'
+        timing records.
+    """
+    recorder = get_recorder()
+    size = os.path.getsize(image)
+    # Nobody's watching, a failure is a result, not a prompt.
+    PromptOnError.interactive = False
+    results = []
+    for name, flags in variants:
+        print('Pipeline: {0} {1}'.format(name, ' '.join(flags)))
+        timings = os.path.join(work_dir, '{0}.jsonl'.format(name))
+        if os.path.exists(timings):
+            os.remove(timings)
+        with ExitStack() as stack:
+            sd_card = stack.enter_context(LoopDevice(sparse_file(
+                os.path.join(work_dir, 'sd.img'), size)))
+            thumb_drive = stack.enter_context(LoopDevice(sparse_file(
+                os.path.join(work_dir, 'thumb.img'), 2 * size)))
+            config = _batch_config(
+                os.path.join(work_dir, 'bench.ini'),
+                os.path.basename(sd_card.path),
+                os.path.basename(thumb_drive.path))
+
+            del recorder.records[:]
+            drop_caches()
+            start = time.monotonic()
+            try:
+                code = raspi_maker.main([
+                    'bench', '--config', config, '--timings', timings] +
+                    list(flags))
+            except Exception as e:
+                print('{0} blew up: {1}'.format(name, e))
+                code = None
+            seconds = time.monotonic() - start
+
+        steps = []
+        if os.path.exists(timings):
+            with open(timings) as f:
+                steps = [json.loads(line) for line in f]
+        results.append({
+            'variant': name,
+            'flags': list(flags),
+            'exit_code': code,
+            'seconds': seconds,
+            'steps': steps,
+        })
+    return results
+
+
+def _print_pipeline(results):
+    line = '{0:<16} {1:>5} {2:>9}  {3}'
+    print(line.format('variant', 'exit', 'seconds', 'slowest steps'))
+    for result in results:
+        slowest = sorted(result['steps'], key=lambda s: -s['seconds'])[:3]
+        print(line.format(
+            result['variant'],
+            str(result['exit_code']),
+            '{0:.1f}'.format(result['seconds']),
+            ', '.join('{0} {1:.1f}s'.format(s['name'], s['seconds'])
+                      for s in slowest)))
+
+
+def _copy_targets(stack, work_dir, size, files):
+    paths = [
+        sparse_file(os.path.join(work_dir, 'target-{0}.img'.format(n)), size)
+        for n in (1, 2)]
+    if files:
+        return paths
+    return [stack.enter_context(LoopDevice(path)).path for path in paths]
+
+
+def main(args):
+    options = _parse_args(args[1:])
+    block_sizes = [int(n) * MiB for n in options.block_sizes.split(',')]
+    wanted = options.variants.split(',')
+    variants = [v for v in VARIANTS if v[0] in wanted]
+    unknown = set(wanted) - set(name for name, _ in VARIANTS)
+    if unknown:
+        print('No such variants: {0}'.format(', '.join(sorted(unknown))))
+        return 2
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='raspi-maker-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    image = os.path.join(work_dir, 'synthetic.img')
+    try:
+        print('Building a {0} MiB image, {1:.0%} full.'.format(
+            options.size, options.fill))
+        start = time.monotonic()
+        built = build_image(
+            image, size=options.size * MiB, boot_size=options.boot_size * MiB,
+            fill=options.fill, seed=options.seed)
+        print('Built in {0:.1f}s, boot is {1}.'.format(
+            time.monotonic() - start, built['boot_fs']))
+
+        results = {
+            'environment': _environment(),
+            'image': built,
+            'copies': [],
+            'pipeline': [],
+        }
+        if not options.skip_copies:
+            with ExitStack() as stack:
+                targets = _copy_targets(
+                    stack, work_dir, built['size'], options.files)
+                results['copies'] = bench_copies(
+                    image, targets, block_sizes, options.repeat)
+
+        if not options.skip_pipeline:
+            # main() goes looking for its image, point it at ours.
+            image_handlers.PATH = work_dir
+            image_handlers.IMAGE_NAME = os.path.basename(image)
+            results['pipeline'] = bench_pipeline(image, work_dir, variants)
+            _print_pipeline(results['pipeline'])
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results in {0}'.format(options.output))
+    failed = [r for r in results['pipeline'] if r['exit_code'] != 0]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
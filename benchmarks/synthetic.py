@@ -0,0 +1,251 @@
+"""Synthetic Raspberry Pi style images, the same every time.
+
+A real Raspbian image is 2GB of somebody else's choices, and changes
+every release. For benchmarking we want something shaped the same (a
+boot partition and an ext4 root partition, with the files polish edits)
+whose size and fullness we pick, and that comes out the same for the
+same seed: same layout, same files, same data blocks. (Inode change
+times come from the files mkfs copied in, which we can't pin, so it's
+not quite byte for byte.)
+
+Needs mkfs.ext4 (e2fsprogs). The boot partition is FAT if mkfs.vfat and
+mcopy (dosfstools, mtools) are around, and ext4 if they aren't; nothing
+we do to it cares which. No mounting, so no root needed to build one.
+"""
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+from raspi_maker.copy_engine import MiB
+from raspi_maker.partition_table import write_layout
+
+
+BOOT_START = 4 * MiB
+DEFAULT_SIZE = 1024 * MiB
+DEFAULT_BOOT_SIZE = 128 * MiB
+DEFAULT_FILL = 0.5
+
+# Most of an ext4 filesystem can hold data, but not all of it.
+MAX_FILL = 0.85
+
+FILLER_FILE = 8 * MiB
+
+DISK_ID = 'b3a7c0de'
+
+# Timestamps for everything in the image, so it comes out the same.
+EPOCH = 1577836800
+
+ROOT_FILES = {
+    'etc/passwd': (
+        'root:x:0:0:root:/root:/bin/bash\n'
+        'pi:x:1000:1000:,,,:/home/pi:/bin/bash\n'),
+    'etc/shadow': 'root:*:19000:0:99999:7:::\npi:*:19000:0:99999:7:::\n',
+    'etc/group': 'root:x:0:\nsudo:x:27:pi\npi:x:1000:\n',
+    'etc/gshadow': 'root:*::\nsudo:*::pi\npi:!::\n',
+    'etc/hostname': 'raspberrypi\n',
+    'etc/hosts': '127.0.0.1\tlocalhost\n127.0.1.1\traspberrypi\n',
+    'etc/fstab': (
+        'proc /proc proc defaults 0 0\n'
+        'PARTUUID={0}-01 /boot vfat defaults 0 2\n'
+        'PARTUUID={0}-02 / ext4 defaults,noatime 0 1\n'.format(DISK_ID)),
+    'etc/ssh/sshd_config': '#PasswordAuthentication yes\n',
+    'etc/ssh/ssh_host_rsa_key.pub': 'ssh-rsa AAAA root@raspberrypi\n',
+    'etc/ssh/ssh_host_ecdsa_key.pub': (
+        'ecdsa-sha2-nistp256 AAAA root@raspberrypi\n'),
+    'etc/ssh/ssh_host_dsa_key.pub': 'ssh-dss AAAA root@raspberrypi\n',
+    'etc/wpa_supplicant/wpa_supplicant.conf': (
+        'ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev\n'
+        'update_config=1\n'),
+    'etc/sudoers.d/010_pi-nopasswd': 'pi ALL=(ALL) NOPASSWD: ALL\n',
+    'etc/systemd/system/autologin@.service': (
+        '[Service]\n'
+        'ExecStart=-/sbin/agetty --autologin pi --noclear %I $TERM\n'),
+    'home/pi/.bashrc': '',
+}
+
+ROOT_DIRS = ('etc/systemd/system/multi-user.target.wants',)
+
+BOOT_FILES = {
+    'cmdline.txt': (
+        'console=serial0,115200 console=tty1 root=PARTUUID={0}-02 '
+        'rootfstype=ext4 fsck.repair=yes rootwait '
+        'init=/usr/lib/raspi-config/init_resize.sh quiet\n'.format(DISK_ID)),
+    'config.txt': 'arm_64bit=1\n',
+}
+
+
+def _write_tree(root, files, dirs=()):
+    for path, text in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'w') as f:
+            f.write(text)
+    for path in dirs:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+
+
+def _write_filler(directory, total, rng, prefix='filler'):
+    """total bytes of incompressible, unskippable data, in files."""
+    os.makedirs(directory, exist_ok=True)
+    index = 0
+    while total > 0:
+        n = min(FILLER_FILE, total)
+        with open(os.path.join(
+                directory, '{0}-{1:04d}.bin'.format(prefix, index)), 'wb') as f:
+            f.write(rng.randbytes(n))
+        total -= n
+        index += 1
+
+
+def _pin_times(tree):
+    for parent, dirs, files in os.walk(tree):
+        for name in dirs + files:
+            os.utime(os.path.join(parent, name), (EPOCH, EPOCH))
+    os.utime(tree, (EPOCH, EPOCH))
+
+
+def _has_vfat_tools():
+    return bool(shutil.which('mkfs.vfat') and shutil.which('mcopy'))
+
+
+def _mkfs_ext4(path, size, tree, label, rng):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    fs_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    hash_seed = str(uuid.UUID(int=rng.getrandbits(128)))
+    env = dict(
+        os.environ, SOURCE_DATE_EPOCH=str(EPOCH),
+        E2FSPROGS_FAKE_TIME=str(EPOCH))
+    subprocess.check_call([
+        'mkfs.ext4', '-q', '-F', '-L', label, '-U', fs_uuid,
+        '-E', 'root_owner=0:0,hash_seed={0}'.format(hash_seed),
+        '-d', tree, path], env=env)
+
+
+def _mkfs_vfat(path, size, tree, label, rng):
+    if os.path.exists(path):
+        os.remove(path)
+    volume_id = '{0:08x}'.format(rng.getrandbits(32))
+    subprocess.check_call(
+        ['mkfs.vfat', '-n', label.upper(), '-i', volume_id, '-C', path,
+         str(size // 1024)],
+        stdout=subprocess.DEVNULL, env=dict(
+            os.environ, SOURCE_DATE_EPOCH=str(EPOCH)))
+    names = [os.path.join(tree, name) for name in sorted(os.listdir(tree))]
+    subprocess.check_call(['mcopy', '-m', '-s', '-i', path] + names + ['::/'])
+
+
+def _place(filesystem, image, offset):
+    """Copy a filesystem into the image at offset, leaving holes where
+    it's zeros, so the image is as sparse as a real one."""
+    src = os.open(filesystem, os.O_RDONLY)
+    dst = os.open(image, os.O_WRONLY)
+    zeros = bytes(MiB)
+    try:
+        position = 0
+        while True:
+            chunk = os.pread(src, MiB, position)
+            if not chunk:
+                break
+            if chunk != zeros[:len(chunk)]:
+                os.pwrite(dst, chunk, offset + position)
+            position += len(chunk)
+    finally:
+        os.close(src)
+        os.close(dst)
+
+
+def build_image(path, size=DEFAULT_SIZE, boot_size=DEFAULT_BOOT_SIZE,
+                fill=DEFAULT_FILL, seed=0):
+    """Build a synthetic Pi image.
+
+    Parameters
+    ----------
+    path : str
+        Where to put it. Anything already there is replaced.
+
+    size : int
+        Bytes. The root partition gets whatever the boot one doesn't.
+
+    boot_size : int
+        Bytes in the boot partition.
+
+    fill : float
+        How full of random data both filesystems are, 0 to 1. Random,
+        so nothing gets to skip it as zeros or compress it.
+
+    seed : int
+        Same seed, same image (give or take inode change times).
+
+    Returns
+    -------
+    dict : path, size, boot_size, fill, seed, boot_fs, and the
+        partition table as written.
+    """
+    if not 0 <= fill <= 1:
+        raise ValueError('fill is a fraction, got {0}'.format(fill))
+    rng = random.Random(seed)
+    root_start = BOOT_START + boot_size
+    root_size = size - root_start
+    if root_size < 64 * MiB:
+        raise ValueError('{0} bytes is too small for a root partition'.format(
+            root_size))
+
+    work = tempfile.mkdtemp(prefix='raspi-maker-bench-')
+    try:
+        boot_tree = os.path.join(work, 'boot')
+        _write_tree(boot_tree, BOOT_FILES)
+        _write_filler(
+            boot_tree, int(boot_size * min(fill, MAX_FILL)), rng,
+            prefix='kernel')
+
+        root_tree = os.path.join(work, 'root')
+        _write_tree(root_tree, ROOT_FILES, ROOT_DIRS)
+        _write_filler(
+            os.path.join(root_tree, 'opt', 'filler'),
+            int(root_size * min(fill, MAX_FILL)), rng)
+
+        _pin_times(boot_tree)
+        _pin_times(root_tree)
+
+        boot_fs = os.path.join(work, 'boot.img')
+        if _has_vfat_tools():
+            _mkfs_vfat(boot_fs, boot_size, boot_tree, 'boot', rng)
+            boot_type = '0c'
+        else:
+            _mkfs_ext4(boot_fs, boot_size, boot_tree, 'boot', rng)
+            boot_type = '83'
+        root_fs = os.path.join(work, 'root.img')
+        _mkfs_ext4(root_fs, root_size, root_tree, 'rootfs', rng)
+
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        table = write_layout(path, [
+            {'number': 1, 'start': BOOT_START, 'end': root_start,
+             'type': boot_type},
+            {'number': 2, 'start': root_start, 'end': None, 'type': '83'},
+        ], type='mbr', disk_id=DISK_ID)
+        _place(boot_fs, path, BOOT_START)
+        _place(root_fs, path, root_start)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return {
+        'path': path,
+        'size': size,
+        'boot_size': boot_size,
+        'fill': fill,
+        'seed': seed,
+        'boot_fs': 'vfat' if boot_type == '0c' else 'ext4',
+        'partition_table': table,
+    }
+
+
+def sparse_file(path, size):
+    """An empty sparse file, to attach as a pretend card."""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return path
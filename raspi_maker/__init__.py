@@ -1,29 +1,579 @@
 """Raspi maker - make nice sd and thumb drive for raspi provisioning."""
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+from .actions import cached_polish_image
 from .actions import clear_device
 from .actions import copy_boot_partition
+from .actions import discard_polished_image
 from .actions import expand_second_partition
 from .actions import flash_image
+from .actions import flash_images
 from .actions import polish_drive
+from .actions import polish_image
 from .actions import update_sdcard_boot_commands
+from .actions import verify_flash
 from .cli_helpers import devices_prompt
 from .cli_helpers import print_devices
 from .cli_helpers import freestyle_prompt
+from .configuration import CONFIG_FILE
 from .configuration import file_config_exists
+from .configuration import is_batch_config
+from .configuration import parse_batch_config
 from .configuration import parse_config
+from .configuration import parse_polish
+from .configuration import parse_run_spec
+from .configuration import DEFAULT_WORKERS
+from .daemon import SOCKET_PATH
+from .daemon import ProvisioningDaemon
+from .daemon import request
+from .daemon import serve
+from .debugging import no_prompts
 from .device import Device
 from .device import get_devices
 from .errors import check_for_root_device
+from .image_handlers import IMAGE_NAME
 from .image_handlers import check_image
+from .image_handlers import get_store
+from .manifest import get_manifest
+from .pipeline import Pipeline
+from .pipeline import StepResult
+from .timing import get_recorder
+from .wipe import WIPE_MODES
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Make a nice SD card and thumb drive for a raspi.')
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Write every byte of the image, instead of skipping zeros.')
+    parser.add_argument(
+        '--config',
+        default=CONFIG_FILE,
+        help='Config file to use. One with [pair.N] sections is a batch.')
+    parser.add_argument(
+        '--spec',
+        metavar='PATH',
+        help='Run everything a run spec (.toml, .json or .ini) says, '
+             'with no prompts. See configuration.parse_run_spec.')
+    parser.add_argument(
+        '--offline-polish',
+        action='store_true',
+        help='Polish a copy of the image on a loop device, then flash that.')
+    parser.add_argument(
+        '--no-polish-cache',
+        action='store_false',
+        dest='polish_cache',
+        help='With --offline-polish, always polish from scratch.')
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Read the thumb drive back after flashing and check it.')
+    parser.add_argument(
+        '--grow-on-boot',
+        action='store_true',
+        help='Leave growing the root filesystem to the Pi\'s first boot, '
+             'instead of e2fsck and resize2fs over USB.')
+    parser.add_argument(
+        '--wipe',
+        choices=WIPE_MODES + ('none',),
+        default='signatures',
+        help='How to clear devices first: zero old filesystem signatures '
+             '(the default), discard the whole device (full), or just '
+             'delete the partitions (none).')
+    parser.add_argument(
+        '--timings',
+        metavar='PATH',
+        help='Append a JSON line per step (time, bytes, MiB/s, commands '
+             'run) to PATH. A summary gets printed at the end either way.')
+    parser.add_argument(
+        '--images',
+        action='store_true',
+        help='List every image in the store, and stop.')
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='Stay up and take provisioning jobs on a Unix socket.')
+    parser.add_argument(
+        '--submit',
+        action='store_true',
+        help='Send the pairs in the config file to a running daemon.')
+    parser.add_argument(
+        '--socket',
+        default=SOCKET_PATH,
+        help='Unix socket the daemon listens on.')
+    return parser.parse_args(args)
+
+
+def build_pipeline(disk_image, sd_card, thumb_drive, ssid, psk, user,
+                   hostname, full=False, name=None, flashed=False,
+                   offline_polish=False, polish_cache=True, verify=False,
+                   flash_stats=None, sd_ready=False, wipe='signatures',
+                   grow_on_boot=False, block_size=None):
+    """Lay out the provisioning steps for one SD card / thumb drive pair.
+
+    The two devices never meet: the SD card gets its boot partition
+    straight out of the image, so it's cleared and finished off in
+    parallel with the thumb drive being cleared, flashed and expanded.
+
+    flashed means both devices were already cleared and the thumb drive
+    already has the image on it (batch mode does that for everyone at
+    once), so the pipeline starts at the boot partition copy.
+
+    offline_polish polishes a copy of the image up front (see
+    actions.polish_image) and flashes that, instead of polishing the
+    thumb drive at the end. With polish_cache the polished image is
+    kept (see raspi_maker.cache), so doing the same node again skips
+    straight to flashing.
+
+    wipe is how the devices get cleared, see actions.clear_device.
+
+    grow_on_boot leaves the root filesystem for the Pi to grow (see
+    actions.expand_second_partition), and has polishing install the
+    unit that does it.
+
+    block_size is the copy buffer for flashing and verifying, None for
+    the copy engine's default.
+
+    sd_ready means the SD card is already done too (batch mode does
+    those while the thumb drives flash), leaving just the thumb drive.
+
+    verify reads the thumb drive back once it's flashed and checks it
+    (see actions.verify_flash). Expanding has to wait for it, since that
+    changes the partition table. When
+    flashed, flash_stats is what the flash handed back for this thumb
+    drive.
+
+    Returns
+    -------
+    raspi_maker.pipeline.Pipeline : ready to run.
+    """
+    pipeline = Pipeline(name=name)
+    # Polishing doesn't move partitions or touch the boot one, so the
+    # original image will do for both.
+    boot_image = disk_image
+    pipeline.add(
+        'manifest', get_manifest, args=(disk_image,),
+        description='Reading the image\'s partition table.')
+    if not flashed:
+        pipeline.add(
+            'clear_sd', clear_device, args=(sd_card,),
+            kwargs={'wipe': wipe},
+            description='Clearing SD Card: {0}'.format(sd_card))
+        pipeline.add(
+            'clear_thumb', clear_device, args=(thumb_drive,),
+            kwargs={'wipe': wipe},
+            description='Clearing Thumb Drive: {0}'.format(thumb_drive))
+        if offline_polish:
+            pipeline.add(
+                'polish_image',
+                cached_polish_image if polish_cache else polish_image,
+                args=(disk_image, ssid, psk, user, hostname),
+                kwargs={'grow_on_boot': grow_on_boot},
+                description='Polishing a copy of the image.')
+            disk_image = StepResult('polish_image')
+        pipeline.add(
+            'flash', flash_image, args=(disk_image, thumb_drive),
+            kwargs={'full': full, 'block_size': block_size},
+            requires=['clear_thumb'],
+            description='Flashing the Image to the thumb_drive.')
+        if offline_polish and not polish_cache:
+            pipeline.add(
+                'discard_polished_image', discard_polished_image,
+                args=(disk_image,), requires=['flash'],
+                description='Throwing away the polished copy.')
+    if verify:
+        written = flash_stats if flashed else StepResult('flash')
+        pipeline.add(
+            'verify', verify_flash, args=(thumb_drive, written),
+            kwargs={'block_size': block_size},
+            description='Checking the thumb drive reads back right.')
+    if not sd_ready:
+        pipeline.add(
+            'copy_boot', copy_boot_partition,
+            kwargs={
+                'disk_image': boot_image,
+                'target': sd_card,
+                'manifest': StepResult('manifest'),
+            },
+            requires=[] if flashed else ['clear_sd'],
+            description='Creating a boot partition on the sd card')
+        pipeline.add(
+            'sd_boot_commands', update_sdcard_boot_commands, args=(sd_card,),
+            requires=['copy_boot'],
+            description='Modifying target boot dir on SD Card')
+    pipeline.add(
+        'expand', expand_second_partition,
+        args=(thumb_drive, StepResult('manifest')),
+        kwargs={'grow_on_boot': grow_on_boot},
+        requires=([] if flashed else ['flash']) + (
+            ['verify'] if verify else []),
+        description='Expanding thumb drive to full thumb size.')
+    if not offline_polish:
+        pipeline.add(
+            'polish', polish_drive,
+            args=(thumb_drive, ssid, psk, user, hostname),
+            kwargs={'grow_on_boot': grow_on_boot},
+            requires=['expand'],
+            description='Polishing thumb drive for final ready to go status.')
+    return pipeline
+
+
+def _wipe_mode(options):
+    """--wipe as clear_device wants it."""
+    return None if options.wipe == 'none' else options.wipe
+
+
+def _settings(options):
+    """The command line flags, as build_pipeline keyword arguments."""
+    return {
+        'full': options.full,
+        'offline_polish': options.offline_polish,
+        'polish_cache': options.polish_cache,
+        'verify': options.verify,
+        'wipe': _wipe_mode(options),
+        'grow_on_boot': options.grow_on_boot,
+        'block_size': None,
+    }
+
+
+def _find_image():
+    """The image to flash, see image_handlers.check_image.
+
+    Raises
+    ------
+    FileNotFoundError : if there's no local one. Fetching it remotely
+        isn't written yet.
+    """
+    print('Checking for local image')
+    store = get_store()
+    disk_image = check_image(store)
+    if not disk_image:
+        raise FileNotFoundError(
+            'No {0} (raw or compressed) in any of: {1}. Fetching it '
+            'remotely isn\'t written yet, so download it there.'.format(
+                IMAGE_NAME, ', '.join(store.directories)))
+    print('Image found: {0}'.format(disk_image))
+    return disk_image
+
+
+def _each_pair(pairs, func, workers):
+    """Run func(pair) for every pair, workers at a time.
+
+    Returns
+    -------
+    list : the pairs func worked for. Failures get printed.
+    """
+    succeeded = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(func, pair), pair) for pair in pairs)
+        for future in as_completed(futures):
+            pair = futures[future]
+            try:
+                future.result()
+                succeeded.append(pair)
+            except Exception:
+                traceback.print_exc()
+                print('{0} FAILED.'.format(pair['hostname']))
+    return [pair for pair in pairs if pair in succeeded]
+
+
+def run_batch(options):
+    """Provision every pair in a batch config, see provision_pairs.
+
+    Returns
+    -------
+    int : exit code. Non zero if any pair failed.
+    """
+    pairs, ssid, psk, workers = parse_batch_config(options.config)
+    for pair in pairs:
+        check_for_root_device(pair['sd_card'], pair['thumb_drive'])
+    try:
+        disk_image = _find_image()
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+    return provision_pairs(
+        disk_image, pairs, ssid, psk, workers, _settings(options))
+
+
+def _spec_image(spec):
+    """The image a run spec names, or the usual one if it doesn't.
+
+    Raises
+    ------
+    FileNotFoundError : if there's no such image.
+    """
+    if spec['image'] is None:
+        return _find_image()
+    disk_image = get_store().resolve(spec['image'])
+    if disk_image is None:
+        raise FileNotFoundError(
+            'No image {0}, as a path, a name in the image store or a '
+            'sha256'.format(spec['image']))
+    return disk_image
+
+
+def run_headless(spec):
+    """Do everything a run spec says, with no prompts at all.
+
+    No pdb on errors either (see provision_pairs): a failed pair is
+    reported and the rest carry on.
+
+    Parameters
+    ----------
+    spec : dict
+        See configuration.parse_run_spec.
+
+    Returns
+    -------
+    int : exit code. Non zero if any pair failed.
+    """
+    for pair in spec['pairs']:
+        check_for_root_device(pair['sd_card'], pair['thumb_drive'])
+
+    try:
+        disk_image = _spec_image(spec)
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+    return provision_pairs(
+        disk_image, spec['pairs'], spec['ssid'], spec['psk'],
+        spec['workers'], spec['settings'])
+
+
+def provision_pairs(disk_image, pairs, ssid, psk, workers, settings):
+    """Provision SD card / thumb drive pairs, a few at a time.
+
+    Three phases:
+
+        1. clear every device, `workers` at a time
+        2. flash every thumb drive at once, reading the image only once,
+           while the SD cards get their boot partitions, `workers` at a
+           time
+        3. finish each thumb drive off with its own pipeline (see
+           build_pipeline), `workers` at a time
+
+    A pair that fails drops out, the rest carry on. Nothing drops into
+    pdb (see debugging.no_prompts), or the failing step would hand back
+    None and its pair would look like it worked.
+
+    With offline_polish every pair has its own polished image, so
+    there's nothing to share and each pair just runs its own full
+    pipeline instead.
+
+    Parameters
+    ----------
+    pairs : list
+        dicts of sd_card, thumb_drive, user and hostname, see
+        configuration.parse_batch_config.
+
+    settings : dict
+        build_pipeline keyword arguments: full, offline_polish,
+        polish_cache, verify, wipe, grow_on_boot and block_size.
+
+    Returns
+    -------
+    int : exit code. Non zero if any pair failed.
+    """
+    with no_prompts():
+        return _provision_pairs(
+            disk_image, pairs, ssid, psk, workers, settings)
+
+
+def _provision_pairs(disk_image, pairs, ssid, psk, workers, settings):
+    print('Batch of {0} pairs, {1} at a time.'.format(len(pairs), workers))
+
+    for pair in pairs:
+        pair['sd_device'] = Device(pair['sd_card'])
+        pair['thumb_device'] = Device(pair['thumb_drive'])
+
+    if settings['offline_polish']:
+        def provision(pair):
+            build_pipeline(
+                disk_image,
+                pair['sd_device'],
+                pair['thumb_device'],
+                ssid,
+                psk,
+                pair['user'],
+                pair['hostname'],
+                name=pair['hostname'],
+                **settings).run()
+
+        return _report_batch(pairs, _each_pair(pairs, provision, workers))
+
+    def clear(pair):
+        clear_device(pair['sd_device'], wipe=settings['wipe'])
+        clear_device(pair['thumb_device'], wipe=settings['wipe'])
+
+    print('Clearing everything.')
+    ready = _each_pair(pairs, clear, workers)
+    # Once now, rather than every pipeline racing to build it.
+    manifest = get_manifest(disk_image)
+
+    def prepare_sd(pair):
+        copy_boot_partition(disk_image, pair['sd_device'], manifest)
+        update_sdcard_boot_commands(pair['sd_device'])
+
+    print('Flashing {0} thumb drives at once, SD cards alongside.'.format(
+        len(ready)))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        sd_cards = executor.submit(_each_pair, ready, prepare_sd, workers)
+        stats = flash_images(
+            disk_image, [pair['thumb_device'] for pair in ready],
+            full=settings['full'], block_size=settings['block_size'])
+        sd_done = sd_cards.result()
+    flashed = [
+        pair for pair in sd_done
+        if not stats[pair['thumb_device'].path]['error']]
+
+    def finish(pair):
+        build_pipeline(
+            disk_image,
+            pair['sd_device'],
+            pair['thumb_device'],
+            ssid,
+            psk,
+            pair['user'],
+            pair['hostname'],
+            name=pair['hostname'],
+            flashed=True,
+            sd_ready=True,
+            flash_stats=stats[pair['thumb_device'].path],
+            **settings).run()
+
+    return _report_batch(pairs, _each_pair(flashed, finish, workers))
+
+
+def _report_batch(pairs, done):
+    """Say how the batch went. Returns the exit code."""
+    failed = [pair['hostname'] for pair in pairs if pair not in done]
+    if failed:
+        print('These ones need another go: {0}'.format(' '.join(failed)))
+        return 1
+    print('Your whole rack is done!')
+    return 0
+
+
+def run_daemon(options):
+    """Provisioning daemon, see raspi_maker.daemon. Wireless settings
+    and worker count come from the config file, if there is one."""
+    ssid = psk = None
+    workers = DEFAULT_WORKERS
+    if file_config_exists(options.config):
+        if is_batch_config(options.config):
+            _, ssid, psk, workers = parse_batch_config(options.config)
+        else:
+            _, _, ssid, psk = parse_config(options.config)
+
+    try:
+        disk_image = _find_image()
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+    defaults = _settings(options)
+    defaults.update(ssid=ssid, psk=psk)
+    daemon = ProvisioningDaemon(disk_image, workers=workers,
+                                defaults=defaults)
+    print('Warming up.')
+    daemon.warm_up()
+    serve(daemon, options.socket)
+    return 0
+
+
+def submit_jobs(options):
+    """Hand the config file's pairs to a running daemon.
+
+    Returns
+    -------
+    int : exit code. Non zero if the daemon turned any down.
+    """
+    if is_batch_config(options.config):
+        pairs, ssid, psk, _ = parse_batch_config(options.config)
+    else:
+        sd_card, thumb_drive, ssid, psk = parse_config(options.config)
+        user, hostname = _polish_prompt(options.config)
+        pairs = [{
+            'sd_card': sd_card,
+            'thumb_drive': thumb_drive,
+            'user': user,
+            'hostname': hostname,
+        }]
+
+    code = 0
+    for pair in pairs:
+        job = dict((key, pair[key]) for key in (
+            'sd_card', 'thumb_drive', 'user', 'hostname'))
+        if ssid and psk:
+            job.update(ssid=ssid, psk=psk)
+        response = request({'op': 'submit', 'job': job}, options.socket)
+        if 'error' in response:
+            print('{0}: {1}'.format(pair['hostname'], response['error']))
+            code = 1
+        else:
+            print('{0}: job {1}'.format(
+                pair['hostname'], response['job']['id']))
+    return code
+
+
+def _polish_prompt(config):
+    """user and hostname from the config's [polish] section, asking for
+    whichever isn't there."""
+    user, hostname = None, None
+    if file_config_exists(config):
+        user, hostname = parse_polish(config)
+    if not user:
+        user = freestyle_prompt('What is the username you want instead of pi?')
+    if not hostname:
+        hostname = freestyle_prompt('What is your preferred hostname?')
+    return user, hostname
 
 
 def main(args):
+    options = _parse_args(args[1:])
+
+    recorder = get_recorder()
+    if options.timings:
+        recorder.open_log(options.timings)
+    try:
+        return _run(options)
+    finally:
+        recorder.print_summary()
+        recorder.close()
+
+
+def _run(options):
+    """Work out what we've been asked to do, and do it."""
+    if options.spec:
+        return run_headless(parse_run_spec(options.spec))
+
+    if options.images:
+        get_store().print_catalog()
+        return 0
+
+    if options.daemon:
+        return run_daemon(options)
+
+    if options.submit:
+        return submit_jobs(options)
+
+    if file_config_exists(options.config) and is_batch_config(options.config):
+        return run_batch(options)
+
     devices = dict((dev, Device(dev)) for dev in get_devices())
 
     print_devices(devices)
 
-    if file_config_exists():
+    if file_config_exists(options.config):
         print('Using the config file!')
-        sd_card, thumb_drive, ssid, psk = parse_config()
+        sd_card, thumb_drive, ssid, psk = parse_config(options.config)
         sd_card = Device(sd_card)
         thumb_drive = Device(thumb_drive)
     else:
@@ -32,39 +582,20 @@ def main(args):
         ssid = freestyle_prompt('What is your wireless ssid?')
         psk = freestyle_prompt('What is your wireless password?')
 
-    user = freestyle_prompt('What is the username you want instead of pi?')
-    hostname = freestyle_prompt('What is your preferred hostname?')
+    user, hostname = _polish_prompt(options.config)
 
     check_for_root_device(sd_card.blk_id, thumb_drive.blk_id)
 
-    print('Checking for local image')
-    disk_image = check_image()
-    if disk_image:
-        print('Image found: {0}'.format(disk_image))
-    else:
-        print('Fetching Image Remotely')
-        raise NotImplemented('I didnt write this yet...')
-
-    print('Clearing SD Card: {0}'.format(str(sd_card)))
-    clear_device(sd_card)
-
-    print('Clearing Thumb Drive: {0}'.format(str(thumb_drive)))
-    clear_device(thumb_drive)
-
-    print('Flashing the Image to the thumb_drive.')
-    flash_image(disk_image, thumb_drive)
-
-    print('Creating a boot partition on the sd card')
-    copy_boot_partition(source=thumb_drive, target=sd_card)
-
-    print('Modifying target boot dir on SD Card')
-    update_sdcard_boot_commands(sd_card)
-
-    print('Expanding thumb drive to full thumb size.')
-    expand_second_partition(thumb_drive)
+    try:
+        disk_image = _find_image()
+    except FileNotFoundError as e:
+        print(e)
+        return 1
 
-    print('Polishing thumb drive for final ready to go status.')
-    polish_drive(thumb_drive, ssid, psk, user, hostname)
+    pipeline = build_pipeline(
+        disk_image, sd_card, thumb_drive, ssid, psk, user, hostname,
+        **_settings(options))
+    pipeline.run()
 
     print('Your shit is done!')
     print('Plug it into a pi and you\'re ready to rock.')
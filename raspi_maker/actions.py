@@ -1,39 +1,68 @@
 import os
+import shutil
+from contextlib import contextmanager
 from tempfile import mkdtemp
-from subprocess import check_output
 
+from .bmap import get_bmap
+from .cache import get_polish_cache
 from .debugging import PromptOnError
-from .console import console
-from .console import interactive_console
-
-
-def _delete_partition(device, number):
-    print('Deleting {0} partition #{1}'.format(device.path, number))
-    console(['sudo', 'parted', device.path, 'rm', str(number)])
+from .decompress import decompress_to
+from .decompress import is_compressed
+from .edits import EditPlan
+from .errors import ChecksumMismatch
+from .fanout import print_report
+from .loop import LoopDevice
+from .loop import working_copy
+from .manifest import get_manifest
+from .manifest import partition
+from .manifest import root_partition
+from .privileged import get_helper
+from .privileged import run_privileged
+from .timing import add_bytes
+from .timing import timed
+
+
+# Grows the root filesystem on the Pi's first boot, then turns itself
+# off. Online ext4 growth, so no e2fsck first, and a no-op if it was
+# already grown before the Pi ever saw it.
+GROW_ROOT_UNIT = 'raspi-maker-grow-root.service'
+GROW_ROOT_SERVICE = """[Unit]
+Description=Grow the root filesystem to fill the thumb drive, once
+After=local-fs.target
+
+[Service]
+Type=oneshot
+ExecStart=/sbin/resize2fs /dev/sda2
+ExecStartPost=/bin/systemctl disable {0}
+
+[Install]
+WantedBy=multi-user.target
+""".format(GROW_ROOT_UNIT)
 
 
 @PromptOnError
-def clear_device(device):
-    """Run rm commands on all partitions on the device.
-
-    To do this, we count the partitions, and delete them one by one.
-    This is done by running:
+@timed
+def clear_device(device, wipe='signatures'):
+    """Delete all the partitions on the device.
 
-        $ sudo parted <path_to_device> rm <partition_number>
+    This used to be a `parted rm` per partition, each one its own sudo
+    and its own table reread. Now it's an empty table written in one go
+    (see raspi_maker.partition_table.write_layout). Without a wipe the
+    table type and disk id stay as they were.
 
-    Where path_to_device is something like /dev/mmcblk0 and partition_number
-    is a 1 indexed id for partitions.
-
-    To get a list of partitions, you can also run:
+    To see what you're working with first, you can still run:
 
         $ sudo parted /dev/mmcblk0 unit s print
 
-    This will make it more clear what you're working with.
-
     Parameters
     ----------
     device : raspi-maker.device.Device instance
 
+    wipe : str
+        Get rid of old filesystem signatures first ('signatures'), or
+        discard the whole device ('full'). See raspi_maker.wipe. None
+        just deletes the partitions.
+
     Returns
     -------
     bool : True if successful
@@ -49,386 +78,480 @@ def clear_device(device):
     """
     device.unmount_all()
 
-    partitions = device.partitions()
-
-    for partition in range(1, 1+len(partitions)):
-        _delete_partition(device, partition)
+    print('Deleting {0} partitions on {1}'.format(
+        len(device.partitions()), device.path))
+    helper = get_helper()
+    if wipe:
+        stats = helper.call('wipe', path=device.path, mode=wipe)
+        print('Wiped {0} ({1}): {2} signatures in {3:.1f}s'.format(
+            device.path, stats['method'], len(stats['signatures']),
+            stats['seconds']))
+    helper.call('write_layout', path=device.path, partitions=[])
+    device.invalidate()
 
     return True
 
 
+def _sizing(block_size):
+    """block_size as helper call kwargs, leaving the default alone."""
+    return {} if block_size is None else {'block_size': block_size}
+
+
 @PromptOnError
-def flash_image(disk_image, device):
-    """DD an image onto a device."""
-    cmd = 'dd if={disk_image} | pv | sudo dd of={device_path}'
+@timed
+def flash_image(disk_image, device, full=False, block_size=None):
+    """Write an image onto a device.
 
-    populated_cmd = cmd.format(
-        disk_image=disk_image,
-        device_path=device.path)
+    Used to be `dd | pv | sudo dd`, now it's the copy engine, running in
+    the privileged helper (see raspi_maker.privileged).
 
-    # why check output? because then you can do the cool
-    # dd | pv | dd trick. '|pv|'' is awesome stdout.
-    output = check_output(populated_cmd, shell=True)
-    print(output)
+    By default only the ranges in the image's block map get written (the
+    target is zeroed up front), and each range is checked against its
+    sha256 on the way through. The map is built on first use and cached
+    next to the image, see raspi_maker.bmap.
 
+    Compressed images (.xz, .zst, .gz, .zip) get decompressed on the fly
+    in a background thread and streamed on, skipping zero chunks.
 
-@PromptOnError
-def copy_boot_partition(source, target):
-    """Copy the boot partition, including flags and file type.
+    Parameters
+    ----------
+    disk_image : str
+        Path to the image, raw or compressed.
 
-    SideEffects
-    -----------
-    Creates a partition on target device, with:
-        label: boot
-        size: equivalent to source device's partition 1
+    device : raspi-maker.device.Device instance
 
+    full : bool
+        Write every byte, zeros and all. The escape hatch for media that
+        lies about zeroing.
+
+    block_size : int
+        Copy buffer size in bytes. None for the copy engine's default.
+
+    Returns
+    -------
+    dict : copy stats, see raspi_maker.copy_engine.copy_image
     """
-    boot_source = source.partition_specs(1)
+    helper = get_helper()
+    sizing = _sizing(block_size)
+    if is_compressed(disk_image):
+        stats = helper.call(
+            'copy_compressed', source=disk_image, target=device.path,
+            sparse=not full, **sizing)
+    elif full:
+        stats = helper.call(
+            'copy_image', source=disk_image, target=device.path, **sizing)
+    else:
+        bmap = get_bmap(disk_image)
+        stats = helper.call(
+            'copy_ranges', source=disk_image, target=device.path,
+            ranges=bmap['ranges'], **sizing)
+    device.invalidate()
+    print('Wrote {0} of {1} bytes in {2:.1f}s'.format(
+        stats['written'], stats['bytes'], stats['seconds']))
+    return stats
+
+
+@timed
+def flash_images(disk_image, devices, full=False, block_size=None):
+    """Write one image to several devices at once, reading it only once.
+
+    Same modes as flash_image (block map, streamed if compressed, or
+    --full), but through raspi_maker.fanout. The slowest device sets the
+    pace, and a device that dies along the way doesn't stop the others.
+
+    Parameters
+    ----------
+    disk_image : str
+        Path to the image, raw or compressed.
+
+    devices : list
+        raspi-maker.device.Device instances.
 
-    mkfs_command = [
-        'sudo',
-        'parted',
-        target.path,
-        'mkpart',
-        'primary',
-        'fat16',
-        boot_source['Start'],
-        boot_source['End']
-    ]
+    full : bool
+        Write every byte.
 
-    # Create a placeholder partition
-    interactive_console(mkfs_command)
+    block_size : int
+        Copy buffer size in bytes, for each of the fan-out's buffers.
 
-    partition = target.partitions()[0]
+    Returns
+    -------
+    dict : device path to copy stats. 'error' is set for devices that
+        failed.
+    """
+    paths = [device.path for device in devices]
+    helper = get_helper()
+    sizing = _sizing(block_size)
+    if is_compressed(disk_image):
+        stats = helper.call(
+            'fan_out', source=disk_image, targets=paths, sparse=not full,
+            **sizing)
+    elif full:
+        stats = helper.call(
+            'fan_out', source=disk_image, targets=paths, **sizing)
+    else:
+        bmap = get_bmap(disk_image)
+        stats = helper.call(
+            'fan_out', source=disk_image, targets=paths,
+            ranges=bmap['ranges'], **sizing)
+    for device in devices:
+        device.invalidate()
+    print_report(stats)
+    add_bytes(sum(s.get('written') or 0 for s in stats.values()))
+    return stats
+
+
+@timed
+def verify_flash(device, stats, block_size=None):
+    """Read back what flash_image (or flash_images) wrote, and check it.
 
-    copy_command = 'sudo dd if={source} | pv | sudo dd of={target}'
+    Parameters
+    ----------
+    device : raspi-maker.device.Device instance
 
-    populated_cmd = copy_command.format(
-        source=source.partitions(full_paths=True)[0],
-        target=target.partitions(full_paths=True)[0])
+    stats : dict
+        What the flash handed back. Its 'ranges' say what to check.
 
-    print('Copying the boot fs over.')
-    output = check_output(populated_cmd, shell=True)
-    print(output)
+    block_size : int
+        Read buffer size in bytes. None for the default.
 
-    e2label_command = [
-        'sudo',
-        'e2label',
-        target.partitions(full_paths=True)[0],
-        'boot'
-    ]
+    Returns
+    -------
+    dict : read back stats, see raspi_maker.verify.verify_ranges
 
-    print('Labeling filesystem.')
-    interactive_console(e2label_command)
+    Raises
+    ------
+    raspi_maker.errors.ChecksumMismatch : if anything came back wrong.
+    """
+    print('Reading {0} back to check it.'.format(device.path))
+    result = get_helper().call(
+        'verify', target=device.path, ranges=stats['ranges'],
+        **_sizing(block_size))
+    if result['mismatches']:
+        raise ChecksumMismatch(
+            '{0} did not read back what was written, {1} range(s) bad. '
+            'Time for a new card?'.format(
+                device.path, len(result['mismatches'])))
+    print('{0} checks out: {1} bytes read back in {2:.1f}s'.format(
+        device.path, result['bytes'], result['seconds']))
+    return result
 
 
 @PromptOnError
-def update_sdcard_boot_commands(device):
-    """Make the SD Card point to the thumb drive on boot."""
-    mount_dir = mkdtemp()
+@timed
+def copy_boot_partition(disk_image, target, manifest):
+    """Copy the boot partition, including flags and file type.
 
-    boot_partition = device.partitions(full_paths=True)[0]
+    Straight out of the image file, by offset, so the SD card doesn't
+    have to wait for the thumb drive (or make the boot partition cross
+    the USB bus twice more). Where it is comes from the image's
+    manifest, see raspi_maker.manifest.
 
-    mount_command = ['sudo', 'mount', boot_partition, mount_dir]
+    Parameters
+    ----------
+    disk_image : str
+        The image, raw or compressed.
 
-    print(f'Mounting SD Card partition {boot_partition} to temp directory {mount_dir}')
-    interactive_console(mount_command)
+    target : raspi-maker.device.Device instance
+        The SD card.
 
-    # Note- this sed command is what the target mounts will look like
-    # I'm not messing with the blk_ids of our devices as we know them
-    # here.
+    manifest : dict
+        The manifest of disk_image.
+
+    SideEffects
+    -----------
+    Creates a partition on target device, with:
+        label: boot
+        size: equivalent to the image's partition 1
+
+    """
+    boot = dict(partition(manifest, 1))
+
+    # Same place and type as in the image. A new uuid though (GPT), the
+    # thumb drive's going to have the image's.
+    boot['uuid'] = None
+    get_helper().call(
+        'write_layout', path=target.path, partitions=[boot],
+        type=manifest['partition_table']['type'])
+    target.invalidate()
+
+    print('Copying the boot fs over, then labeling it.')
+    target_partition = target.partitions(full_paths=True)[0]
+    e2label_command = ['e2label', target_partition, 'boot']
+
+    # e2label has never managed this on a fat16 partition, and we've
+    # never minded, so don't start now.
+    stats, _ = get_helper().batch([
+        ('copy_range', {
+            'source': disk_image,
+            'target': target_partition,
+            'start': boot['start'],
+            'end': boot['end'],
+            'checksum': boot['sha256']}),
+        ('run', {'argv': e2label_command, 'check': False}),
+    ])
+    print('Boot partition copied with {0} in {1:.1f}s'.format(
+        stats['method'], stats['seconds']))
+    return stats
 
-    sed_command = [
-        'sudo',
-        'sed',
-        '-i',
-        '-E',
-        's#root=[^ ]+#root=/dev/sda2#',
-        os.path.join(mount_dir, 'cmdline.txt')]
-    console(sed_command)
-    sed_command = [
-        'sudo',
-        'sed',
-        '-i',
-        's# init=/usr/lib/raspi-config/init_resize.sh##',
-        os.path.join(mount_dir, 'cmdline.txt')]
 
-    print('Modifying init command line')
-    console(sed_command)
+@PromptOnError
+@timed
+def update_sdcard_boot_commands(device):
+    """Make the SD Card point to the thumb drive on boot."""
+    boot_partition = device.partitions(full_paths=True)[0]
+
+    # Note- this is what the target mounts will look like.
+    # I'm not messing with the blk_ids of our devices as we know them
+    # here.
+    with _mounted(boot_partition) as mount_dir:
+        print(f'Mounted SD Card partition {boot_partition} on temp directory '
+              f'{mount_dir}, modifying init command line, unmounting')
+        get_helper().call(
+            'apply_plan', plan=boot_commands_plan(mount_dir).to_dict())
 
-    print('Successfully modified! Unmounting.')
-    umount_command = ['sudo', 'umount', mount_dir]
-    interactive_console(umount_command)
 
-    print('Cleaning up mounted dir')
-    os.rmdir(mount_dir)
+@timed
+def expand_second_partition(device, manifest, grow_on_boot=False):
+    """Take the root partition (the image's last one, partition 2 on a
+    Pi image) from the thumb drive and expand it.
 
+    The new layout (no boot partition, root out to the end of the
+    drive) comes from the image's manifest and goes down in one write.
 
-def expand_second_partition(device):
-    """Take the second partition from the thumb drive and expand it."""
+    grow_on_boot leaves the filesystem the size it was, and the Pi grows
+    it on its first boot (polish_plan installs a unit that does that).
+    That skips a full e2fsck and a resize2fs over USB, which is most of
+    the time this step takes.
+    """
+    root = dict(root_partition(manifest))
 
-    print('Deleting the original boot partition from the thumb drive')
-    _delete_partition(device, 1)
+    # Both in one table write: the boot partition goes (the SD card has
+    # it) and the root partition runs to the end of the drive.
+    print('Deleting the original boot partition from the thumb drive, '
+          'expanding the root partition')
+    root['end'] = None
+    get_helper().call('write_layout', path=device.path, partitions=[root])
+    device.invalidate()
 
-    print('Expanding the partition. Resizing isn\'t worth it. Or obvious to do.')
-    resize_command = ['sudo', 'parted', device.path, 'resizepart', '2', '"-1s"']
-    interactive_console(resize_command)
+    if grow_on_boot:
+        print('Leaving the filesystem for the Pi to grow on first boot')
+        return
 
     print('Fixing the nibbly bits for the partition itself')
     target_partition = device.partitions(full_paths=True)[0]
-    interactive_console(['sudo', 'e2fsck', '-f', target_partition])
+    run_privileged(['e2fsck', '-f', target_partition])
 
+    # With no size, resize2fs fills the partition, which is what we want.
     print('Fixing ext4 so it goes all the way to the end')
-    target_end = device.partition_specs(2)['End']
-    interactive_console(['sudo', 'resize2fs', target_partition, target_end])
+    run_privileged(['resize2fs', target_partition])
 
     print('Success!')
 
 
-def polish_drive(device, ssid, psk, user, hostname):
-    mount_dir = mkdtemp()
-    mount_command = [
-        'sudo',
-        'mount',
-        device.partitions(full_paths=True)[0],
-        mount_dir]
-
-    print('Mounting device locally')
-    interactive_console(mount_command)
-
-    print('Changing password acceptance on ssh policy to "no thanks"')
-    sed_ssh_command = [
-        'sudo',
-        'sed',
-        '-i',
-        's/#PasswordAuthentication yes/PasswordAuthentication no/',
-        os.path.join(mount_dir, 'etc', 'ssh', 'sshd_config')
-    ]
-    interactive_console(sed_ssh_command)
-
-    print('Creating a .ssh directory for pi user.')
-    mkdir_command = [
-        'sudo',
-        'mkdir',
-        os.path.join(mount_dir, 'home', 'pi', '.ssh')
-    ]
-    interactive_console(mkdir_command)
-
-    print('adding ~/.ssh/id_rsa.pub to ~/.ssh/authorized_keys')
-    authorized_keys_command = [
-        'sudo',
-        'cp',
-        os.path.join(os.path.expanduser('~/'), '.ssh', 'id_rsa.pub'),
-        os.path.join(mount_dir, 'home', 'pi', '.ssh', 'authorized_keys')
-    ]
-    interactive_console(authorized_keys_command)
-
-    print('Chowning the whole thing as UID=pID')
-    chown_command = [
-        'sudo',
-        'chown',
-        '-R',
-        '1000:1000',
-        os.path.join(mount_dir, 'home', 'pi', '.ssh')
-    ]
-    interactive_console(chown_command)
-
-    print('Stricting up perms on .ssh dir as well')
-    chown_command = [
-        'sudo',
-        'chmod',
-        '700',
-        os.path.join(mount_dir, 'home', 'pi', '.ssh')
-    ]
-    interactive_console(chown_command)
+@timed
+def polish_drive(device, ssid, psk, user, hostname, grow_on_boot=False):
+    """Mount the root partition of a thumb drive and polish it."""
+    _polish_partition(
+        device.partitions(full_paths=True)[0], ssid, psk, user, hostname,
+        grow_on_boot=grow_on_boot)
 
-    if ssid and psk:
-        print('Throwing the wireless info into the wpa_supplicant.conf')
-        supplicant = os.path.join(mount_dir, 'etc', 'wpa_supplicant', 'wpa_supplicant.conf')
-        me = os.getlogin()
-
-        interactive_console(['sudo', 'chown', me, supplicant])
-        with open(supplicant, 'a') as f:
-            f.write('\n')
-            f.write('network={\n')
-            f.write('    ssid="{ssid}"\n'.format(ssid=ssid))
-            f.write('    psk="{psk}"\n'.format(psk=psk))
-            f.write('}\n')
-            f.write('\n')
-        interactive_console(['sudo', 'chown', '0:0', supplicant])
-
-    print('Killing the pi user. Time to die!')
-    print('...')
-    print('Removing pi name from etc/passwd')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/pi/{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'passwd')
-    ])
-    print('Steal pis password for user')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/pi/{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'shadow')
-    ])
-    print('Removing pi group from etc/passwd')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/pi/{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'passwd')
-    ])
-    print('Removing pi group from etc/sudoers.d/010_pi-nopasswd')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/pi/{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'sudoers.d', '010_pi-nopasswd')
-    ])
-    print('Removing pi group from etc/group')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/:pi/:{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'group')
-    ])
-    print('Removing pi group from etc/group, again')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-E',
-        '-i',
-        's#^pi\:x\:1000#{0}:x:1000:#'.format(user),
-        os.path.join(mount_dir, 'etc', 'group')
-    ])
-    print('Removing pi group from etc/gshadow')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/:pi/:{0}/'.format(user),
-        os.path.join(mount_dir, 'etc', 'gshadow')
-    ])
-    print('Removing pi group from etc/gshadow, again')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-E',
-        '-i',
-        's#^pi\:!\:\:#{0}:!::#'.format(user),
-        os.path.join(mount_dir, 'etc', 'gshadow')
-    ])
-    print('Moving pi directory')
-    interactive_console([
-        'sudo',
-        'mv',
-        os.path.join(mount_dir, 'home', 'pi'),
-        os.path.join(mount_dir, 'home', user)
-    ])
 
-    print('Autologging in new user')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/pi/{0}/'.format(user),
-        os.path.join(
-            mount_dir,
-            'etc',
-            'systemd',
-            'system',
-            'autologin@.service')
-    ])
+@timed
+def polish_image(disk_image, ssid, psk, user, hostname, work_dir=None,
+                 grow_on_boot=False):
+    """Polish a copy of the image before it goes anywhere near a device.
 
-    print('Changing hostname',)
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'hostname')
-    ])
+    The copy lives next to the original (so it can be a reflink on
+    filesystems that do copy-on-write), or in work_dir if given, gets
+    attached to a loop device, and its root partition is polished on
+    fast local disk. Flashing the result is then nothing but sequential
+    writes.
 
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'hosts')
-    ])
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'hosts')
-    ])
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'hosts')
-    ])
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'ssh', 'ssh_host_rsa_key.pub')
-    ])
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'ssh', 'ssh_host_ecdsa_key.pub')
-    ])
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        's/raspberrypi/{0}/'.format(hostname),
-        os.path.join(mount_dir, 'etc', 'ssh', 'ssh_host_dsa_key.pub')
-    ])
+    Compressed images get decompressed into the copy first.
 
-    print('Fix the /boot fstab partition')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        '-E',
-        's#PARTUUID=.*-01#/dev/mmcblk0p1#',
-        os.path.join(mount_dir, 'etc', 'fstab')
-    ])
-    print('Fix the root fstab partition')
-    interactive_console([
-        'sudo',
-        'sed',
-        '-i',
-        '-E',
-        's#PARTUUID=.*-02#/dev/sda2#',
-        os.path.join(mount_dir, 'etc', 'fstab')
-    ])
+    Which partition is root comes from the image's manifest, same as
+    expand_second_partition, not a hardcoded 2.
+
+    grow_on_boot is passed on to polish_plan.
 
-    print('Enabling SSH service on boot')
-    ssh_service_path = os.path.join(mount_dir, 'lib', 'systemd', 'system', 'ssh.service')
-    symlink_path = os.path.join(mount_dir, 'etc', 'systemd', 'system', 'multi-user.target.wants', 'ssh.service')
-    enable_command = ['sudo', 'ln', '-s', ssh_service_path, symlink_path]
-    interactive_console(enable_command)
+    Returns
+    -------
+    str : path to the polished image. Its directory is a temp dir, get
+        rid of it with discard_polished_image when you're done.
+    """
+    root = root_partition(get_manifest(disk_image))
+    work_dir = mkdtemp(
+        prefix='raspi-maker-',
+        dir=work_dir or os.path.dirname(os.path.abspath(disk_image)))
+    polished = os.path.join(work_dir, 'polished.img')
+
+    try:
+        if is_compressed(disk_image):
+            print('Decompressing {0} to polish it'.format(disk_image))
+            decompress_to(disk_image, polished)
+        else:
+            working_copy(disk_image, polished)
+
+        with LoopDevice(polished) as loop:
+            print('Polishing {0} on {1}'.format(polished, loop.path))
+            _polish_partition(
+                loop.partition(root['number']), ssid, psk, user, hostname,
+                grow_on_boot=grow_on_boot)
+    except BaseException:
+        # Half a polished image is no use to anyone, and in the cache's
+        # directory nothing else would ever clear it up.
+        discard_polished_image(polished)
+        raise
+
+    return polished
+
+
+def cached_polish_image(disk_image, ssid, psk, user, hostname, cache=None,
+                        grow_on_boot=False):
+    """polish_image, unless we've polished this exact thing before.
+
+    Parameters
+    ----------
+    cache : raspi_maker.cache.PolishCache
+        Defaults to the shared one, see raspi_maker.cache.get_polish_cache.
 
-    print('Good to go! Unmounting')
-    umount_command = ['sudo', 'umount', mount_dir]
-    interactive_console(umount_command)
+    Returns
+    -------
+    str : path to the polished image, inside the cache. Leave it there.
+    """
+    if cache is None:
+        cache = get_polish_cache()
+
+    key = cache.key(
+        disk_image, ssid, psk, user, hostname, grow_on_boot=grow_on_boot)
+    with cache.lock(key):
+        cached = cache.get(key)
+        if cached is not None:
+            print('Already polished this one: {0}'.format(cached))
+            return cached
+
+        # Polished in the cache's directory, so putting it in the cache
+        # is a rename, and it stays sparse.
+        polished = polish_image(
+            disk_image, ssid, psk, user, hostname, work_dir=cache.directory,
+            grow_on_boot=grow_on_boot)
+        try:
+            return cache.put(key, polished)
+        finally:
+            discard_polished_image(polished)
+
+
+def discard_polished_image(polished):
+    """Clean up after polish_image."""
+    shutil.rmtree(os.path.dirname(polished), ignore_errors=True)
+
+
+def boot_commands_plan(mount_dir):
+    """Edits to the SD card's cmdline.txt so it boots off the thumb drive."""
+    plan = EditPlan(mount_dir)
+    plan.substitute('cmdline.txt', r'root=[^ ]+', 'root=/dev/sda2')
+    plan.substitute('cmdline.txt', r' init=/usr/lib/raspi-config/init_resize\.sh', '')
+    return plan
+
+
+def polish_plan(mount_dir, ssid, psk, user, hostname,
+                authorized_key='~/.ssh/id_rsa.pub', grow_on_boot=False):
+    """Everything polish does to a root filesystem, as one EditPlan.
+
+    * ssh: no password logins, our public key in authorized_keys, and
+      the service enabled on boot
+    * wifi: ssid and psk into wpa_supplicant.conf, if we have them
+    * the pi user gets renamed to user, home directory and all
+    * hostname changed everywhere raspberrypi shows up
+    * fstab pointed at the SD card boot and thumb drive root partitions
+    * with grow_on_boot, the root filesystem grown to fill the thumb
+      drive on first boot (see expand_second_partition). Without it the
+      filesystem was grown before the Pi ever saw it, so no unit.
+    """
+    plan = EditPlan(mount_dir)
+
+    plan.substitute(
+        'etc/ssh/sshd_config',
+        '#PasswordAuthentication yes',
+        'PasswordAuthentication no')
+
+    plan.mkdir('home/pi/.ssh')
+    authorized_key = os.path.expanduser(authorized_key)
+    if os.path.exists(authorized_key):
+        with open(authorized_key) as f:
+            plan.write('home/pi/.ssh/authorized_keys', f.read())
+    else:
+        print('No {0}, you will need a password to get in.'.format(
+            authorized_key))
+    plan.chown('home/pi/.ssh', 1000, 1000, recursive=True)
+    plan.chmod('home/pi/.ssh', 0o700)
 
-    print('Removing temp dir')
-    os.rmdir(mount_dir)
+    if ssid and psk:
+        plan.append(
+            'etc/wpa_supplicant/wpa_supplicant.conf',
+            '\nnetwork={{\n    ssid="{ssid}"\n    psk="{psk}"\n}}\n\n'.format(
+                ssid=ssid, psk=psk))
+
+    # pi shows up twice on its passwd line (name and home directory).
+    plan.substitute('etc/passwd', 'pi', user, count=2)
+    plan.substitute('etc/shadow', 'pi', user)
+    plan.substitute('etc/sudoers.d/010_pi-nopasswd', 'pi', user)
+    plan.substitute('etc/group', ':pi', ':' + user)
+    plan.substitute('etc/group', r'^pi:x:1000', user + ':x:1000')
+    plan.substitute('etc/gshadow', ':pi', ':' + user)
+    plan.substitute('etc/gshadow', r'^pi:!::', user + ':!::')
+    plan.move('home/pi', os.path.join('home', user))
+    plan.substitute('etc/systemd/system/autologin@.service', 'pi', user)
+
+    plan.substitute('etc/hostname', 'raspberrypi', hostname)
+    plan.substitute('etc/hosts', 'raspberrypi', hostname, count=0)
+    for key_type in ('rsa', 'ecdsa', 'dsa'):
+        plan.substitute(
+            'etc/ssh/ssh_host_{0}_key.pub'.format(key_type),
+            'raspberrypi',
+            hostname)
+
+    plan.substitute('etc/fstab', r'PARTUUID=.*-01', '/dev/mmcblk0p1')
+    plan.substitute('etc/fstab', r'PARTUUID=.*-02', '/dev/sda2')
+
+    plan.symlink(
+        '/lib/systemd/system/ssh.service',
+        'etc/systemd/system/multi-user.target.wants/ssh.service')
+
+    if grow_on_boot:
+        plan.write(
+            'etc/systemd/system/' + GROW_ROOT_UNIT, GROW_ROOT_SERVICE,
+            mode=0o644)
+        plan.symlink(
+            '/etc/systemd/system/' + GROW_ROOT_UNIT,
+            'etc/systemd/system/multi-user.target.wants/' + GROW_ROOT_UNIT)
+
+    return plan
+
+
+@contextmanager
+def _mounted(partition):
+    """Mount partition on a temp dir for the with block. It gets
+    unmounted, and the dir removed, however the block ends, so a failed
+    edit doesn't leave the device (or a loop device) busy."""
+    mount_dir = mkdtemp()
+    try:
+        run_privileged(['mount', partition, mount_dir])
+        try:
+            yield mount_dir
+        finally:
+            run_privileged(['umount', mount_dir])
+    finally:
+        os.rmdir(mount_dir)
+
+
+def _polish_partition(partition, ssid, psk, user, hostname,
+                      grow_on_boot=False):
+    print('Mounting device locally, polishing: ssh, wifi, {0} instead of pi, '
+          'hostname {1}, fstab, unmounting'.format(user, hostname))
+    with _mounted(partition) as mount_dir:
+        get_helper().call('apply_plan', plan=polish_plan(
+            mount_dir, ssid, psk, user, hostname,
+            grow_on_boot=grow_on_boot).to_dict())
 
     print('All done!')
@@ -0,0 +1,212 @@
+"""Raw block device ioctls, with plain file fallbacks for testing."""
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+
+
+# From linux/fs.h
+BLKGETSIZE64 = 0x80081272
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+BLKRRPART = 0x125f
+
+SECTOR = 512
+
+SYS_DEV_BLOCK = '/sys/dev/block'
+
+# From linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# An mmap, so page aligned: O_DIRECT writes can come straight out of it.
+_ZEROS = mmap.mmap(-1, 1024 * 1024)
+
+
+def is_block_device(fd):
+    """True if the open fd is a block device rather than a file."""
+    return stat.S_ISBLK(os.fstat(fd).st_mode)
+
+
+def reread_partitions(fd):
+    """Have the kernel reread a device's partition table.
+
+    Returns
+    -------
+    bool : False for plain files, and devices that don't do partitions
+        (loop devices without partscan), which have nothing to reread.
+
+    Raises
+    ------
+    OSError : EBUSY if one of the device's partitions is in use.
+    """
+    if not is_block_device(fd):
+        return False
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return False
+    return True
+
+
+def write_zeros(fd, offset, length):
+    """Zero a range the slow way, by writing zeros over it.
+
+    Works on an O_DIRECT fd too. The zeros are aligned, and a range that
+    isn't whole sectors (say the tail zero_range's ioctl can't do) gets
+    written with O_DIRECT turned off until it's done.
+    """
+    o_direct = getattr(os, 'O_DIRECT', 0)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    buffered = bool(flags & o_direct) and bool(
+        offset % SECTOR or length % SECTOR)
+    if buffered:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~o_direct)
+    try:
+        zeros = memoryview(_ZEROS)
+        end = offset + length
+        while offset < end:
+            n = os.pwrite(
+                fd, zeros[:min(len(zeros), end - offset)], offset)
+            offset += n
+        if buffered:
+            # Out of the page cache before O_DIRECT writes go around it.
+            os.fsync(fd)
+    finally:
+        if buffered:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def _punch_hole(fd, offset, length):
+    """Deallocate a range of a regular file. Reads back as zeros."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fallocate.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    result = libc.fallocate(
+        fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+    if result != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _range_ioctl(fd, request, offset, length):
+    """Issue a BLKZEROOUT/BLKDISCARD style ioctl on a sector aligned range.
+
+    Returns
+    -------
+    int : how many bytes at the end weren't covered, because the kernel
+        only deals in whole sectors.
+    """
+    aligned = length - (length % SECTOR)
+    if offset % SECTOR:
+        raise ValueError('offset {0} is not sector aligned'.format(offset))
+    if aligned:
+        fcntl.ioctl(fd, request, struct.pack('QQ', offset, aligned))
+    return length - aligned
+
+
+def discard_range(fd, offset, length):
+    """Tell the device a byte range is unused (TRIM, basically).
+
+    Block devices get BLKDISCARD. What a discarded range reads back as
+    is up to the card, often zeros, sometimes 0xff, sometimes the old
+    data. Regular files get a hole punched, which does read as zeros.
+
+    Raises
+    ------
+    OSError : EOPNOTSUPP or EINVAL if the device can't discard.
+    """
+    if length <= 0:
+        return
+    if is_block_device(fd):
+        _range_ioctl(fd, BLKDISCARD, offset, length)
+        return
+    _punch_hole(fd, offset, length)
+
+
+def _queue_value(fd, name, sys_dev_block=SYS_DEV_BLOCK):
+    """A block device's /sys/.../queue/<name> as an int, or None.
+    Partitions don't have a queue of their own, their disk's counts."""
+    rdev = os.fstat(fd).st_rdev
+    device = os.path.join(sys_dev_block, '{0}:{1}'.format(
+        os.major(rdev), os.minor(rdev)))
+    for queue in (os.path.join(device, 'queue'),
+                  os.path.join(device, '..', 'queue')):
+        try:
+            with open(os.path.join(queue, name)) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def zeroes_cheaply(fd, sys_dev_block=SYS_DEV_BLOCK):
+    """True if zero_range on fd is cheaper than writing the zeros.
+
+    Regular files get a hole punched, which is. A block device is only
+    if it does WRITE ZEROES itself (write_zeroes_max_bytes isn't 0), or
+    on old kernels, says discarded blocks read back as zeros. Without
+    either, BLKZEROOUT just has the kernel write every zero byte, which
+    is what most USB sticks and SD card readers get.
+    """
+    mode = os.fstat(fd).st_mode
+    if stat.S_ISREG(mode):
+        return True
+    if not stat.S_ISBLK(mode):
+        return False
+    for name in ('write_zeroes_max_bytes', 'discard_zeroes_data'):
+        if _queue_value(fd, name, sys_dev_block=sys_dev_block):
+            return True
+    return False
+
+
+def zero_range(fd, offset, length):
+    """Make a byte range read back as zeros, as cheaply as possible.
+
+    Block devices get BLKZEROOUT, which the kernel turns into a write
+    zeroes or unmap command when the hardware supports it. Regular files
+    get a hole punched in them (and are grown if they're too short).
+    Anything else gets zeros written over it.
+
+    Parameters
+    ----------
+    fd : int
+        Open, writable file descriptor.
+
+    offset : int
+        Byte offset to start at. Must be sector aligned on devices.
+
+    length : int
+        Number of bytes to zero.
+    """
+    if length <= 0:
+        return
+
+    if is_block_device(fd):
+        try:
+            tail = _range_ioctl(fd, BLKZEROOUT, offset, length)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY):
+                raise
+            tail = length
+        if tail:
+            write_zeros(fd, offset + length - tail, tail)
+        return
+
+    size = os.fstat(fd).st_size
+    if size < offset + length:
+        # Growing the file fills the new bit with zeros for free.
+        os.ftruncate(fd, offset + length)
+
+    existing = min(length, size - offset)
+    if existing <= 0:
+        return
+    try:
+        _punch_hole(fd, offset, existing)
+    except (OSError, AttributeError):
+        write_zeros(fd, offset, existing)
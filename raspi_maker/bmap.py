@@ -0,0 +1,143 @@
+"""Block maps: which bits of an image are actually worth writing.
+
+Same idea as bmaptool. Scan the image once, write down the ranges that
+have data in them and a sha256 for each, and keep that next to the image
+as `<image>.bmap.json`. Flashing then only touches those ranges and
+checks each one as it goes.
+
+The map remembers the size and mtime of the image it was made from, so
+a new download with the same name gets rescanned, and an old one never
+does.
+"""
+import hashlib
+import os
+
+from .copy_engine import ALIGNMENT
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import allocate_buffer
+from .copy_engine import data_extents
+from .copy_engine import fd_size
+from .copy_engine import is_zero
+from .copy_engine import read_chunk
+from .sidecar import get_sidecar
+from .sidecar import image_key
+from .sidecar import load_sidecar
+from .sidecar import save_sidecar
+
+
+BMAP_SUFFIX = '.bmap.json'
+BMAP_VERSION = 1
+
+# Granularity of the map. Anything smaller isn't worth a seek.
+MAP_BLOCK_SIZE = ALIGNMENT
+
+# Mapped ranges closer together than this get merged. Writing a few
+# hundred KB of zeros is cheaper than another round trip to a USB stick.
+MERGE_GAP = 1024 * 1024
+
+
+def bmap_path(image):
+    """Where the block map for an image lives."""
+    return image + BMAP_SUFFIX
+
+
+def _mapped_extents(fd, total, view):
+    """Yield (start, end) ranges of MAP_BLOCK_SIZE blocks with data in them."""
+    zeros = bytes(MAP_BLOCK_SIZE)
+    run_start = None
+    run_end = None
+
+    for start, end in data_extents(fd, total):
+        offset = start
+        while offset < end:
+            n = read_chunk(fd, view[:min(len(view), end - offset)], offset)
+            if n == 0:
+                break
+            for block in range(0, n, MAP_BLOCK_SIZE):
+                length = min(MAP_BLOCK_SIZE, n - block)
+                if is_zero(view[block:block + length], zeros):
+                    continue
+                block_start = offset + block
+                if run_end is not None and block_start - run_end <= MERGE_GAP:
+                    run_end = block_start + length
+                else:
+                    if run_start is not None:
+                        yield run_start, run_end
+                    run_start, run_end = block_start, block_start + length
+            offset += n
+
+    if run_start is not None:
+        yield run_start, run_end
+
+
+def _checksum(fd, view, start, end):
+    digest = hashlib.sha256()
+    offset = start
+    while offset < end:
+        n = read_chunk(fd, view[:min(len(view), end - offset)], offset)
+        if n == 0:
+            break
+        digest.update(view[:n])
+        offset += n
+    return digest.hexdigest()
+
+
+def generate_bmap(image, block_size=DEFAULT_BLOCK_SIZE):
+    """Scan an image and build its block map.
+
+    Parameters
+    ----------
+    image : str
+        Path to a raw .img file.
+
+    block_size : int
+        Read buffer size. Nothing to do with the map granularity.
+
+    Returns
+    -------
+    dict : the block map. 'ranges' is a list of [start, end, sha256]
+        with end exclusive, in bytes.
+    """
+    size, mtime_ns = image_key(image)
+    view = allocate_buffer(block_size)
+
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        total = fd_size(fd)
+        extents = list(_mapped_extents(fd, total, view))
+        ranges = [
+            [start, end, _checksum(fd, view, start, end)]
+            for start, end in extents]
+    finally:
+        os.close(fd)
+
+    return {
+        'version': BMAP_VERSION,
+        'image': os.path.basename(image),
+        'image_size': size,
+        'image_mtime_ns': mtime_ns,
+        'map_block_size': MAP_BLOCK_SIZE,
+        'mapped_bytes': sum(end - start for start, end, _ in ranges),
+        'ranges': ranges,
+    }
+
+
+def load_bmap(image):
+    """Return the cached block map for image, or None if it's stale/missing."""
+    return load_sidecar(image, BMAP_SUFFIX, BMAP_VERSION)
+
+
+def save_bmap(image, bmap):
+    """Write the block map next to the image. Atomic, so no half maps."""
+    save_sidecar(image, BMAP_SUFFIX, bmap)
+
+
+def get_bmap(image):
+    """Load the block map for an image, scanning it first if we have to.
+
+    If the map can't be saved next to the image (read only mount, say)
+    it still gets returned, we'll just scan again next time.
+    """
+    return get_sidecar(
+        image, BMAP_SUFFIX, BMAP_VERSION, generate_bmap, 'block map',
+        'Scanning {0} for a block map. Only happens once.')
@@ -0,0 +1,179 @@
+"""Cache of polished images, so the same polish never happens twice.
+
+A polished image is keyed on a hash of the base image and everything
+polish_drive gets told (ssid, psk, user, hostname, and the public key
+that ends up in authorized_keys). Re-provisioning a replaced card for a
+node we've done before is then just a flash.
+
+The cache is bounded by how much disk it actually uses (images are
+sparse, so that's a lot less than their size), and evicts whatever was
+used longest ago. "Used" is the access time, which we bump on every hit.
+Modification times are left alone, since block maps key off them.
+"""
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .bmap import get_bmap
+from .decompress import is_compressed
+from .image_store import ImageStore
+from .loop import working_copy
+
+
+CACHE_DIR = '~/.cache/raspi-maker/polished'
+
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+
+AUTHORIZED_KEY = '~/.ssh/id_rsa.pub'
+
+# Bumped whenever polishing changes what it does, so images polished
+# the old way aren't handed out.
+POLISH_VERSION = 2
+
+
+class PolishCache(object):
+    """A directory of polished images, named by their key.
+
+    Parameters
+    ----------
+    store : raspi_maker.image_store.ImageStore
+        Where compressed images' sha256s are remembered. Defaults to the
+        usual catalog.
+    """
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES,
+                 store=None):
+        self.directory = os.path.expanduser(directory)
+        self.store = store if store is not None else ImageStore()
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def fingerprint(self, disk_image):
+        """sha256 that changes when the image's contents do.
+
+        Raw images are fingerprinted off their block map, which already
+        has a checksum for every byte that isn't zero. Compressed images
+        use their sha256 out of the image store's catalog, so they get
+        hashed whole once, whether for this or a lookup by hash.
+        """
+        if not is_compressed(disk_image):
+            bmap = get_bmap(disk_image)
+            digest = hashlib.sha256(str(bmap['image_size']).encode('utf8'))
+            for start, end, checksum in bmap['ranges']:
+                digest.update(
+                    '{0}:{1}:{2}'.format(start, end, checksum).encode('utf8'))
+            return digest.hexdigest()
+
+        return self.store.sha256(disk_image)
+
+    def key(self, disk_image, ssid, psk, user, hostname,
+            authorized_key=AUTHORIZED_KEY, grow_on_boot=False):
+        """The cache key for polishing disk_image with these parameters."""
+        key_path = os.path.expanduser(authorized_key)
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                key_contents = f.read()
+        else:
+            key_contents = ''
+
+        params = json.dumps({
+            'image': self.fingerprint(disk_image),
+            'ssid': ssid,
+            'psk': psk,
+            'user': user,
+            'hostname': hostname,
+            'authorized_key': key_contents,
+            'grow_on_boot': grow_on_boot,
+            'polish_version': POLISH_VERSION,
+        }, sort_keys=True)
+        return hashlib.sha256(params.encode('utf8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.img')
+
+    def lock(self, key):
+        """A lock per key, so two threads don't polish the same thing."""
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key):
+        """Path to the cached image for key, or None. Counts as a use."""
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        return path
+
+    def put(self, key, image):
+        """Move a freshly polished image into the cache.
+
+        Polish it in the cache's directory (see
+        actions.cached_polish_image) and this is just a rename. From
+        another filesystem it gets a sparse copy, not shutil.move's
+        copy of every zero, which would fill the cache a lot faster.
+
+        Returns
+        -------
+        str : where it lives now.
+        """
+        path = self.path_for(key)
+        temp_path = path + '.tmp'
+        try:
+            os.rename(image, temp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            working_copy(image, temp_path)
+            os.remove(image)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def _entries(self):
+        """(last used, bytes on disk, files) for every cached image."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.img'):
+                continue
+            path = os.path.join(self.directory, name)
+            files = [path] + [
+                os.path.join(self.directory, other)
+                for other in os.listdir(self.directory)
+                if other.startswith(name + '.') and not other.endswith('.tmp')]
+            used = sum(os.stat(f).st_blocks * 512 for f in files)
+            entries.append((os.stat(path).st_atime_ns, used, files))
+        return entries
+
+    def evict(self, keep=None):
+        """Drop least recently used images until we're under max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(used for _, used, _ in entries)
+        for _, used, files in entries:
+            if total <= self.max_bytes:
+                break
+            if files[0] == keep:
+                continue
+            print('Evicting {0} from the polish cache'.format(files[0]))
+            for f in files:
+                os.remove(f)
+            total -= used
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_polish_cache():
+    """The shared PolishCache, in CACHE_DIR. Shared so its per key locks
+    are too: two pairs polishing the same thing at once wait for each
+    other, rather than both missing and polishing it twice."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PolishCache()
+        return _cache
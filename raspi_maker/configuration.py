@@ -1,24 +1,56 @@
 """Configure it just, just right."""
 from configparser import ConfigParser
+from configparser import NoOptionError
 from configparser import NoSectionError
+import json
 import os
 
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from .copy_engine import ALIGNMENT
+from .copy_engine import MiB
+from .wipe import WIPE_MODES
+
 
 CONFIG_FILE='./config.ini'
 
-def file_config_exists():
-    if os.path.exists(CONFIG_FILE):
+# Sections named like [pair.1], [pair.2] make it a batch config.
+PAIR_PREFIX = 'pair.'
+
+DEFAULT_WORKERS = 4
+
+# What a run spec can say about how to run, and what you get if it
+# doesn't. Same names as build_pipeline's keyword arguments.
+RUN_SETTINGS = {
+    'full': False,
+    'verify': False,
+    'offline_polish': False,
+    'polish_cache': True,
+    'wipe': 'signatures',
+    'grow_on_boot': False,
+    'block_size': None,
+}
+
+SIZE_SUFFIXES = {'K': 1024, 'M': MiB, 'G': 1024 * MiB}
+
+
+def file_config_exists(path=CONFIG_FILE):
+    if os.path.exists(path):
         return True
     return False
 
-def parse_config():
+
+def _read(path):
     parser = ConfigParser()
-    with open(CONFIG_FILE) as f:
-        parser.readfp(f)
+    with open(path) as f:
+        parser.read_file(f)
+    return parser
 
-    sd_card = parser.get('devices', 'sd_card')
-    thumb_drive = parser.get('devices', 'thumb_drive')
 
+def _wireless(parser):
     try:
         ssid = parser.get('wireless', 'ssid')
         psk = parser.get('wireless', 'psk')
@@ -27,4 +59,290 @@ def parse_config():
         ssid = None
         psk = None
 
+    return ssid, psk
+
+
+def parse_config(path=CONFIG_FILE):
+    parser = _read(path)
+
+    sd_card = parser.get('devices', 'sd_card')
+    thumb_drive = parser.get('devices', 'thumb_drive')
+
+    ssid, psk = _wireless(parser)
+
     return sd_card, thumb_drive, ssid, psk
+
+
+def parse_polish(path=CONFIG_FILE):
+    """user and hostname from a [polish] section, so nobody has to be
+    asked. (None, None) for whatever isn't there."""
+    parser = _read(path)
+    return (parser.get('polish', 'user', fallback=None),
+            parser.get('polish', 'hostname', fallback=None))
+
+
+def is_batch_config(path=CONFIG_FILE):
+    """True if the config lists device pairs instead of one [devices]."""
+    parser = _read(path)
+    return any(s.startswith(PAIR_PREFIX) for s in parser.sections())
+
+
+def parse_batch_config(path=CONFIG_FILE):
+    """Parse a config listing many SD card / thumb drive pairs.
+
+    Looks like:
+
+        [batch]
+        user=admin
+        hostname=node-{n:02d}
+        workers=4
+
+        [pair.1]
+        sd_card=mmcblk0
+        thumb_drive=sdb
+
+        [pair.2]
+        sd_card=sdc
+        thumb_drive=sdd
+        hostname=the-odd-one
+
+        [wireless]
+        ssid=your_ssid
+        psk=your_ssid_password
+
+    user and hostname in [batch] are templates, formatted with n, the
+    number after `pair.`. Any pair can override either one.
+
+    Returns
+    -------
+    tuple : (pairs, ssid, psk, workers). pairs is a list of dicts with
+        n, sd_card, thumb_drive, user and hostname, in config order.
+
+    Raises
+    ------
+    ValueError : if a device shows up in more than one pair.
+    """
+    parser = _read(path)
+
+    def batch_option(name, default=None):
+        try:
+            return parser.get('batch', name)
+        except (NoSectionError, NoOptionError):
+            return default
+
+    user_template = batch_option('user', 'pi')
+    hostname_template = batch_option('hostname', 'raspberrypi-{n}')
+    workers = int(batch_option('workers', DEFAULT_WORKERS))
+
+    pairs = []
+    seen = set()
+    for section in parser.sections():
+        if not section.startswith(PAIR_PREFIX):
+            continue
+        n = int(section[len(PAIR_PREFIX):])
+        pair = {
+            'n': n,
+            'sd_card': parser.get(section, 'sd_card'),
+            'thumb_drive': parser.get(section, 'thumb_drive'),
+            'user': parser.get(
+                section, 'user', fallback=user_template).format(n=n),
+            'hostname': parser.get(
+                section, 'hostname', fallback=hostname_template).format(n=n),
+        }
+        for device in (pair['sd_card'], pair['thumb_drive']):
+            if device in seen:
+                raise ValueError(
+                    'Device {0} is in more than one pair'.format(device))
+            seen.add(device)
+        pairs.append(pair)
+
+    ssid, psk = _wireless(parser)
+
+    return pairs, ssid, psk, workers
+
+
+def _ini_spec(path):
+    """An ini run spec, in the shape a TOML or JSON one comes in."""
+    parser = _read(path)
+    spec = dict(
+        (section, dict(parser.items(section)))
+        for section in ('run', 'polish', 'wireless')
+        if parser.has_section(section))
+    # A batch config's [batch] does the same job as [polish] and [run].
+    if parser.has_section('batch'):
+        batch = dict(parser.items('batch'))
+        polish = spec.setdefault('polish', {})
+        run = spec.setdefault('run', {})
+        for key in ('user', 'hostname'):
+            if key in batch:
+                polish.setdefault(key, batch[key])
+        if 'workers' in batch:
+            run.setdefault('workers', batch['workers'])
+
+    pairs = []
+    if parser.has_section('devices'):
+        pairs.append(dict(parser.items('devices')))
+    for section in parser.sections():
+        if section.startswith(PAIR_PREFIX):
+            pair = dict(parser.items(section))
+            pair['n'] = section[len(PAIR_PREFIX):]
+            pairs.append(pair)
+    spec['pairs'] = pairs
+    return spec
+
+
+def _read_spec(path):
+    """The raw spec, whatever it's written in. Goes by the extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.toml':
+        if tomllib is None:
+            raise ImportError(
+                'TOML run specs need python 3.11, or use .json or .ini')
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    if extension == '.json':
+        with open(path) as f:
+            return json.load(f)
+    return _ini_spec(path)
+
+
+def _boolean(name, value):
+    if isinstance(value, bool):
+        return value
+    states = ConfigParser.BOOLEAN_STATES
+    if str(value).lower() not in states:
+        raise ValueError('{0} should be true or false, got {1!r}'.format(
+            name, value))
+    return states[str(value).lower()]
+
+
+def _size(name, value):
+    """Bytes, from 16777216 or '16M' (K, M and G, powers of two)."""
+    text = str(value).strip().upper()
+    scale = SIZE_SUFFIXES.get(text[-1:], 1)
+    if scale > 1:
+        text = text[:-1]
+    try:
+        size = int(text) * scale
+    except ValueError:
+        raise ValueError('{0} should be a size like 16M, got {1!r}'.format(
+            name, value))
+    if size <= 0 or size % ALIGNMENT:
+        raise ValueError('{0} must be a multiple of {1} bytes, got {2}'.format(
+            name, ALIGNMENT, size))
+    return size
+
+
+def _run_settings(run):
+    settings = dict(RUN_SETTINGS)
+    unknown = set(run) - set(settings) - set(['image', 'workers'])
+    if unknown:
+        raise ValueError('Unknown [run] settings: {0}'.format(
+            ', '.join(sorted(unknown))))
+    for name in ('full', 'verify', 'offline_polish', 'polish_cache',
+                 'grow_on_boot'):
+        if name in run:
+            settings[name] = _boolean(name, run[name])
+    if 'wipe' in run:
+        if run['wipe'] not in WIPE_MODES + ('none',):
+            raise ValueError('wipe should be one of {0}, got {1!r}'.format(
+                ', '.join(WIPE_MODES + ('none',)), run['wipe']))
+        settings['wipe'] = None if run['wipe'] == 'none' else run['wipe']
+    if run.get('block_size') is not None:
+        settings['block_size'] = _size('block_size', run['block_size'])
+    return settings
+
+
+def parse_run_spec(path):
+    """Parse a run spec: everything a run needs, so nobody gets asked.
+
+    TOML (python 3.11 and up), JSON or ini, going by the extension. In
+    TOML:
+
+        [run]
+        image = "~/images/raspios-lite.img.xz"
+        workers = 4
+        block_size = "16M"
+        verify = true
+        wipe = "signatures"
+
+        [polish]
+        user = "admin"
+        hostname = "node-{n:02d}"
+
+        [wireless]
+        ssid = "your_ssid"
+        psk = "your_ssid_password"
+
+        [[pairs]]
+        sd_card = "mmcblk0"
+        thumb_drive = "sdb"
+
+        [[pairs]]
+        sd_card = "sdc"
+        thumb_drive = "sdd"
+        hostname = "the-odd-one"
+
+    JSON is the same shape. An ini spec is a normal config file (see
+    config.ini.example and batch.ini.example) plus a [polish] section
+    and, if you like, a [run] one.
+
+    Everything in [run] is optional: image (a path, or the name or
+    sha256 of one in the image store, see raspi_maker.image_store;
+    otherwise it's looked for the usual way), workers, block_size (the copy buffer, bytes or
+    '16M' style), and full, verify, offline_polish, polish_cache,
+    wipe and grow_on_boot, which do what the command line flags do.
+    user and hostname are templates, formatted with n, the pair's
+    number (its position, counting from 1, unless it says otherwise).
+    Any pair can override either one.
+
+    Returns
+    -------
+    dict : image (None if not given), pairs (dicts of n, sd_card,
+        thumb_drive, user and hostname), ssid, psk, workers, and
+        settings (keyword arguments for build_pipeline).
+
+    Raises
+    ------
+    ValueError : if anything's missing, unknown or doesn't make sense,
+        before any device gets touched.
+    """
+    raw = _read_spec(path)
+    run = dict(raw.get('run', {}))
+    polish = raw.get('polish', {})
+    wireless = raw.get('wireless', {})
+
+    pairs = []
+    seen = set()
+    for index, entry in enumerate(raw.get('pairs', []), 1):
+        n = int(entry.get('n', index))
+        pair = {'n': n}
+        for key in ('sd_card', 'thumb_drive'):
+            if not entry.get(key):
+                raise ValueError('Pair {0} has no {1}'.format(n, key))
+            pair[key] = entry[key]
+        for key in ('user', 'hostname'):
+            template = entry.get(key, polish.get(key))
+            if not template:
+                raise ValueError(
+                    'Pair {0} has no {1}, and there is no [polish] {1} '
+                    'to fall back on'.format(n, key))
+            pair[key] = template.format(n=n)
+        for device in (pair['sd_card'], pair['thumb_drive']):
+            if device in seen:
+                raise ValueError(
+                    'Device {0} is in more than one pair'.format(device))
+            seen.add(device)
+        pairs.append(pair)
+    if not pairs:
+        raise ValueError('{0} has no devices in it'.format(path))
+
+    image = run.get('image')
+    return {
+        'image': os.path.expanduser(image) if image else None,
+        'pairs': pairs,
+        'ssid': wireless.get('ssid'),
+        'psk': wireless.get('psk'),
+        'workers': int(run.get('workers', DEFAULT_WORKERS)),
+        'settings': _run_settings(run),
+    }
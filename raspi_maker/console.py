@@ -1,70 +1,103 @@
 """Drop some shit to terminal."""
+import asyncio
+import time
+from asyncio.subprocess import DEVNULL
+from asyncio.subprocess import PIPE
+from asyncio.subprocess import STDOUT
 
-from subprocess import Popen
-from subprocess import PIPE
-from subprocess import STDOUT
+from .debugging import PromptOnError
+from .timing import add_subprocesses
 
-from queue import Queue
-from queue import Empty
 
-from threading import Thread
+class CommandResult(object):
+    """What a command left behind: exit code and everything it printed."""
+    def __init__(self, cmd, returncode, output):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
 
-import time
+    @property
+    def ok(self):
+        return self.returncode == 0
 
-from .debugging import PromptOnError
+    def __repr__(self):
+        return 'CommandResult({0!r}, returncode={1})'.format(
+            ' '.join(self.cmd), self.returncode)
 
 
-def enqueue(pipe, queue):
-    """Takes a pipe and a queue, and unloads.
-    
+async def run_async(cmd_list, inputs=None, echo=False):
+    """Run a command, without polling or sleeping for it.
+
     Parameters
     ----------
-    pipe : subprocess.Popen.stdout.
-        A file-like object.
-    
-    queue : Queue.Queue
-        A FIFO Queue.
+    cmd_list : list : str
+        Command list. no pipes, please.
+
+    inputs : list : str
+        Lines to send to stdin. stdin is closed after.
+
+    echo : bool
+        Print output lines as they show up.
+
+    Returns
+    -------
+    CommandResult : stdout and stderr are captured together.
     """
-    for line in iter(pipe.readline, b''):
-        queue.put(line)
-    pipe.close()
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *cmd_list,
+        stdin=PIPE if inputs else DEVNULL,
+        stdout=PIPE,
+        stderr=STDOUT)
 
+    if inputs:
+        process.stdin.write(''.join(i + '\n' for i in inputs).encode('utf8'))
+        await process.stdin.drain()
+        process.stdin.close()
 
-def read_queue(queue):
-    """Return everything from the queue in a dandy string.
-    Logic is to handle
+    lines = []
+    async for line in process.stdout:
+        line = line.decode('utf8', 'replace')
+        lines.append(line)
+        if echo:
+            print(line, end='')
 
-    Parameters
-    ----------
-    queue : Queue.Queue
+    returncode = await process.wait()
+    add_subprocesses(1, time.monotonic() - start)
+    return CommandResult(cmd_list, returncode, ''.join(lines))
+
+
+async def run_many_async(cmd_lists, limit=None, echo=False):
+    """Run a bunch of commands at the same time, at most limit at once.
 
     Returns
     -------
-    str : queue contents
-
-    SideEffects
-    -----------
-    Depopulates the queue provided.
+    list : CommandResults, in the same order as cmd_lists.
     """
-    output = ''
-    try:
-        # Non blocking queue population
-        while True:
-            # Raises Queue.Empty on empty queue
-            output += queue.get_nowait().decode('utf8')
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def one(cmd_list):
+        if semaphore is None:
+            return await run_async(cmd_list, echo=echo)
+        async with semaphore:
+            return await run_async(cmd_list, echo=echo)
+
+    return await asyncio.gather(*(one(cmd) for cmd in cmd_lists))
+
+
+def run(cmd_list, inputs=None, echo=False):
+    """Blocking wrapper for run_async. Fine to call from any thread."""
+    return asyncio.run(run_async(cmd_list, inputs=inputs, echo=echo))
 
-    # Catch and Return
-    except Empty:
-        return output
 
+def run_many(cmd_lists, limit=None, echo=False):
+    """Blocking wrapper for run_many_async."""
+    return asyncio.run(run_many_async(cmd_lists, limit=limit, echo=echo))
 
-def console(cmd, blocking=True, shell=True):
-    open_pipe = Popen(cmd, stdout=PIPE)
-    if blocking:
-        while open_pipe.poll() is None:
-            time.sleep(0.2)
 
-    return open_pipe.stdout.read().decode('utf8')
+def console(cmd):
+    """Run a command quietly and hand back what it printed."""
+    return run(cmd).output
 
 
 @PromptOnError
@@ -79,32 +112,16 @@ def interactive_console(cmd_list, inputs=None, verbose=True):
     inputs : list : str
         list of string responses to send. If empty, ignored
 
+    verbose : bool
+        Print the command, and its output as it comes.
+
     Returns
     -------
     bool : True if successful
     """
     if verbose:
         print('Running:', ' '.join(cmd_list))
-    process = Popen(cmd_list, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-    stdout_queue = Queue()
-    stdout_thread = Thread(target=enqueue, args=(process.stdout, stdout_queue))
-    stdout_thread.daemon= True
-    stdout_thread.start()
-
-    if inputs is None:
-        inputs = []
-
-    for str_input in inputs:
-        process.stdin.write(str_input + '\n')
-
-    while process.poll() is None:
-        output = read_queue(stdout_queue)
-        if output:
-            print(output)
-        time.sleep(1)
-
-    output = read_queue(stdout_queue)
-    if output:
-        print(output)
-
-    return True
+    result = run(cmd_list, inputs=inputs, echo=verbose)
+    if not result.ok:
+        print('{0} exited with {1}'.format(cmd_list[0], result.returncode))
+    return result.ok
@@ -0,0 +1,750 @@
+"""Move bytes from an image onto a device, quickly.
+
+This replaces the old `dd if=... | pv | sudo dd of=...` pipeline. dd
+defaults to 512 byte blocks and the pipe hops cost us two extra copies
+of every byte, so we do it in process instead:
+
+    * big page aligned buffers, pooled and reused from copy to copy
+    * preadv straight into that buffer, pwrite straight out of it
+    * O_DIRECT on the target where the kernel lets us have it
+
+Works the same against a block device or a plain file, so you can test
+it with an image file standing in for the thumb drive.
+
+Sparse mode skips every chunk of the image that's all zeros, plus any
+holes a sparse image file has in it, and zeros just those gaps on the
+target. That's only a win where zeroing is cheaper than writing (see
+blockdev.zeroes_cheaply): files, and cards that do WRITE ZEROES
+themselves. Everywhere else the gaps get written out like any other
+chunk, so it's no slower than a full copy, but no faster either.
+
+copy_stream does the same job for images that only come as a stream of
+chunks, like the decompressor in raspi_maker.decompress hands out.
+
+Every copy hands back a sha256 for each range it put on the target, so
+raspi_maker.verify can read them back later and check.
+
+copy_range lifts one byte range (a partition, say) out of an image and
+puts it at the start of a target, and lets the kernel move the bytes:
+copy_file_range, then sendfile, then plain pread/pwrite if neither will
+do it.
+"""
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from .blockdev import zero_range
+from .blockdev import zeroes_cheaply
+from .errors import ChecksumMismatch
+
+
+MiB = 1024 * 1024
+
+# O_DIRECT wants buffers, offsets and lengths aligned to the logical
+# block size of the device. 4096 covers everything we plug in.
+ALIGNMENT = 4096
+
+DEFAULT_BLOCK_SIZE = 16 * MiB
+
+
+def _check_block_size(block_size):
+    """Raise ValueError unless block_size is usable for direct io."""
+    if block_size <= 0 or block_size % ALIGNMENT:
+        raise ValueError(
+            'block_size must be a positive multiple of {0}, got {1}'.format(
+                ALIGNMENT, block_size))
+
+
+def allocate_buffer(block_size=DEFAULT_BLOCK_SIZE):
+    """Return a page aligned, reusable buffer of block_size bytes.
+
+    An anonymous mmap is always page aligned, which a bytearray is not,
+    and O_DIRECT will refuse to write out of an unaligned buffer.
+
+    Returns
+    -------
+    memoryview : writable view over the buffer.
+    """
+    _check_block_size(block_size)
+    return memoryview(mmap.mmap(-1, block_size))
+
+
+# Idle buffers kept for the next copy. More than one, since a batch has
+# a few copies and verifies on the go at once.
+POOLED_BUFFERS = 4
+
+
+class BufferPool(object):
+    """Buffers from allocate_buffer, checked out for a copy and handed
+    back after, so the next copy (or the verify after it) doesn't map a
+    fresh 16MiB.
+
+    Shared by every thread, not one per thread: the privileged helper
+    runs each request on a new thread, so a per thread buffer would
+    never get used twice.
+    """
+    def __init__(self, size=POOLED_BUFFERS):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def buffer(self, block_size=DEFAULT_BLOCK_SIZE):
+        """Yields a block_size buffer, all ours until the with ends."""
+        view = None
+        with self._lock:
+            for index, idle in enumerate(self._idle):
+                if len(idle) == block_size:
+                    view = self._idle.pop(index)
+                    break
+        if view is None:
+            view = allocate_buffer(block_size)
+        try:
+            yield view
+        finally:
+            with self._lock:
+                self._idle.append(view)
+                # Oldest out first, so a size nobody uses any more goes.
+                del self._idle[:-self.size]
+
+
+_pool = BufferPool()
+
+
+def pooled_buffer(block_size=DEFAULT_BLOCK_SIZE):
+    """A buffer out of the shared BufferPool, for a with block."""
+    return _pool.buffer(block_size)
+
+
+def open_source(path):
+    """Open something to read an image out of."""
+    return os.open(path, os.O_RDONLY)
+
+
+def open_target(path, direct=True, create=False):
+    """Open a device (or file) for writing.
+
+    Parameters
+    ----------
+    path : str
+        /dev/sdb, /dev/mmcblk0p1, or a plain file.
+
+    direct : bool
+        Try to open with O_DIRECT. Falls back quietly to buffered io
+        on filesystems that don't support it (tmpfs, for example).
+
+    create : bool
+        Create path if it isn't there, for writing to a plain file.
+        Off, a mistyped /dev/sdX is a FileNotFoundError, rather than a
+        few GB of regular file quietly flashed into /dev.
+
+    Returns
+    -------
+    (int, bool) : file descriptor, and whether O_DIRECT is on.
+    """
+    flags = os.O_WRONLY | (os.O_CREAT if create else 0)
+    o_direct = getattr(os, 'O_DIRECT', 0)
+    if direct and o_direct:
+        try:
+            return os.open(path, flags | o_direct, 0o644), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags, 0o644), False
+
+
+def _drop_direct(fd):
+    """Turn O_DIRECT off on an open fd, for unaligned tails."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~getattr(os, 'O_DIRECT', 0))
+
+
+def fd_size(fd):
+    """Size of whatever fd points at. fstat says 0 for block devices."""
+    current = os.lseek(fd, 0, os.SEEK_CUR)
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, current, os.SEEK_SET)
+    return size
+
+
+def data_extents(fd, total):
+    """Find the ranges of a file that actually have data in them.
+
+    Uses SEEK_DATA/SEEK_HOLE, so holes in sparse image files are skipped
+    without reading them. Filesystems (and devices) that don't support
+    that just get one big extent. Extents are widened to ALIGNMENT so
+    they stay O_DIRECT friendly.
+
+    Returns
+    -------
+    list : (start, end) byte offset tuples.
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < total:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but hole from here to the end.
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), total)
+            start -= start % ALIGNMENT
+            end = min(end + (-end % ALIGNMENT), total)
+            if extents and start <= extents[-1][1]:
+                extents[-1] = (extents[-1][0], end)
+            else:
+                extents.append((start, end))
+            offset = end
+    except (OSError, AttributeError):
+        return [(0, total)]
+    return extents
+
+
+def is_zero(view, zeros):
+    """True if view is all zero bytes. zeros must be at least as long.
+
+    bytes.startswith is a memcmp with no copying, which is a good 50x
+    faster than comparing memoryviews.
+    """
+    return zeros.startswith(view)
+
+
+def read_chunk(fd, view, offset):
+    """Fill view from fd at offset. Returns the number of bytes read.
+
+    Only comes up short at end of file.
+    """
+    done = 0
+    length = len(view)
+    while done < length:
+        n = os.preadv(fd, [view[done:]], offset + done)
+        if n == 0:
+            break
+        done += n
+    return done
+
+
+def write_chunk(fd, view, offset):
+    """Write all of view to fd at offset, retrying short writes."""
+    done = 0
+    length = len(view)
+    while done < length:
+        done += os.pwrite(fd, view[done:], offset + done)
+    return done
+
+
+class RangeRecorder(object):
+    """sha256s of what went onto a target, as (start, end, sha256) ranges.
+
+    Back to back chunks go into the same range. gap() ends the current
+    one, for bits we skipped (zeros) and don't need checked.
+    """
+    def __init__(self):
+        self.ranges = []
+        self._start = None
+        self._end = None
+        self._digest = None
+
+    def add(self, view, offset):
+        if self._digest is None or offset != self._end:
+            self.gap()
+            self._start = self._end = offset
+            self._digest = hashlib.sha256()
+        self._digest.update(view)
+        self._end += len(view)
+
+    def gap(self):
+        if self._digest is not None and self._end > self._start:
+            self.ranges.append(
+                [self._start, self._end, self._digest.hexdigest()])
+        self._digest = None
+
+    def finish(self):
+        self.gap()
+        return self.ranges
+
+
+class Target(object):
+    """An open target, remembering whether it's still in O_DIRECT mode,
+    and whether it can zero ranges without writing them."""
+    def __init__(self, path, direct=True, create=False):
+        self.fd, self.direct = open_target(
+            path, direct=direct, create=create)
+        self.zero_offload = zeroes_cheaply(self.fd)
+        self.zeroed = 0
+        self._zeros = None
+
+    def write(self, view, offset):
+        if self.direct and len(view) % ALIGNMENT:
+            _drop_direct(self.fd)
+            self.direct = False
+        return write_chunk(self.fd, view, offset)
+
+    def zero(self, offset, length):
+        """Make a gap we skipped read back as zeros.
+
+        Handed to the device where it can do that itself, written out
+        where it can't (a BLKZEROOUT would only have the kernel write
+        them instead, in smaller pieces).
+        """
+        if length <= 0:
+            return
+        self.zeroed += length
+        if self.zero_offload:
+            zero_range(self.fd, offset, length)
+            return
+        if self._zeros is None:
+            # Never written to, so it's all zero pages, and aligned.
+            self._zeros = allocate_buffer(DEFAULT_BLOCK_SIZE)
+        end = offset + length
+        while offset < end:
+            offset += self.write(
+                self._zeros[:min(len(self._zeros), end - offset)], offset)
+
+    def stats(self):
+        """What the gaps cost, for a copy's stats."""
+        return {'zeroed': self.zeroed, 'zero_offload': self.zero_offload}
+
+    def close(self):
+        try:
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+
+class Progress(object):
+    """Keeps the running byte count and throughput for a copy."""
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.written = 0
+        self.start = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def bytes_per_sec(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def update(self, n, written=True):
+        if not n:
+            return
+        self.done += n
+        if written:
+            self.written += n
+        if self.callback is not None:
+            self.callback(self.done, self.total, self.bytes_per_sec)
+
+    def finish(self):
+        """For streams: the total is whatever we ended up with."""
+        if self.total is None:
+            self.total = self.done
+            if self.callback is not None:
+                self.callback(self.done, self.total, self.bytes_per_sec)
+
+    def stats(self):
+        """Summary dict handed back to whoever asked for the copy."""
+        return {
+            'bytes': self.done,
+            'written': self.written,
+            'seconds': self.elapsed,
+            'bytes_per_sec': self.bytes_per_sec,
+        }
+
+
+def print_progress(done, total, bytes_per_sec):
+    """Default progress callback. Poor man's pv.
+
+    total is None for streams we don't know the length of yet.
+    """
+    if total is None:
+        sys.stdout.write('\r{0:8.1f} MiB  {1:7.1f} MiB/s'.format(
+            done / MiB, bytes_per_sec / MiB))
+    else:
+        percent = 100.0 * done / total if total else 100.0
+        sys.stdout.write('\r{0:6.2f}%  {1:8.1f} MiB  {2:7.1f} MiB/s'.format(
+            percent, done / MiB, bytes_per_sec / MiB))
+        if done >= total:
+            sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
+def _copy_extents(src, dst, extents, view, tracker, zeros=None,
+                  checksums=None, recorder=None):
+    """The actual copy loop, shared by copy_image and copy_ranges.
+
+    Parameters
+    ----------
+    src : int
+        Source fd.
+
+    dst : Target
+
+    extents : list
+        (start, end) byte ranges of the source to copy. Sorted.
+
+    view : memoryview
+        Buffer from allocate_buffer.
+
+    tracker : Progress
+
+    zeros : bytes
+        If given, chunks that are all zeros are skipped. Has to be at
+        least len(view) long.
+
+    checksums : list
+        If given, the expected sha256 hexdigest of each extent. Raises
+        ChecksumMismatch as soon as an extent comes out wrong.
+
+    recorder : RangeRecorder
+        If given, gets every extent, skipped zeros and all (they get
+        zeroed on the target, so they'll read back the same).
+
+    Only the gaps (between extents, and zero chunks skipped) get zeroed
+    on the target, each run of them in one go, right before the next
+    write. Nothing gets zeroed and then written over.
+    """
+    block_size = len(view)
+    position = 0
+    # Start of the run of bytes not written yet.
+    gap = 0
+    for index, (start, end) in enumerate(extents):
+        tracker.update(start - position, written=False)
+        digest = hashlib.sha256() if checksums is not None else None
+        offset = start
+        while offset < end:
+            chunk = view[:min(block_size, end - offset)]
+            n = read_chunk(src, chunk, offset)
+            if n == 0:
+                break
+            chunk = chunk[:n]
+            if digest is not None:
+                digest.update(chunk)
+            if recorder is not None:
+                recorder.add(chunk, offset)
+            if zeros is not None and is_zero(chunk, zeros):
+                tracker.update(n, written=False)
+            else:
+                dst.zero(gap, offset - gap)
+                dst.write(chunk, offset)
+                gap = offset + n
+                tracker.update(n)
+            offset += n
+        if digest is not None and digest.hexdigest() != checksums[index]:
+            raise ChecksumMismatch(
+                'Range {0}-{1} does not match its checksum'.format(start, end))
+        position = offset
+    dst.zero(gap, tracker.total - gap)
+    if position < tracker.total:
+        tracker.update(tracker.total - position, written=False)
+
+
+def copy_image(source, target, block_size=DEFAULT_BLOCK_SIZE, direct=True,
+               progress=None, sparse=False, create=False):
+    """Copy source onto the start of target.
+
+    Parameters
+    ----------
+    source : str
+        Path to the image (or partition) to read.
+
+    target : str
+        Path to the device (or partition, or file) to write.
+
+    block_size : int
+        Bytes per read/write. Multiple of ALIGNMENT. 4-64 MiB is the
+        sweet spot for USB sticks and SD cards.
+
+    direct : bool
+        Write with O_DIRECT where supported, so we don't fill the page
+        cache with a few GB of image we'll never read again.
+
+    progress : callable
+        Called as progress(bytes_done, bytes_total, bytes_per_sec) after
+        every chunk.
+
+    sparse : bool
+        Only write chunks that have something other than zeros in them,
+        and zero the rest (see Target.zero).
+
+    create : bool
+        Create target if it isn't there, see open_target.
+
+    Returns
+    -------
+    dict : bytes (covered), written, seconds and bytes_per_sec, zeroed
+        and zero_offload (see Target.stats), plus ranges: [start, end,
+        sha256] for everything on the target.
+    """
+    with pooled_buffer(block_size) as view:
+        zeros = bytes(block_size) if sparse else None
+        recorder = RangeRecorder()
+
+        src = open_source(source)
+        try:
+            dst = Target(target, direct=direct, create=create)
+            try:
+                total = fd_size(src)
+                tracker = Progress(total, progress)
+
+                if sparse:
+                    extents = data_extents(src, total)
+                else:
+                    extents = [(0, total)]
+
+                _copy_extents(
+                    src, dst, extents, view, tracker, zeros=zeros,
+                    recorder=recorder)
+            finally:
+                dst.close()
+        finally:
+            os.close(src)
+
+    stats = tracker.stats()
+    stats.update(dst.stats())
+    stats['ranges'] = recorder.finish()
+    return stats
+
+
+def copy_ranges(source, target, ranges, block_size=DEFAULT_BLOCK_SIZE,
+                direct=True, progress=None, create=False):
+    """Copy only the given ranges of source onto target, checking each.
+
+    Everything between the ranges gets zeroed on the target (see
+    Target.zero), so the result reads back exactly like the image.
+
+    Parameters
+    ----------
+    source : str
+        Path to the image.
+
+    target : str
+        Path to the device (or file) to write.
+
+    ranges : list
+        (start, end, sha256 hexdigest) tuples, as in a block map. See
+        raspi_maker.bmap.
+
+    block_size, direct, progress, create :
+        Same as copy_image.
+
+    Returns
+    -------
+    dict : bytes (covered), written, seconds and bytes_per_sec, zeroed
+        and zero_offload (see Target.stats), plus ranges, which are
+        just the ranges we were given.
+
+    Raises
+    ------
+    raspi_maker.errors.ChecksumMismatch : if a range read out of the
+        image doesn't match its checksum.
+    """
+    with pooled_buffer(block_size) as view:
+        src = open_source(source)
+        try:
+            dst = Target(target, direct=direct, create=create)
+            try:
+                total = fd_size(src)
+                tracker = Progress(total, progress)
+
+                extents = [(start, end) for start, end, _ in ranges]
+                checksums = [checksum for _, _, checksum in ranges]
+                _copy_extents(
+                    src, dst, extents, view, tracker, checksums=checksums)
+            finally:
+                dst.close()
+        finally:
+            os.close(src)
+
+    stats = tracker.stats()
+    stats.update(dst.stats())
+    stats['ranges'] = [list(r) for r in ranges]
+    return stats
+
+
+# What copy_file_range and sendfile say when they can't do this pair of
+# files (block devices, different filesystems, old kernels).
+_UNSUPPORTED = (
+    errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _copy_file_range(src, dst, offset, length, dst_offset):
+    return os.copy_file_range(src, dst, length, offset, dst_offset)
+
+
+def _sendfile(src, dst, offset, length, dst_offset):
+    os.lseek(dst, dst_offset, os.SEEK_SET)
+    return os.sendfile(dst, src, offset, length)
+
+
+def _pread_pwrite(src, dst, offset, length, dst_offset, view):
+    n = read_chunk(src, view[:length], offset)
+    return write_chunk(dst, view[:n], dst_offset)
+
+
+def _copy_methods(view):
+    """Ways to copy between fds, fastest first. view is the buffer for
+    when we have to do it ourselves."""
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(('copy_file_range', _copy_file_range))
+    if hasattr(os, 'sendfile'):
+        methods.append(('sendfile', _sendfile))
+    methods.append(('pwrite', partial(_pread_pwrite, view=view)))
+    return methods
+
+
+def copy_range(source, target, start, end, block_size=DEFAULT_BLOCK_SIZE,
+               progress=None, checksum=None, create=False):
+    """Copy bytes start to end of source onto the start of target.
+
+    Parameters
+    ----------
+    source : str
+        Path to a raw image.
+
+    target : str
+        Path to the device, partition or file to write.
+
+    start, end : int
+        Byte range of source. end is exclusive.
+
+    block_size : int
+        Most bytes per syscall. Multiple of ALIGNMENT.
+
+    progress : callable
+        Same as copy_image.
+
+    checksum : str
+        sha256 of the range, if known (see raspi_maker.manifest). Only
+        passed back in the stats' ranges, so the copy can be verified.
+
+    create : bool
+        Same as copy_image.
+
+    Returns
+    -------
+    dict : bytes, written, seconds and bytes_per_sec, plus 'method',
+        which of copy_file_range, sendfile or pwrite did the work.
+    """
+    length = end - start
+    tracker = Progress(length, progress)
+    with pooled_buffer(block_size) as view:
+        methods = _copy_methods(view)
+        src = open_source(source)
+        try:
+            dst = Target(target, direct=False, create=create)
+            try:
+                done = 0
+                while done < length:
+                    name, method = methods[0]
+                    try:
+                        n = method(
+                            src, dst.fd, start + done,
+                            min(block_size, length - done), done)
+                    except OSError as e:
+                        if e.errno not in _UNSUPPORTED or len(methods) == 1:
+                            raise
+                        methods.pop(0)
+                        continue
+                    if n == 0:
+                        raise EOFError('{0} ends before byte {1}'.format(
+                            source, end))
+                    done += n
+                    tracker.update(n)
+            finally:
+                dst.close()
+        finally:
+            os.close(src)
+
+    stats = tracker.stats()
+    stats['method'] = methods[0][0]
+    stats['ranges'] = [[0, length, checksum]] if checksum else []
+    return stats
+
+
+def copy_stream(chunks, target, total=None, direct=True, progress=None,
+                sparse=False, block_size=DEFAULT_BLOCK_SIZE, create=False):
+    """Write a stream of chunks onto the start of target, in order.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Bytes-likes to write back to back. Every chunk but the last should
+        be a multiple of ALIGNMENT for O_DIRECT to stay on, which is the
+        case for raspi_maker.decompress.DecompressingReader.
+
+    target : str
+        Path to the device (or file) to write.
+
+    total : int
+        Expected length of the stream, if known. Only used for progress.
+
+    direct, progress :
+        Same as copy_image.
+
+    sparse : bool
+        Don't write chunks that are all zeros, zero that bit of the
+        target instead (see Target.zero).
+
+    block_size : int
+        Largest chunk we expect. Only used to size the zero comparison
+        buffer in sparse mode.
+
+    create : bool
+        Same as copy_image.
+
+    Returns
+    -------
+    dict : bytes (covered), written, seconds and bytes_per_sec, plus
+        ranges: [start, end, sha256] for every run of chunks written.
+    """
+    zeros = bytes(block_size) if sparse else None
+    recorder = RangeRecorder()
+    dst = Target(target, direct=direct, create=create)
+    try:
+        tracker = Progress(total, progress)
+        offset = 0
+        # Runs of zero chunks get zeroed in one go, when the run ends.
+        zero_start = None
+        for chunk in chunks:
+            n = len(chunk)
+            if zeros is not None and n <= len(zeros) and is_zero(chunk, zeros):
+                if zero_start is None:
+                    zero_start = offset
+                recorder.gap()
+                tracker.update(n, written=False)
+            else:
+                if zero_start is not None:
+                    dst.zero(zero_start, offset - zero_start)
+                    zero_start = None
+                dst.write(chunk, offset)
+                recorder.add(chunk, offset)
+                tracker.update(n)
+            offset += n
+        if zero_start is not None:
+            dst.zero(zero_start, offset - zero_start)
+        tracker.finish()
+    finally:
+        dst.close()
+
+    stats = tracker.stats()
+    stats.update(dst.stats())
+    stats['ranges'] = recorder.finish()
+    return stats
@@ -0,0 +1,362 @@
+"""Stay up, take provisioning jobs, keep everything warm between them.
+
+run.py pays for finding the image, building its block map, starting the
+privileged helper and looking at every device, every time. The daemon
+pays once, then sits on a Unix socket taking jobs (an SD card and thumb
+drive pair, plus who the Pi should be) and running them on a bounded
+pool of workers:
+
+    ./run.py --daemon
+    ./run.py --submit --config batch.ini
+
+The protocol is one JSON object per line each way, same as the
+privileged helper:
+
+    {"op": "submit", "job": {"sd_card": "sdc", "thumb_drive": "sdd",
+                             "user": "bob", "hostname": "node-01"}}
+    {"op": "status", "id": 3}
+    {"op": "list"}
+    {"op": "shutdown"}
+
+USB buses are where the bandwidth actually runs out, so on top of the
+pool there's a limit on how many jobs can be using each bus at once.
+"""
+import json
+import os
+import re
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .bmap import get_bmap
+from .configuration import DEFAULT_WORKERS
+from .debugging import no_prompts
+from .decompress import is_compressed
+from .device import get_inventory
+from .errors import check_for_root_device
+from .hotplug import Watcher
+from .manifest import get_manifest
+from .privileged import get_helper
+
+
+SOCKET_PATH = '~/.cache/raspi-maker/daemon.sock'
+
+SYS_BLOCK = '/sys/class/block'
+
+# Jobs that can be using any one USB bus at a time.
+DEFAULT_PER_BUS = 2
+
+JOB_FIELDS = ('sd_card', 'thumb_drive', 'user', 'hostname')
+
+# Finished jobs kept around for status and list. Older ones get
+# forgotten, or a daemon that's been up for months would remember
+# every job it ever ran.
+DEFAULT_KEEP_FINISHED = 100
+
+FINISHED = ('done', 'failed')
+
+
+def usb_bus(blk_id, sys_block=SYS_BLOCK):
+    """Which USB bus a block device hangs off, like 'usb2'.
+
+    Anything that isn't on USB (the built in SD slot, say) is its own
+    bus, named after the device.
+    """
+    real = os.path.realpath(os.path.join(sys_block, blk_id))
+    buses = re.findall(r'/(usb\d+)/', real)
+    return buses[0] if buses else blk_id
+
+
+class BusLimits(object):
+    """A semaphore per bus, made as buses show up."""
+    def __init__(self, per_bus=DEFAULT_PER_BUS):
+        self.per_bus = per_bus
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, bus):
+        with self._lock:
+            if bus not in self._semaphores:
+                self._semaphores[bus] = threading.Semaphore(self.per_bus)
+            return self._semaphores[bus]
+
+    @contextmanager
+    def hold(self, buses):
+        """Hold a slot on every bus in buses. Always taken in the same
+        order, so two jobs can't deadlock each other."""
+        held = []
+        try:
+            for bus in sorted(set(buses)):
+                semaphore = self._semaphore(bus)
+                semaphore.acquire()
+                held.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(held):
+                semaphore.release()
+
+
+class Job(object):
+    """One pair to provision, and how it's going."""
+    def __init__(self, id, params):
+        self.id = id
+        self.params = params
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.seconds = None
+
+    @property
+    def devices(self):
+        return (self.params['sd_card'], self.params['thumb_drive'])
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'params': dict(
+                (k, v) for k, v in self.params.items() if k != 'psk'),
+            'state': self.state,
+            'error': self.error,
+            'submitted': self.submitted,
+            'seconds': self.seconds,
+        }
+
+
+def provision(disk_image, params):
+    """Run one job's pipeline. What the daemon does by default."""
+    # Imported here, raspi_maker imports us for --daemon.
+    from . import build_pipeline
+    from .device import Device
+
+    build_pipeline(
+        disk_image,
+        Device(params['sd_card']),
+        Device(params['thumb_drive']),
+        params.get('ssid'),
+        params.get('psk'),
+        params['user'],
+        params['hostname'],
+        full=params.get('full', False),
+        name=params['hostname'],
+        offline_polish=params.get('offline_polish', False),
+        polish_cache=params.get('polish_cache', True),
+        verify=params.get('verify', False),
+        wipe=params.get('wipe', 'signatures'),
+        grow_on_boot=params.get('grow_on_boot', False),
+        block_size=params.get('block_size')).run()
+
+
+class ProvisioningDaemon(object):
+    """The job queue, workers and bus limits.
+
+    Parameters
+    ----------
+    disk_image : str
+        Image every job flashes.
+
+    workers : int
+        Jobs running at once, at most.
+
+    per_bus : int
+        Jobs using any one USB bus at once, at most.
+
+    defaults : dict
+        Job parameters to fill in when a job doesn't say (ssid, psk,
+        full, offline_polish, polish_cache, verify, wipe, grow_on_boot,
+        block_size).
+
+    runner : callable
+        runner(disk_image, params) does the work. Defaults to provision.
+
+    keep_finished : int
+        Finished jobs to remember, most recent first.
+    """
+    def __init__(self, disk_image, workers=DEFAULT_WORKERS,
+                 per_bus=DEFAULT_PER_BUS, defaults=None, runner=provision,
+                 sys_block=SYS_BLOCK, keep_finished=DEFAULT_KEEP_FINISHED):
+        self.disk_image = disk_image
+        self.defaults = defaults or {}
+        self.runner = runner
+        self.keep_finished = keep_finished
+        self.sys_block = sys_block
+        self.jobs = {}
+        self.limits = BusLimits(per_bus)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def warm_up(self):
+        """Everything we'd otherwise pay for on the first job."""
+        get_helper()
+        get_inventory().disks()
+        get_manifest(self.disk_image)
+        if not is_compressed(self.disk_image):
+            get_bmap(self.disk_image)
+
+    def submit(self, params):
+        """Queue a job.
+
+        Returns
+        -------
+        Job
+
+        Raises
+        ------
+        ValueError : if the job is missing something, or wants a device
+            another job is already using.
+        raspi_maker.errors.NotGunnaDoItException : if it wants sda.
+        """
+        missing = [field for field in JOB_FIELDS if not params.get(field)]
+        if missing:
+            raise ValueError('Job needs {0}'.format(', '.join(missing)))
+        check_for_root_device(params['sd_card'], params['thumb_drive'])
+
+        merged = dict(self.defaults)
+        merged.update(params)
+        with self._lock:
+            busy = self._busy.intersection(
+                (merged['sd_card'], merged['thumb_drive']))
+            if busy:
+                raise ValueError('Already working on {0}'.format(
+                    ', '.join(sorted(busy))))
+            self._next_id += 1
+            job = Job(self._next_id, merged)
+            self.jobs[job.id] = job
+            self._busy.update(job.devices)
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        buses = [usb_bus(device, self.sys_block) for device in job.devices]
+        try:
+            with self.limits.hold(buses):
+                job.state = 'running'
+                start = time.monotonic()
+                try:
+                    self.runner(self.disk_image, job.params)
+                    job.state = 'done'
+                except Exception as e:
+                    traceback.print_exc()
+                    job.state = 'failed'
+                    job.error = str(e)
+                job.seconds = time.monotonic() - start
+        finally:
+            with self._lock:
+                self._busy.difference_update(job.devices)
+                self._forget_old_jobs()
+        print('Job {0} ({1}): {2}'.format(
+            job.id, job.params['hostname'], job.state))
+
+    def _forget_old_jobs(self):
+        """Drop all but the last keep_finished finished jobs. Call with
+        the lock held."""
+        finished = sorted(
+            id for id, job in self.jobs.items() if job.state in FINISHED)
+        for id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[id]
+
+    def handle(self, request):
+        """Answer one request off the socket."""
+        op = request.get('op')
+        try:
+            if op == 'submit':
+                return {'job': self.submit(request['job']).to_dict()}
+            # Jobs get forgotten from worker threads (see _run), so look
+            # them up under the lock.
+            if op == 'status':
+                with self._lock:
+                    job = self.jobs.get(request['id'])
+                if job is None:
+                    return {'error': 'No job {0}'.format(request['id'])}
+                return {'job': job.to_dict()}
+            if op == 'list':
+                with self._lock:
+                    jobs = [self.jobs[id] for id in sorted(self.jobs)]
+                return {'jobs': [job.to_dict() for job in jobs]}
+            return {'error': 'Unknown op {0}'.format(op)}
+        except Exception as e:
+            return {'error': '{0}: {1}'.format(type(e).__name__, e)}
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request = json.loads(line.decode('utf8'))
+            if request.get('op') == 'shutdown':
+                response = {'ok': True}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = self.server.provisioning.handle(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(daemon, socket_path=SOCKET_PATH, watch=True):
+    """Take requests on a Unix socket until someone sends shutdown.
+
+    Nobody's at a terminal for the workers, so actions that would drop
+    into pdb (debugging.PromptOnError) raise instead, for as long as
+    this runs, and the job fails.
+
+    Parameters
+    ----------
+    daemon : ProvisioningDaemon
+
+    socket_path : str
+
+    watch : bool
+        Keep an eye out for cards being plugged in (see
+        raspi_maker.hotplug), and say so.
+    """
+    socket_path = os.path.expanduser(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    watcher = None
+    if watch:
+        try:
+            watcher = Watcher(lambda event: print('{0}: {1}'.format(
+                'Plugged in' if event.action == 'add' else 'Pulled out',
+                event.path))).start()
+        except OSError as e:
+            print('Not watching for devices: {0}'.format(e))
+
+    server = _Server(socket_path, _Handler)
+    server.provisioning = daemon
+    print('Taking jobs on {0}'.format(socket_path))
+    try:
+        with no_prompts():
+            server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        if watcher is not None:
+            watcher.stop()
+        daemon.close()
+
+
+def request(message, socket_path=SOCKET_PATH):
+    """Send the daemon one request, get its response."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.expanduser(socket_path))
+        client.sendall((json.dumps(message) + '\n').encode('utf8'))
+        response = client.makefile('rb').readline()
+    finally:
+        client.close()
+    return json.loads(response.decode('utf8'))
@@ -1,8 +1,17 @@
 import pdb
 import traceback
+from contextlib import contextmanager
 
 
 class PromptOnError(object):
+    """Drop into pdb when func fails, so it can be fixed live.
+
+    Set PromptOnError.interactive to False when nobody's there to type
+    into the prompt (benchmarks, headless runs), and failures are just
+    raised like normal.
+    """
+    interactive = True
+
     def __init__(self, func):
         self.func = func
 
@@ -10,6 +19,9 @@ class PromptOnError(object):
         try:
             return self.func(*args, **kwargs)
         except Exception as e:
+            if not PromptOnError.interactive:
+                raise
+
             traceback.print_exc()
 
             print('Falling back to prompt to try live fix.')
@@ -17,3 +29,16 @@ class PromptOnError(object):
             print('exit() to gtfo and cancel.')
 
             pdb.set_trace()
+
+
+@contextmanager
+def no_prompts():
+    """PromptOnError just raises, inside this. For runs with more than
+    one thing going on (batches), where a prompt on one worker thread
+    would hand back None and have the rest carry on as if it worked."""
+    interactive = PromptOnError.interactive
+    PromptOnError.interactive = False
+    try:
+        yield
+    finally:
+        PromptOnError.interactive = interactive
@@ -0,0 +1,211 @@
+"""Stream compressed images straight onto a device.
+
+Releases come as .img.xz (or .zip, .gz, .zst), and decompressing to disk
+first means writing the whole image twice and needing a few GB free. So
+don't: decompress in a background thread into a small ring of reusable
+buffers, and let the copy engine write them out as they fill up.
+
+A thread is enough here. lzma, zlib and zstandard all drop the GIL
+while they crunch, so decompression and device writes really do overlap.
+
+.zst needs the `zstandard` package. Everything else is stdlib.
+"""
+import gzip
+import lzma
+import threading
+import zipfile
+from queue import Queue
+
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import allocate_buffer
+from .copy_engine import copy_stream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSED_SUFFIXES = ('.xz', '.zst', '.gz', '.zip')
+
+# How many buffers the decompressor can get ahead of the writer by.
+DEFAULT_DEPTH = 4
+
+
+def is_compressed(path):
+    """True if path looks like a compressed image we know how to read."""
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def _zip_member(archive):
+    """The image inside a zip. The first .img, or the only file."""
+    names = [info for info in archive.infolist() if not info.is_dir()]
+    for info in names:
+        if info.filename.endswith('.img'):
+            return info
+    if len(names) == 1:
+        return names[0]
+    raise ValueError('Cannot tell which file in {0} is the image'.format(
+        archive.filename))
+
+
+def open_decompressed(path):
+    """Open a compressed image, returning a file-like of the raw bytes."""
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return archive.open(_zip_member(archive))
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError(
+                'Reading .zst images needs the zstandard package: '
+                'pip install zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), closefd=True)
+    raise ValueError('Not a compressed image: {0}'.format(path))
+
+
+def uncompressed_size(path):
+    """Size of the image once decompressed, if it's cheap to find out.
+
+    Only zips tell us up front. Returns None otherwise.
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return _zip_member(archive).file_size
+    return None
+
+
+def _fill(f, view):
+    """readinto until view is full or the stream ends."""
+    done = 0
+    while done < len(view):
+        n = f.readinto(view[done:])
+        if not n:
+            break
+        done += n
+    return done
+
+
+class DecompressingReader(object):
+    """Iterate over the decompressed image, one full buffer at a time.
+
+    A background thread decompresses into a ring of `depth` buffers. Each
+    buffer yielded goes back in the ring when you ask for the next one,
+    so use it (write it out) before moving on, and don't hang on to it.
+
+    Example:
+
+        with DecompressingReader('raspios.img.xz') as reader:
+            for chunk in reader:
+                device.write(chunk)
+    """
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE,
+                 depth=DEFAULT_DEPTH):
+        self.path = path
+        self.size = uncompressed_size(path)
+        self._free = Queue()
+        self._filled = Queue()
+        for _ in range(depth):
+            self._free.put(allocate_buffer(block_size))
+        self._stop = False
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _decompress(self):
+        try:
+            with open_decompressed(self.path) as f:
+                while True:
+                    view = self._free.get()
+                    if self._stop:
+                        break
+                    n = _fill(f, view)
+                    if n:
+                        self._filled.put((view, n))
+                    if n < len(view):
+                        break
+        except Exception as e:
+            self._filled.put(e)
+            return
+        self._filled.put(None)
+
+    def __iter__(self):
+        previous = None
+        while True:
+            if previous is not None:
+                self._free.put(previous)
+                previous = None
+            item = self._filled.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            view, n = item
+            previous = view
+            yield view[:n]
+
+    def close(self):
+        """Stop the decompressor thread early."""
+        self._stop = True
+        # Wake the thread up if it's waiting on a free buffer.
+        self._free.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+def decompress_to(path, target, block_size=DEFAULT_BLOCK_SIZE):
+    """Decompress a whole image into a plain file, for when we need it raw.
+
+    Zero chunks are skipped, so the result is sparse.
+    """
+    zeros = bytes(block_size)
+    with DecompressingReader(path, block_size=block_size) as reader:
+        with open(target, 'wb') as f:
+            for chunk in reader:
+                if len(chunk) == block_size and zeros.startswith(chunk):
+                    f.seek(len(chunk), 1)
+                else:
+                    f.write(chunk)
+            f.truncate()
+    return target
+
+
+def _slice_chunks(chunks, start, end):
+    """Just the bits of a chunk stream between start and end."""
+    offset = 0
+    for chunk in chunks:
+        chunk_end = offset + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(start - offset, 0):min(end, chunk_end) - offset]
+        if chunk_end >= end:
+            break
+        offset = chunk_end
+
+
+def decompress_range(path, target, start, end, block_size=DEFAULT_BLOCK_SIZE,
+                     progress=None, checksum=None, create=False):
+    """copy_engine.copy_range, for a compressed image.
+
+    Everything up to end gets decompressed (there's no seeking in a
+    compressed stream), but only start to end is written.
+    """
+    with DecompressingReader(path, block_size=block_size) as reader:
+        stats = copy_stream(
+            _slice_chunks(reader, start, end), target, total=end - start,
+            direct=False, progress=progress, create=create)
+    if stats['bytes'] < end - start:
+        raise EOFError('{0} ends before byte {1}'.format(path, end))
+    stats['method'] = 'decompress'
+    if checksum:
+        stats['ranges'] = [[0, end - start, checksum]]
+    return stats
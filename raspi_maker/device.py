@@ -1,28 +1,51 @@
 # -*- coding: utf-8 -*-
 """Helper Functions for the file system."""
+import json
 import os
-from subprocess import Popen, PIPE, STDOUT
-from .console import console
+import re
+import threading
+from subprocess import Popen, PIPE
+from .privileged import get_helper
+from .privileged import run_privileged
+
+
+LSBLK_COLUMNS = 'NAME,PATH,SIZE,TYPE,MOUNTPOINT,PARTUUID,VENDOR,MODEL'
+
+MOUNTINFO = '/proc/self/mountinfo'
 
 
 class Device(object):
-    """Abstraction around a given block device."""
-    def __init__(self, blk_id):
+    """Abstraction around a given block device.
+
+    Everything about it comes from a DeviceInventory snapshot, shared by
+    default. Call invalidate() after changing the device (partitions,
+    mounts, a fresh image) so the next question gets a fresh answer.
+    """
+    def __init__(self, blk_id, inventory=None):
         assert os.path.exists('/dev/')
         self.blk_id = blk_id
-        
-        size = _get_blk_size_bytes(blk_id)
+        self.inventory = inventory if inventory is not None else get_inventory()
+
+        entry = self.inventory.lookup(blk_id)
+        if entry is None:
+            # Not something lsblk knows about. Ask sysfs, like we used to.
+            size = _get_blk_size_bytes(blk_id)
+            self.vendor = _get_vendor(blk_id)
+            self.model = _get_model(blk_id)
+        else:
+            size = entry['size']
+            self.vendor = (entry.get('vendor') or '').strip() or blk_id
+            self.model = (entry.get('model') or '').strip() or blk_id
         self.hr_size = _get_hr_size(size)
 
-        self.vendor = _get_vendor(blk_id)
-        self.model = _get_model(blk_id)
-
         self.path = '/dev/{0}'.format(blk_id)
 
     def partitions(self, full_paths=False):
-        lsblk_output = _get_lsblk_output()
-        return _get_partitions(
-            lsblk_output, self.blk_id, full_paths=full_paths)
+        return self.inventory.partitions(self.blk_id, full_paths=full_paths)
+
+    def invalidate(self):
+        """Forget what we know, the device changed."""
+        self.inventory.invalidate()
 
     def unmount_all(self):
         """Runs umount on all partitions. Regardless.
@@ -31,23 +54,20 @@ class Device(object):
         -------
         bool : True if successful.
         `"""
-        for mount in self.mount_points:
+        mounts = self.mount_points
+        for mount in mounts:
             print('Unmounting {0}'.format(mount))
-            p = Popen(
-                ['sudo', 'umount', mount],
-                stdout=PIPE,
-                stderr=STDOUT)  # stdout=PIPE makes this line blocking.
-            p.communicate()
+        get_helper().call('run_many', argvs=[['umount', mount] for mount in mounts])
+        self.invalidate()
         print(True)
 
     @property
     def mount_points(self):
         mounts = []
         for partition in self.partitions():
-            mounts += _get_partition_mounts(partition)
+            mounts += self.inventory.mounts(partition)
         return mounts
 
-
     def __str__(self):
         return '{vendor} {model} {hr_size}'.format(
             vendor=self.vendor,
@@ -84,16 +104,7 @@ def get_devices():
     -------
     list : list of strings related to each device.
     """
-
-    devices = []
-
-    cmd = ['lsblk']
-    for line in console(cmd).split('\n'):
-        if 'disk' in line:
-            devices.append(line.split()[0])
-    devices.sort()
-
-    return devices
+    return get_inventory().disks()
 
 
 def _get_blk_size_bytes(blk_id, test=None):
@@ -180,33 +191,195 @@ def _get_model(blk_id):
 
 def _get_lsblk_output():
     """This is what we use to get our partitions."""
-    p = Popen(['lsblk'], stdout=PIPE)
+    p = Popen(
+        ['lsblk', '--json', '--bytes', '--output', LSBLK_COLUMNS], stdout=PIPE)
     return p.stdout.read().decode('utf8')
 
-    
+
+def _get_mountinfo():
+    with open(MOUNTINFO) as f:
+        return f.read()
+
+
+def _flatten(blockdevices, parent=None):
+    """Walk lsblk's tree, yielding (entry, parent name) for everything."""
+    for entry in blockdevices:
+        yield entry, parent
+        for child in _flatten(entry.get('children', []), entry['name']):
+            yield child
+
+
+def _unescape_mount(path):
+    """mountinfo writes spaces and friends as octal, like \\040."""
+    return re.sub(
+        r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+
+def _parse_mountinfo(mountinfo):
+    """Source device to the list of places it's mounted.
+
+    Parameters
+    ----------
+    mountinfo : str
+        Contents of /proc/self/mountinfo. Example line:
+
+            '28 1 254:0 / / rw,relatime - ext4 /dev/vda rw,discard'
+
+        Field 5 is where it's mounted, and the source is the second
+        field after the lone '-'.
+
+    Returns
+    -------
+    dict : str to list of str.
+    """
+    mounts = {}
+    for line in mountinfo.splitlines():
+        fields = line.split()
+        if '-' not in fields:
+            continue
+        after = fields[fields.index('-') + 1:]
+        if len(after) < 2:
+            continue
+        mounts.setdefault(after[1], []).append(_unescape_mount(fields[4]))
+    return mounts
+
+
+class _Snapshot(object):
+    """One look around, indexed. Never changes once built, so a reader
+    holding one sees all of it from the same moment."""
+    def __init__(self, lsblk_output, mountinfo):
+        self.by_name = {}
+        self.by_path = {}
+        self.by_partuuid = {}
+        self.children = {}
+        for entry, parent in _flatten(json.loads(lsblk_output)['blockdevices']):
+            entry = dict(entry)
+            entry.pop('children', None)
+            entry['parent'] = parent
+            entry.setdefault('path', '/dev/{0}'.format(entry['name']))
+            self.by_name[entry['name']] = entry
+            self.by_path[entry['path']] = entry
+            if entry.get('partuuid'):
+                self.by_partuuid[entry['partuuid']] = entry
+            if parent is not None:
+                self.children.setdefault(parent, []).append(entry['name'])
+        self.mounts = _parse_mountinfo(mountinfo)
+
+    def lookup(self, key):
+        for index in (self.by_name, self.by_path, self.by_partuuid):
+            if key in index:
+                return index[key]
+        return None
+
+
+class DeviceInventory(object):
+    """Everything we know about block devices, from one look around.
+
+    One `lsblk --json` and one read of /proc/self/mountinfo, indexed by
+    name, path and PARTUUID. It stays put until invalidate() is called,
+    then the next lookup takes a fresh snapshot.
+
+    A new snapshot replaces the old one in a single assignment, and
+    every lookup works off one snapshot from start to finish. So a
+    refresh on another thread (hotplug, the daemon) can't hand a lookup
+    half of each.
+
+    Parameters
+    ----------
+    lsblk_output : str
+        lsblk --json output to use, instead of running it. Tests.
+
+    mountinfo : str
+        /proc/self/mountinfo contents to use, instead of reading it.
+    """
+    def __init__(self, lsblk_output=None, mountinfo=None):
+        self._lsblk_output = lsblk_output
+        self._mountinfo = mountinfo
+        self._lock = threading.Lock()
+        self._stale = True
+        self._snapshot = None
+        self.snapshots = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+
+    def refresh(self):
+        """Take the snapshot now."""
+        lsblk_output = self._lsblk_output
+        if lsblk_output is None:
+            lsblk_output = _get_lsblk_output()
+        mountinfo = self._mountinfo
+        if mountinfo is None:
+            mountinfo = _get_mountinfo()
+
+        self._snapshot = _Snapshot(lsblk_output, mountinfo)
+        self._stale = False
+        self.snapshots += 1
+
+    def _fresh(self):
+        """The current snapshot, taking a new one first if it's stale."""
+        with self._lock:
+            if self._stale or self._snapshot is None:
+                self.refresh()
+            return self._snapshot
+
+    def lookup(self, key):
+        """Entry for a name (sdc1), path (/dev/sdc1) or PARTUUID. None if
+        there's no such thing.
+
+        Returns
+        -------
+        dict : lsblk's columns (lower case), plus 'parent'.
+        """
+        return self._fresh().lookup(key)
+
+    def disks(self):
+        """Names of every disk, sorted."""
+        snapshot = self._fresh()
+        return sorted(
+            name for name, entry in snapshot.by_name.items()
+            if entry['type'] == 'disk')
+
+    def partitions(self, blk_id, full_paths=False):
+        """Partitions on a disk, in order. Can be empty."""
+        snapshot = self._fresh()
+        names = [
+            name for name in snapshot.children.get(blk_id, [])
+            if snapshot.by_name[name]['type'] == 'part']
+        if full_paths:
+            return [snapshot.by_name[name]['path'] for name in names]
+        return names
+
+    def mounts(self, key):
+        """Everywhere a device or partition is mounted."""
+        snapshot = self._fresh()
+        entry = snapshot.lookup(key)
+        if entry is None:
+            return []
+        return list(snapshot.mounts.get(entry['path'], []))
+
+
+_inventory = None
+_inventory_lock = threading.Lock()
+
+
+def get_inventory():
+    """The shared DeviceInventory."""
+    global _inventory
+    with _inventory_lock:
+        if _inventory is None:
+            _inventory = DeviceInventory()
+        return _inventory
+
+
 def _get_partitions(lsblk_output, blk_id, full_paths=False):
     """Get partitions for a given block id.
 
     Parameters
     ----------
     lsblk_output : str
-        Output of lsblk. This gives us all the info we need,
-        so we just need to pull it apart. Example:
-            '''NAME                    MAJ:MIN RM   SIZE RO TYPE  MOUNTPOINT
-            sda                       8:0    0 931.5G  0 disk  
-            ├─sda1                    8:1    0   512M  0 part  /boot/efi
-            ├─sda2                    8:2    0   488M  0 part  /boot
-            └─sda3                    8:3    0 930.5G  0 part  
-              └─sda3_crypt          252:0    0 930.5G  0 crypt 
-                ├─ubuntu--vg-root   252:1    0 898.7G  0 lvm   /
-                └─ubuntu--vg-swap_1 252:2    0  31.9G  0 lvm   [SWAP]
-            sdc                       8:32   1  14.9G  0 disk  
-            ├─sdc1                    8:33   1    63M  0 part  
-            └─sdc2                    8:34   1     4G  0 part  
-            sr0                      11:0    1  1024M  0 rom   
-            mmcblk0                 179:0    0    29G  0 disk  
-            └─mmcblk0p1             179:1    0    63M  0 part  
-            '''
+        Output of `lsblk --json`. See _get_lsblk_output.
 
     blk_id : str
         root block id that we're getting partitions for
@@ -219,42 +392,8 @@ def _get_partitions(lsblk_output, blk_id, full_paths=False):
     -------
     list : list of strings of partitions. Can be empty.
     """
-
-    partitions = []
-
-
-    flagged = False
-    for line in lsblk_output.splitlines():
-
-        # exhaust lines we don't care about
-        if blk_id in line and not flagged:
-            flagged = True
-            continue
-
-        # Only start caring once the flag is set
-        if '─' in line and flagged:
-            stripped_line = line.lstrip('─└├ ')
-            components = stripped_line.split()
-            partitions.append(components[0])
-
-        # if the flag is set and we're out of subdivisions
-        # break out of the generator
-        elif flagged:
-            break
-
-    if full_paths:
-        partitions = ['/dev/{0}'.format(partition) for partition in partitions]
-
-    return partitions
-
-def _get_partition_mounts(partition_name):
-    """Return all mounts for this partition."""
-    mounts = []
-    with open('/etc/mtab') as f:
-        for line in f:
-            if partition_name in line:
-                mounts.append(line.split()[1])
-    return mounts
+    inventory = DeviceInventory(lsblk_output=lsblk_output, mountinfo='')
+    return inventory.partitions(blk_id, full_paths=full_paths)
 
 
 def _device_partitions(device_path):
@@ -262,13 +401,9 @@ def _device_partitions(device_path):
 
     Example:
     """
-    cmd = ['sudo', 'parted', device_path, 'unit', 's', 'print']
+    cmd = ['parted', device_path, 'unit', 's', 'print']
 
-    p = Popen(
-        cmd,
-        stdout=PIPE)
-
-    return p.stdout.read().decode('utf8')
+    return run_privileged(cmd, check=False, echo=False)['output']
 
 
 def _partition_details(device_unit_info, number):
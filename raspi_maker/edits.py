@@ -0,0 +1,207 @@
+"""Declarative file edits, applied in one go.
+
+polish_drive used to be thirty-odd `sudo sed -i` processes, a few of
+them doing the exact same thing to the same file. Instead, build an
+EditPlan saying what should happen to which file, and hand the whole
+thing to run_plan. Every file gets opened once, has all its edits
+applied in memory, and gets written back atomically (temp file and
+rename, owner and mode kept).
+
+Plans are plain JSON, so they can be shipped to a process with more
+privileges than us: run_plan hands them to the privileged helper (see
+raspi_maker.privileged), which is just this process if we're root.
+
+Paths in a plan are relative to its root (the mount point), and can't
+escape it.
+"""
+import os
+import re
+
+
+class EditPlan(object):
+    """A list of operations against files under root.
+
+    Substitutions and appends to the same file are collected together, at
+    the spot in the plan where that file was first mentioned, so each
+    file is only read and written once. Everything else (mkdir, move,
+    symlink, ...) runs in the order it was added.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.ops = []
+        self._edits = {}
+
+    def _file_edits(self, path):
+        if path not in self._edits:
+            op = {'op': 'edit', 'path': path, 'edits': []}
+            self.ops.append(op)
+            self._edits[path] = op['edits']
+        return self._edits[path]
+
+    def substitute(self, path, pattern, replacement, count=1):
+        """Like `sed -i -E s/pattern/replacement/`, line by line.
+
+        count is how many matches to replace per line, sed style. 0 means
+        all of them. The replacement is literal, no backreferences, so
+        whatever a user typed in can go straight in.
+        """
+        self._file_edits(path).append({
+            'type': 'substitute',
+            'pattern': pattern,
+            'replacement': replacement,
+            'count': count,
+        })
+        return self
+
+    def append(self, path, text):
+        """Tack text onto the end of a file."""
+        self._file_edits(path).append({'type': 'append', 'text': text})
+        return self
+
+    def write(self, path, text, mode=None):
+        """Write a whole new file."""
+        self.ops.append(
+            {'op': 'write', 'path': path, 'text': text, 'mode': mode})
+        return self
+
+    def mkdir(self, path, mode=None):
+        self.ops.append({'op': 'mkdir', 'path': path, 'mode': mode})
+        return self
+
+    def chmod(self, path, mode):
+        self.ops.append({'op': 'chmod', 'path': path, 'mode': mode})
+        return self
+
+    def chown(self, path, uid, gid, recursive=False):
+        self.ops.append({
+            'op': 'chown',
+            'path': path,
+            'uid': uid,
+            'gid': gid,
+            'recursive': recursive,
+        })
+        return self
+
+    def move(self, path, destination):
+        self.ops.append(
+            {'op': 'move', 'path': path, 'destination': destination})
+        return self
+
+    def symlink(self, target, path):
+        """Make path a symlink to target. target is left as is, so use
+        the path it should have on the booted Pi."""
+        self.ops.append({'op': 'symlink', 'path': path, 'target': target})
+        return self
+
+    def to_dict(self):
+        return {'root': self.root, 'ops': self.ops}
+
+
+def _resolve(root, path):
+    """Join path onto root, refusing anything that climbs out of it."""
+    root = os.path.abspath(root)
+    full = os.path.abspath(os.path.join(root, path.lstrip('/')))
+    if full != root and not full.startswith(root + os.sep):
+        raise ValueError('{0} is outside of {1}'.format(path, root))
+    return full
+
+
+def _substitute(text, pattern, replacement, count):
+    regex = re.compile(pattern)
+    return ''.join(
+        regex.sub(lambda match: replacement, line, count=count)
+        for line in text.splitlines(True))
+
+
+def _atomic_write(path, text, like=None):
+    """Write text to path via a temp file and rename.
+
+    like is a stat result to copy owner and mode from.
+    """
+    temp_path = path + '.raspi-maker.tmp'
+    with open(temp_path, 'w', newline='') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    if like is not None:
+        os.chmod(temp_path, like.st_mode & 0o7777)
+        os.chown(temp_path, like.st_uid, like.st_gid)
+    os.replace(temp_path, path)
+
+
+def _apply_edit(full, op):
+    if not os.path.exists(full):
+        print('Skipping edits to missing file {0}'.format(op['path']))
+        return
+    stat = os.stat(full)
+    with open(full, newline='') as f:
+        text = f.read()
+    for edit in op['edits']:
+        if edit['type'] == 'substitute':
+            text = _substitute(
+                text, edit['pattern'], edit['replacement'], edit['count'])
+        elif edit['type'] == 'append':
+            text += edit['text']
+        else:
+            raise ValueError('Unknown edit type {0}'.format(edit['type']))
+    _atomic_write(full, text, like=stat)
+
+
+def _chown(full, uid, gid, recursive):
+    os.lchown(full, uid, gid)
+    if recursive and os.path.isdir(full):
+        for parent, dirs, files in os.walk(full):
+            for name in dirs + files:
+                os.lchown(os.path.join(parent, name), uid, gid)
+
+
+def apply_plan(plan):
+    """Carry out a plan, in this process. Needs whatever permissions the
+    files need, so usually root.
+
+    Parameters
+    ----------
+    plan : dict
+        EditPlan.to_dict()
+    """
+    root = plan['root']
+    for op in plan['ops']:
+        full = _resolve(root, op['path'])
+        kind = op['op']
+        if kind == 'edit':
+            _apply_edit(full, op)
+        elif kind == 'write':
+            _atomic_write(full, op['text'])
+            if op['mode'] is not None:
+                os.chmod(full, op['mode'])
+        elif kind == 'mkdir':
+            os.makedirs(full, exist_ok=True)
+            if op['mode'] is not None:
+                os.chmod(full, op['mode'])
+        elif kind == 'chmod':
+            os.chmod(full, op['mode'])
+        elif kind == 'chown':
+            _chown(full, op['uid'], op['gid'], op['recursive'])
+        elif kind == 'move':
+            os.rename(full, _resolve(root, op['destination']))
+        elif kind == 'symlink':
+            if os.path.lexists(full):
+                os.remove(full)
+            os.symlink(op['target'], full)
+        else:
+            raise ValueError('Unknown op {0}'.format(kind))
+
+
+def run_plan(plan):
+    """Apply an EditPlan as root, via the privileged helper.
+
+    Parameters
+    ----------
+    plan : EditPlan
+
+    Raises
+    ------
+    raspi_maker.errors.PrivilegedError : if applying it fails.
+    """
+    from .privileged import get_helper
+    get_helper().call('apply_plan', plan=plan.to_dict())
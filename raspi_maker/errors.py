@@ -5,6 +5,17 @@ class NotGunnaDoItException(Exception):
     """Throw when you simply refuse to follow orders."""
     pass
 
+
+class ChecksumMismatch(Exception):
+    """Throw when the bytes aren't the bytes we were promised."""
+    pass
+
+
+class PrivilegedError(Exception):
+    """Throw when something we did as root didn't work out."""
+    pass
+
+
 def check_for_root_device(*args):
     """Throw exception if trying to write to sda.
 
@@ -0,0 +1,320 @@
+"""Read an image once, write it to a bunch of devices at the same time.
+
+One reader (the calling thread) fills a ring of shared buffers, and each
+target gets a writer thread that drains them. A buffer goes back in the
+ring once every writer is done with it, so the reader can never get
+more than `depth` buffers ahead of the slowest device, and memory stays
+at depth * block_size no matter how many targets there are.
+
+A target that fails (yanked stick, dead card) stops writing but keeps
+handing buffers back, so it doesn't hold everyone else up.
+"""
+import hashlib
+import os
+import sys
+import threading
+from functools import partial
+from queue import Queue
+
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import MiB
+from .copy_engine import Progress
+from .copy_engine import RangeRecorder
+from .copy_engine import Target
+from .copy_engine import allocate_buffer
+from .copy_engine import fd_size
+from .copy_engine import is_zero
+from .copy_engine import open_source
+from .copy_engine import read_chunk
+from .decompress import DecompressingReader
+from .decompress import is_compressed
+from .decompress import uncompressed_size
+from .errors import ChecksumMismatch
+
+
+DEFAULT_DEPTH = 4
+
+# A target going slower than this fraction of the fastest one gets
+# called out in the report.
+SLOW_FRACTION = 0.75
+
+
+class _Slot(object):
+    """One buffer in the ring, and how many writers still need it."""
+    def __init__(self, block_size, free):
+        self.view = allocate_buffer(block_size)
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._free = free
+
+    def hand_out(self, count):
+        self.pending = count
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self._free.put(self)
+
+
+class _Writer(threading.Thread):
+    """Drains chunks for one target."""
+    def __init__(self, path, total, direct=True, progress=None,
+                 create=False):
+        super(_Writer, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.total = total
+        self.direct = direct
+        self.create = create
+        self.queue = Queue()
+        self.error = None
+        self.target = None
+        # Where the last chunk ended. Gaps between block map ranges
+        # count as progress.
+        self.position = 0
+        # Start of the run of bytes not written yet, zeroed (see
+        # copy_engine.Target.zero) right before the next write.
+        self.gap = 0
+        callback = partial(progress, path) if progress is not None else None
+        self.tracker = Progress(total, callback)
+
+    def _handle(self, target, item):
+        slot, offset, n, zero = item
+        try:
+            if self.error is not None:
+                return
+            self.tracker.update(offset - self.position, written=False)
+            self.position = offset + n
+            if zero:
+                self.tracker.update(n, written=False)
+            else:
+                target.zero(self.gap, offset - self.gap)
+                target.write(slot.view[:n], offset)
+                self.gap = offset + n
+                self.tracker.update(n)
+        except Exception as e:
+            self.error = e
+        finally:
+            slot.release()
+
+    def run(self):
+        target = None
+        try:
+            target = self.target = Target(
+                self.path, direct=self.direct, create=self.create)
+        except Exception as e:
+            self.error = e
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._handle(target, item)
+
+        if target is not None:
+            try:
+                if self.error is None:
+                    # Streams don't know their total, they end where
+                    # the last chunk did.
+                    end = self.total if self.total is not None else (
+                        self.position)
+                    target.zero(self.gap, end - self.gap)
+                target.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+        if self.error is None and self.total is not None:
+            self.tracker.update(self.total - self.position, written=False)
+        self.tracker.finish()
+
+    def stats(self):
+        stats = self.tracker.stats()
+        if self.target is not None:
+            stats.update(self.target.stats())
+        stats['error'] = str(self.error) if self.error is not None else None
+        return stats
+
+
+def _raw_chunks(source, free, ranges, sparse, block_size, recorder):
+    """Yield (slot, offset, n, zero) for a raw image, checking ranges."""
+    zeros = bytes(block_size) if sparse else None
+    src = open_source(source)
+    try:
+        if ranges is None:
+            ranges = [(0, fd_size(src), None)]
+        for start, end, checksum in ranges:
+            recorder.gap()
+            digest = hashlib.sha256() if checksum is not None else None
+            offset = start
+            while offset < end:
+                slot = free.get()
+                n = read_chunk(
+                    src, slot.view[:min(block_size, end - offset)], offset)
+                if n == 0:
+                    free.put(slot)
+                    break
+                chunk = slot.view[:n]
+                if digest is not None:
+                    digest.update(chunk)
+                recorder.add(chunk, offset)
+                yield slot, offset, n, zeros is not None and is_zero(chunk, zeros)
+                offset += n
+            if digest is not None and digest.hexdigest() != checksum:
+                raise ChecksumMismatch(
+                    'Range {0}-{1} does not match its checksum'.format(
+                        start, end))
+    finally:
+        os.close(src)
+
+
+def _compressed_chunks(source, free, sparse, block_size, recorder):
+    """Yield (slot, offset, n, zero) for a compressed image."""
+    zeros = bytes(block_size) if sparse else None
+    offset = 0
+    with DecompressingReader(source, block_size=block_size) as reader:
+        for chunk in reader:
+            n = len(chunk)
+            slot = free.get()
+            slot.view[:n] = chunk
+            zero = zeros is not None and is_zero(chunk, zeros)
+            if zero:
+                recorder.gap()
+            else:
+                recorder.add(chunk, offset)
+            yield slot, offset, n, zero
+            offset += n
+
+
+def fan_out(source, targets, ranges=None, sparse=False,
+            block_size=DEFAULT_BLOCK_SIZE, depth=DEFAULT_DEPTH, direct=True,
+            progress=None, create=False):
+    """Write one image to many targets, reading it only once.
+
+    Parameters
+    ----------
+    source : str
+        Path to the image. Compressed images get decompressed once, too.
+
+    targets : list
+        Paths of devices (or files) to write.
+
+    ranges : list
+        (start, end, sha256) block map ranges to write, see
+        raspi_maker.bmap. The gaps between them get zeroed, and each
+        range is checked as it's read. Raw images only.
+
+    sparse : bool
+        Zero, rather than write, chunks that are all zeros.
+
+    block_size : int
+        Size of each buffer in the ring.
+
+    depth : int
+        Buffers in the ring. How far the reader can get ahead of the
+        slowest target.
+
+    direct : bool
+        O_DIRECT writes where supported.
+
+    progress : callable
+        Called as progress(target, bytes_done, bytes_total, bytes_per_sec).
+
+    create : bool
+        Create targets that aren't there, see copy_engine.open_target.
+
+    Returns
+    -------
+    dict : target path to its copy stats (see copy_engine.copy_image),
+        plus 'error', which is None unless that target failed. Every
+        target gets the same 'ranges'.
+
+    Raises
+    ------
+    raspi_maker.errors.ChecksumMismatch : if a range of the image is bad.
+        Every target is suspect at that point.
+    """
+    free = Queue()
+    for _ in range(depth):
+        free.put(_Slot(block_size, free))
+
+    recorder = RangeRecorder()
+    if is_compressed(source):
+        if ranges is not None:
+            raise ValueError('Block maps only work with raw images')
+        total = uncompressed_size(source)
+        chunks = _compressed_chunks(
+            source, free, sparse, block_size, recorder)
+    else:
+        total = os.path.getsize(source)
+        chunks = _raw_chunks(
+            source, free, ranges, sparse, block_size, recorder)
+
+    writers = [
+        _Writer(path, total, direct=direct, progress=progress,
+                create=create)
+        for path in targets]
+    for writer in writers:
+        writer.start()
+
+    try:
+        for slot, offset, n, zero in chunks:
+            if all(writer.error is not None for writer in writers):
+                free.put(slot)
+                break
+            slot.hand_out(len(writers))
+            for writer in writers:
+                writer.queue.put((slot, offset, n, zero))
+    finally:
+        chunks.close()
+        for writer in writers:
+            writer.queue.put(None)
+        for writer in writers:
+            writer.join()
+
+    written = recorder.finish()
+    stats = {}
+    for writer in writers:
+        stats[writer.path] = writer.stats()
+        stats[writer.path]['ranges'] = written
+    return stats
+
+
+class ProgressBoard(object):
+    """Progress callback for fan_out. Keeps every target on one line."""
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.latest = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, target, done, total, bytes_per_sec):
+        with self._lock:
+            self.latest[target] = (done, total, bytes_per_sec)
+            parts = []
+            for name in sorted(self.latest):
+                done, total, rate = self.latest[name]
+                percent = '{0:3.0f}%'.format(
+                    100.0 * done / total) if total else '{0:.0f}MiB'.format(
+                        done / MiB)
+                parts.append('{0} {1} {2:.0f}MiB/s'.format(
+                    os.path.basename(name), percent, rate / MiB))
+            self.stream.write('\r' + ' | '.join(parts))
+            self.stream.flush()
+
+
+def print_report(stats):
+    """Per-target throughput, so slow cards stand out."""
+    print('')
+    rates = [s['bytes_per_sec'] for s in stats.values() if not s['error']]
+    fastest = max(rates) if rates else 0
+    for path in sorted(stats):
+        s = stats[path]
+        if s['error']:
+            print('{0}: FAILED - {1}'.format(path, s['error']))
+            continue
+        line = '{0}: {1:.1f} MiB/s, {2} bytes written in {3:.1f}s'.format(
+            path, s['bytes_per_sec'] / MiB, s['written'], s['seconds'])
+        if fastest and s['bytes_per_sec'] < SLOW_FRACTION * fastest:
+            line += '  <-- slow'
+        print(line)
@@ -0,0 +1,327 @@
+"""Notice block devices coming and going, as it happens.
+
+get_devices is a snapshot. For something long running (see the daemon)
+we'd rather hear about a card the moment it's plugged in, so:
+
+    with Watcher(on_event):
+        ...
+
+calls on_event(DeviceEvent) from a background thread every time a disk
+shows up or goes away.
+
+Events come from one of a few sources, all with the same shape (a
+fileno() to select on, and read() to get whatever events are waiting):
+
+* NetlinkSource: the kernel's own uevents, same as udev hears. Best.
+* InotifySource: watches /dev for nodes being created and deleted, for
+  when netlink isn't on offer (some containers).
+* SimulatedSource: events you make up. Tests.
+"""
+import ctypes
+import os
+import select
+import socket
+import struct
+import threading
+
+from .device import get_inventory
+
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group the kernel sends uevents to. udev rebroadcasts on 2.
+KERNEL_GROUP = 1
+
+UEVENT_BUFFER = 64 * 1024
+
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+ACTIONS = ('add', 'remove')
+
+
+class DeviceEvent(object):
+    """A block device was added or removed.
+
+    Attributes
+    ----------
+    action : str
+        'add' or 'remove'.
+
+    name : str
+        sdc, mmcblk0p1, ...
+
+    devtype : str
+        'disk' or 'partition'. None if we couldn't tell.
+    """
+    def __init__(self, action, name, devtype=None):
+        self.action = action
+        self.name = name
+        self.devtype = devtype
+
+    @property
+    def path(self):
+        return '/dev/{0}'.format(self.name)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, DeviceEvent) and
+            (self.action, self.name, self.devtype) ==
+            (other.action, other.name, other.devtype))
+
+    def __repr__(self):
+        return 'DeviceEvent({0!r}, {1!r}, {2!r})'.format(
+            self.action, self.name, self.devtype)
+
+
+def parse_uevent(data):
+    """Turn one netlink message into a DeviceEvent, or None.
+
+    Kernel messages look like (NUL separated):
+
+        add@/devices/.../block/sdc
+        ACTION=add
+        DEVPATH=/devices/.../block/sdc
+        SUBSYSTEM=block
+        DEVNAME=sdc
+        DEVTYPE=disk
+
+    udev's rebroadcasts start with 'libudev' and are binary, so those
+    are ignored, as is anything that isn't a block device.
+    """
+    if data.startswith(b'libudev'):
+        return None
+    fields = {}
+    for part in data.split(b'\0')[1:]:
+        key, sep, value = part.partition(b'=')
+        if sep:
+            fields[key.decode('utf8', 'replace')] = value.decode(
+                'utf8', 'replace')
+    if fields.get('SUBSYSTEM') != 'block':
+        return None
+    if fields.get('ACTION') not in ACTIONS or 'DEVNAME' not in fields:
+        return None
+    return DeviceEvent(
+        fields['ACTION'], os.path.basename(fields['DEVNAME']),
+        fields.get('DEVTYPE'))
+
+
+class NetlinkSource(object):
+    """Kernel uevents, straight off a netlink socket.
+
+    Raises
+    ------
+    OSError : if netlink isn't available to us.
+    """
+    def __init__(self):
+        self._socket = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self._socket.bind((os.getpid(), KERNEL_GROUP))
+        except OSError:
+            # Someone else in this process has the pid as a port id.
+            try:
+                self._socket.bind((0, KERNEL_GROUP))
+            except OSError:
+                self._socket.close()
+                raise
+        self._socket.setblocking(False)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def read(self):
+        events = []
+        while True:
+            try:
+                data = self._socket.recv(UEVENT_BUFFER)
+            except BlockingIOError:
+                break
+            event = parse_uevent(data)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        self._socket.close()
+
+
+class InotifySource(object):
+    """Device nodes appearing and disappearing in /dev.
+
+    Only names sysfs knows as block devices count, and a node getting
+    removed only counts if we saw it as a block device first.
+
+    Parameters
+    ----------
+    dev_dir : str
+        Where device nodes show up.
+
+    sys_block : str
+        sysfs' directory of block devices, to tell disks from partitions
+        from everything else in /dev.
+    """
+    def __init__(self, dev_dir='/dev', sys_block='/sys/class/block'):
+        self.dev_dir = dev_dir
+        self.sys_block = sys_block
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        result = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dev_dir), IN_CREATE | IN_DELETE)
+        if result < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err))
+        self._known = {}
+        if os.path.isdir(sys_block):
+            for name in os.listdir(sys_block):
+                self._known[name] = self._devtype(name)
+
+    def _devtype(self, name):
+        if os.path.exists(os.path.join(self.sys_block, name, 'partition')):
+            return 'partition'
+        return 'disk'
+
+    def fileno(self):
+        return self._fd
+
+    def _event(self, mask, name):
+        if mask & IN_CREATE:
+            if not os.path.exists(os.path.join(self.sys_block, name)):
+                return None
+            self._known[name] = self._devtype(name)
+            return DeviceEvent('add', name, self._known[name])
+        if mask & IN_DELETE and name in self._known:
+            return DeviceEvent('remove', name, self._known.pop(name))
+        return None
+
+    def read(self):
+        try:
+            data = os.read(self._fd, UEVENT_BUFFER)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(
+                'utf8', 'replace')
+            offset += length
+            event = self._event(mask, name)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SimulatedSource(object):
+    """Events you make up, delivered just like the real ones."""
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._events = []
+        self._lock = threading.Lock()
+
+    def emit(self, action, name, devtype='disk'):
+        with self._lock:
+            self._events.append(DeviceEvent(action, name, devtype))
+        os.write(self._write_fd, b'.')
+
+    def fileno(self):
+        return self._read_fd
+
+    def read(self):
+        os.read(self._read_fd, UEVENT_BUFFER)
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+def open_source():
+    """The best event source we can get: netlink, else inotify on /dev."""
+    try:
+        return NetlinkSource()
+    except OSError as e:
+        print('No netlink uevents ({0}), watching /dev instead.'.format(e))
+        return InotifySource()
+
+
+class Watcher(object):
+    """Calls callback(DeviceEvent) from a thread as devices come and go.
+
+    Each event also invalidates the shared DeviceInventory, so whoever
+    gets called back sees the device that just showed up.
+
+    Parameters
+    ----------
+    callback : callable
+        Called with each DeviceEvent. Exceptions get printed, not raised,
+        so one bad event doesn't stop the watching.
+
+    source : object
+        Where events come from. Defaults to open_source().
+
+    devtypes : tuple
+        Which kinds of device to report. None for all of them.
+    """
+    def __init__(self, callback, source=None, devtypes=('disk',)):
+        self.callback = callback
+        self.source = source if source is not None else open_source()
+        self.devtypes = devtypes
+        self._stop_read, self._stop_write = os.pipe()
+        self._thread = None
+
+    def _wanted(self, event):
+        return self.devtypes is None or event.devtype in self.devtypes
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select(
+                [self.source, self._stop_read], [], [])
+            if self._stop_read in readable:
+                break
+            for event in self.source.read():
+                get_inventory().invalidate()
+                if not self._wanted(event):
+                    continue
+                try:
+                    self.callback(event)
+                except Exception as e:
+                    print('Hotplug callback failed on {0}: {1}'.format(
+                        event, e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_write, b'.')
+            self._thread.join()
+            self._thread = None
+        self.source.close()
+        os.close(self._stop_read)
+        os.close(self._stop_write)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,18 +1,49 @@
 """Got to keep your image up!"""
 import os
 
-IMAGE_NAME = '2016-11-25-raspbian-jessie.img'
-IMAGE_NAME = '2017-08-16-raspbian-stretch.img'
-IMAGE_NAME = '2017-09-07-raspbian-stretch.img'
-IMAGE_NAME = '2018-10-09-raspbian-stretch-lite.img'
-# IMAGE_NAME = '2017-06-21-octopi-jessie-lite-0.14.0.img'
-# IMAGE_NAME = 'retropie-4.3-rpi2_rpi3.img'
+from .decompress import COMPRESSED_SUFFIXES
+from .image_store import IMAGE_DIRS
+from .image_store import ImageStore
+
+# Been through a few:
+#   2016-11-25-raspbian-jessie.img
+#   2017-08-16-raspbian-stretch.img
+#   2017-09-07-raspbian-stretch.img
+#   2018-10-09-raspbian-stretch-lite.img
+#   2017-06-21-octopi-jessie-lite-0.14.0.img
+#   retropie-4.3-rpi2_rpi3.img
 IMAGE_NAME = '2022-04-04-raspios-bullseye-arm64-lite.img'
 PATH = '~/Documents/'
 
 
-def check_image():
-    full_path = os.path.expanduser(os.path.join(PATH, IMAGE_NAME))
-    if os.path.exists(full_path):
-        return full_path
+def _candidates(name):
+    """The raw image first, then any compressed versions of it."""
+    yield name
+    for suffix in COMPRESSED_SUFFIXES:
+        yield name + suffix
+    # Zips are named like the image, without the .img
+    yield os.path.splitext(name)[0] + '.zip'
+
+
+def get_store():
+    """The image store, over PATH and the usual places."""
+    return ImageStore(directories=(PATH,) + IMAGE_DIRS)
+
+
+def check_image(store=None):
+    """Find IMAGE_NAME in the image store's directories, raw or
+    compressed. Nothing gets read (see raspi_maker.image_store).
+
+    A raw image wins if we have both, since it can be flashed from a
+    block map. Otherwise the compressed one gets streamed.
+
+    Returns
+    -------
+    str : path to the image, or False if there isn't one.
+    """
+    store = store or get_store()
+    for candidate in _candidates(IMAGE_NAME):
+        path = store.find(candidate)
+        if path:
+            return path
     return False
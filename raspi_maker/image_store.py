@@ -0,0 +1,415 @@
+"""Every image we've got, and what's in it, without looking twice.
+
+Images (raw or compressed) in IMAGE_DIRS get catalogued in one JSON
+file, `~/.cache/raspi-maker/images.json`:
+
+    {
+        'version': 2,
+        'images': {
+            '/home/me/Documents/2022-04-04-raspios-bullseye-arm64-lite.img': {
+                'name': '2022-04-04-raspios-bullseye-arm64-lite.img',
+                'size': 1962934272,
+                'mtime_ns': ...,
+                'compressed': False,
+                'sha256': '...',
+                'partition_table': {'type': 'mbr', 'disk_id': '...', ...},
+                'partitions': [{'number': 1, 'start': ..., ...}, ...],
+                'os_release': {'ID': 'debian', 'VERSION_CODENAME': ...},
+                'error': None,
+            },
+            ...
+        },
+    }
+
+Finding an image by path or name never reads it, it's a look in each
+directory. Only what's asked for gets worked out, and only once:
+
+    * sha256, when something's looked up by hash (or for duplicates).
+      It's of the file as it sits on disk, so it matches the one
+      published next to a download, and two copies of the same image
+      share one.
+    * the partition layout and os_release, for `--images`. The layout
+      is just the partition table off the front of the image (no
+      manifest, so nothing written next to your files). os_release is
+      the root filesystem's /etc/os-release, read with debugfs, for raw
+      images only. Compressed images, or no debugfs, get None.
+
+Those are None until worked out. Same rules as block maps and
+manifests: an entry is good for as long as the file's size and mtime
+don't change, and files that go away drop out.
+"""
+import json
+import os
+import re
+import subprocess
+import threading
+
+from .decompress import COMPRESSED_SUFFIXES
+from .decompress import is_compressed
+from .decompress import open_decompressed
+from .partition_table import HEAD_BYTES
+from .partition_table import parse_partition_table
+from .partition_table import read_partition_table
+from .sidecar import hash_file
+
+
+CATALOG = '~/.cache/raspi-maker/images.json'
+
+CATALOG_VERSION = 2
+
+IMAGE_DIRS = ('~/Documents/', '~/Downloads/')
+
+# Where os-release is, most likely first. /etc/os-release is usually a
+# symlink to the other one, which debugfs won't follow.
+OS_RELEASE_PATHS = ('/usr/lib/os-release', '/etc/os-release')
+
+# sha256 prefixes shorter than this are too easy to get wrong.
+MIN_HASH_PREFIX = 8
+
+HASH_PREFIX = re.compile(r'^[0-9a-fA-F]+$')
+
+
+def is_image(name):
+    """True if name looks like an image: .img, or a compressed one."""
+    if name.endswith('.zip'):
+        return True
+    return any(name.endswith('.img' + suffix)
+               for suffix in ('',) + COMPRESSED_SUFFIXES)
+
+
+def _parse_os_release(text):
+    release = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition('=')
+        if not sep or key.startswith('#'):
+            continue
+        release[key] = value.strip().strip('"\'')
+    return release
+
+
+
+
+def read_layout(image):
+    """The partition table off the front of an image, raw or compressed.
+
+    Compressed images only get as much decompressed as that takes.
+    """
+    if not is_compressed(image):
+        return read_partition_table(image)
+    head = b''
+    with open_decompressed(image) as f:
+        while len(head) < HEAD_BYTES:
+            chunk = f.read(HEAD_BYTES - len(head))
+            if not chunk:
+                break
+            head += chunk
+    return parse_partition_table(head)
+
+
+def read_os_release(image, partitions):
+    """/etc/os-release out of a raw image's root filesystem.
+
+    Tries each partition, last first, since that's where root usually
+    is. debugfs reads ext filesystems at an offset into the file, so
+    there's no mounting, and no root needed.
+
+    Returns
+    -------
+    dict : its keys and values, or None if there's no finding it.
+    """
+    if is_compressed(image):
+        return None
+    for entry in reversed(partitions):
+        target = '{0}?offset={1}'.format(image, entry['start'])
+        for path in OS_RELEASE_PATHS:
+            try:
+                result = subprocess.run(
+                    ['debugfs', '-R', 'cat {0}'.format(path), target],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except OSError:
+                # No debugfs.
+                return None
+            release = _parse_os_release(
+                result.stdout.decode('utf8', 'replace'))
+            if release:
+                return release
+    return None
+
+
+def new_entry(path):
+    """Catalog entry for one image, with nothing worked out yet. Just a
+    stat, so cheap."""
+    stat = os.stat(path)
+    return {
+        'name': os.path.basename(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'compressed': is_compressed(path),
+        'sha256': None,
+        'partition_table': None,
+        'partitions': None,
+        'os_release': None,
+        'error': None,
+    }
+
+
+def _is_current(entry, path):
+    stat = os.stat(path)
+    return (entry is not None and entry['size'] == stat.st_size and
+            entry['mtime_ns'] == stat.st_mtime_ns)
+
+
+class ImageStore(object):
+    """The catalog, and the directories it covers.
+
+    Parameters
+    ----------
+    directories : list
+        Where images live. Not recursive. Earlier ones win when two
+        hold an image of the same name.
+
+    catalog : str
+        Path to the catalog file.
+    """
+    def __init__(self, directories=IMAGE_DIRS, catalog=CATALOG):
+        self.directories = []
+        for directory in directories:
+            directory = os.path.realpath(os.path.expanduser(directory))
+            if directory not in self.directories:
+                self.directories.append(directory)
+        self.catalog = os.path.expanduser(catalog)
+        self.images = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the catalog file. A missing or stale one is empty."""
+        try:
+            with open(self.catalog) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = {}
+        if catalog.get('version') != CATALOG_VERSION:
+            catalog = {}
+        self.images = catalog.get('images', {})
+
+    def save(self):
+        """Write the catalog out, atomically. Not being able to is only
+        worth a mention, it'll just get worked out again."""
+        directory = os.path.dirname(self.catalog)
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = self.catalog + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(
+                    {'version': CATALOG_VERSION, 'images': self.images}, f)
+            os.replace(temp_path, self.catalog)
+        except OSError as e:
+            print('Could not save the image catalog: {0}'.format(e))
+
+    def _files(self):
+        for directory in self.directories:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                if is_image(name) and os.path.isfile(path):
+                    yield path
+
+    def refresh(self):
+        """Bring the catalog's list of images up to date with what's on
+        disk. A stat per file: new or changed ones get a fresh entry,
+        with nothing worked out yet.
+
+        Returns
+        -------
+        list : paths that are new or changed.
+        """
+        with self._lock:
+            changed = []
+            for path in self._files():
+                if not _is_current(self.images.get(path), path):
+                    self.images[path] = new_entry(path)
+                    changed.append(path)
+
+            gone = [path for path in self.images if not os.path.isfile(path)]
+            for path in gone:
+                del self.images[path]
+
+            if changed or gone:
+                self.save()
+            return changed
+
+    def _hash(self, path):
+        """Fill in the entry's sha256, if it isn't already. True if it
+        wasn't."""
+        entry = self.images[path]
+        if entry['sha256']:
+            return False
+        print('Hashing {0}. Only happens once.'.format(path))
+        try:
+            entry['sha256'] = hash_file(path)
+        except OSError as e:
+            print('Could not hash {0}: {1}'.format(path, e))
+            return False
+        return True
+
+    def _describe(self, path):
+        """Fill in the entry's layout and os_release, if they aren't
+        already. True if they weren't.
+
+        Anything wrong with the image is kept in the entry's error,
+        rather than raised, so a broken image doesn't get read again
+        until it changes.
+        """
+        entry = self.images[path]
+        if entry['partitions'] is not None or entry['error']:
+            return False
+        try:
+            table = read_layout(path)
+            entry['partition_table'] = {
+                'type': table['type'],
+                'disk_id': table['disk_id'],
+                'sector_size': table['sector_size'],
+            }
+            entry['partitions'] = table['partitions']
+            entry['os_release'] = read_os_release(path, table['partitions'])
+        except Exception as e:
+            entry['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        return True
+
+    def _work_out(self, *steps):
+        """refresh, then run each of steps (_hash, _describe) over every
+        image. Saves if anything got worked out."""
+        with self._lock:
+            self.refresh()
+            worked = False
+            for path, _ in self._ordered():
+                for step in steps:
+                    worked = step(path) or worked
+            if worked:
+                self.save()
+
+    def sha256(self, path):
+        """sha256 of one image, from the catalog if we've had it before.
+
+        It doesn't have to be in one of the store's directories. Images
+        from elsewhere are remembered for as long as they're there.
+
+        Returns
+        -------
+        str : the hexdigest.
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            if not _is_current(self.images.get(path), path):
+                self.images[path] = new_entry(path)
+            entry = self.images[path]
+            if not entry['sha256']:
+                print('Hashing {0}. Only happens once.'.format(path))
+                entry['sha256'] = hash_file(path)
+                self.save()
+            return entry['sha256']
+
+    def _ordered(self):
+        """(path, entry) in directory order, then by name. Only images in
+        the store's directories, not ones sha256 was asked about."""
+        def key(item):
+            return self.directories.index(os.path.dirname(item[0])), item[0]
+        return sorted(
+            ((path, entry) for path, entry in self.images.items()
+             if os.path.dirname(path) in self.directories),
+            key=key)
+
+    def find(self, name):
+        """Path of an image called name, or None.
+
+        Straight off the filesystem, in directory order. Nothing gets
+        read, and the catalog isn't involved.
+        """
+        for directory in self.directories:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def by_hash(self, sha256):
+        """Paths of every image whose sha256 starts with sha256.
+
+        Hashes any image that hasn't been, so the first one can take a
+        while.
+        """
+        if len(sha256) < MIN_HASH_PREFIX or not HASH_PREFIX.match(sha256):
+            raise ValueError(
+                'Give at least {0} characters of sha256, got {1!r}'.format(
+                    MIN_HASH_PREFIX, sha256))
+        sha256 = sha256.lower()
+        self._work_out(self._hash)
+        return [path for path, entry in self._ordered()
+                if entry['sha256'] and entry['sha256'].startswith(sha256)]
+
+    def resolve(self, ref):
+        """An image, from a path, a name or a sha256 (prefix).
+
+        Only a sha256 means reading anything.
+
+        Returns
+        -------
+        str : its path, or None.
+
+        Raises
+        ------
+        ValueError : if a sha256 prefix matches different images.
+        """
+        path = os.path.expanduser(ref)
+        if os.path.isfile(path):
+            return path
+        found = self.find(ref)
+        if found:
+            return found
+        try:
+            paths = self.by_hash(ref)
+        except ValueError:
+            return None
+        if len(set(self.images[p]['sha256'] for p in paths)) > 1:
+            raise ValueError('{0} could be any of: {1}'.format(
+                ref, ', '.join(paths)))
+        return paths[0] if paths else None
+
+    def duplicates(self):
+        """Images there's more than one copy of.
+
+        Returns
+        -------
+        list : lists of paths, one per sha256 with more than one file.
+        """
+        self._work_out(self._hash)
+        by_sha256 = {}
+        for path, entry in self._ordered():
+            if entry['sha256']:
+                by_sha256.setdefault(entry['sha256'], []).append(path)
+        return [paths for paths in by_sha256.values() if len(paths) > 1]
+
+    def print_catalog(self):
+        """What's in the store, one image per line, copies marked.
+
+        Works out everything about every image, so slow the first time.
+        """
+        self._work_out(self._hash, self._describe)
+        copies = dict(
+            (path, paths[0])
+            for paths in self.duplicates() for path in paths[1:])
+        for path, entry in self._ordered():
+            release = entry['os_release'] or {}
+            line = '{0:<64} {1:>8.1f} MiB  {2}  {3}'.format(
+                path, entry['size'] / 1024.0 / 1024,
+                (entry['sha256'] or '-' * 64)[:12],
+                release.get('PRETTY_NAME', ''))
+            if entry['error']:
+                line += '  ({0})'.format(entry['error'])
+            if path in copies:
+                line += '  (same as {0})'.format(copies[path])
+            print(line)
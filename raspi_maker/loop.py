@@ -0,0 +1,60 @@
+"""Loop devices, so an image file can be treated like a thumb drive."""
+import os
+
+from .console import console
+from .privileged import run_privileged
+
+
+class LoopDevice(object):
+    """An image file attached to /dev/loopN, partitions and all.
+
+    Example:
+
+        with LoopDevice('work.img') as loop:
+            run_privileged(['mount', loop.partition(2), mnt])
+    """
+    def __init__(self, image, read_only=False):
+        self.image = image
+        self.read_only = read_only
+        self.path = None
+
+    def attach(self):
+        """losetup the image. --partscan gets us /dev/loopNp1 and friends."""
+        cmd = ['losetup', '--find', '--show', '--partscan']
+        if self.read_only:
+            cmd.append('--read-only')
+        cmd.append(self.image)
+        self.path = run_privileged(cmd, echo=False)['output'].strip()
+        if not self.path.startswith('/dev/loop'):
+            raise OSError('losetup did not give us a loop device for {0}'.format(
+                self.image))
+        return self.path
+
+    def detach(self):
+        if self.path is not None:
+            run_privileged(['losetup', '--detach', self.path])
+            self.path = None
+
+    def partition(self, number):
+        """Path of a partition on the loop device. 1 indexed."""
+        return '{0}p{1}'.format(self.path, number)
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.detach()
+
+
+def working_copy(image, target):
+    """Cheap copy of an image to scribble on.
+
+    A reflink where the filesystem can do copy-on-write (btrfs, xfs), so
+    it costs nothing until we change something. Otherwise a sparse copy,
+    which still skips the empty bits.
+    """
+    console(['cp', '--reflink=auto', '--sparse=always', image, target])
+    if not os.path.exists(target):
+        raise OSError('Could not copy {0} to {1}'.format(image, target))
+    return target
@@ -0,0 +1,174 @@
+"""Image manifests: an image's partition table and what's in each partition.
+
+Asking parted about a freshly flashed thumb drive, just to find out
+where the image's boot partition starts and ends, means root, a
+subprocess and a device round trip, every time. The answer is sitting
+in the image. So read the partition table out of it once (see
+raspi_maker.partition_table), hash each partition while we're at it,
+and keep that next to the image as `<image>.manifest.json`:
+
+    {
+        'version': 1,
+        'image': '2018-04-18-raspbian-stretch-lite.img',
+        'image_size': 1862270976,
+        'image_mtime_ns': ...,
+        'partition_table': {'type': 'mbr', 'disk_id': '...', ...},
+        'partitions': [
+            {'number': 1, 'start': ..., 'end': ..., 'type': '0c',
+             ..., 'sha256': '...'},
+            ...
+        ],
+    }
+
+Same rules as block maps: keyed on the image's size and mtime, rebuilt
+when those change. Compressed images work too, they just get
+decompressed (once) to do it.
+"""
+import hashlib
+import os
+
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import allocate_buffer
+from .copy_engine import read_chunk
+from .decompress import DecompressingReader
+from .decompress import is_compressed
+from .partition_table import HEAD_BYTES
+from .partition_table import parse_partition_table
+from .sidecar import get_sidecar
+from .sidecar import image_key
+from .sidecar import load_sidecar
+from .sidecar import save_sidecar
+
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+
+def manifest_path(image):
+    """Where the manifest for an image lives."""
+    return image + MANIFEST_SUFFIX
+
+
+def _raw_chunks(image, block_size):
+    view = allocate_buffer(block_size)
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        offset = 0
+        while True:
+            n = read_chunk(fd, view, offset)
+            if n == 0:
+                break
+            yield view[:n]
+            offset += n
+    finally:
+        os.close(fd)
+
+
+def _hash_partitions(chunks):
+    """Read the table from the first chunk, then hash every partition as
+    the chunks go by.
+
+    Returns
+    -------
+    (dict, list) : the partition table, and its partitions with sha256.
+    """
+    table = None
+    digests = []
+    offset = 0
+    for chunk in chunks:
+        if table is None:
+            table = parse_partition_table(chunk[:HEAD_BYTES])
+            digests = [
+                (p['start'], p['end'], hashlib.sha256())
+                for p in table['partitions']]
+        end = offset + len(chunk)
+        for start, stop, digest in digests:
+            if start < end and stop > offset:
+                digest.update(
+                    chunk[max(start, offset) - offset:min(stop, end) - offset])
+        offset = end
+
+    if table is None:
+        raise ValueError('Empty image')
+    partitions = []
+    for partition, (_, _, digest) in zip(table['partitions'], digests):
+        partition = dict(partition)
+        partition['sha256'] = digest.hexdigest()
+        partitions.append(partition)
+    return table, partitions
+
+
+def generate_manifest(image, block_size=DEFAULT_BLOCK_SIZE):
+    """Read an image's partition table and hash its partitions.
+
+    Parameters
+    ----------
+    image : str
+        Path to the image, raw or compressed.
+
+    Returns
+    -------
+    dict : the manifest, see the module docstring.
+
+    Raises
+    ------
+    ValueError : if the image has no partition table we understand.
+    """
+    size, mtime_ns = image_key(image)
+    if is_compressed(image):
+        with DecompressingReader(image, block_size=block_size) as reader:
+            table, partitions = _hash_partitions(reader)
+    else:
+        table, partitions = _hash_partitions(_raw_chunks(image, block_size))
+
+    return {
+        'version': MANIFEST_VERSION,
+        'image': os.path.basename(image),
+        'image_size': size,
+        'image_mtime_ns': mtime_ns,
+        'partition_table': {
+            'type': table['type'],
+            'disk_id': table['disk_id'],
+            'sector_size': table['sector_size'],
+        },
+        'partitions': partitions,
+    }
+
+
+def load_manifest(image):
+    """Return the saved manifest for image, or None if stale/missing."""
+    return load_sidecar(image, MANIFEST_SUFFIX, MANIFEST_VERSION)
+
+
+def save_manifest(image, manifest):
+    """Write the manifest next to the image, atomically."""
+    save_sidecar(image, MANIFEST_SUFFIX, manifest)
+
+
+def get_manifest(image):
+    """Load the manifest for an image, building it first if we have to."""
+    return get_sidecar(
+        image, MANIFEST_SUFFIX, MANIFEST_VERSION, generate_manifest,
+        'manifest', 'Reading the partition table of {0}. Only happens once.')
+
+
+def partition(manifest, number):
+    """The manifest entry for partition number (1 indexed).
+
+    Raises
+    ------
+    IndexError : if the image has no such partition.
+    """
+    for entry in manifest['partitions']:
+        if entry['number'] == number:
+            return entry
+    raise IndexError('{0} has no partition {1}'.format(
+        manifest['image'], number))
+
+
+def root_partition(manifest):
+    """The manifest entry for the root partition: the image's last one
+    (partition 2 on a Pi image, but not on everything)."""
+    if not manifest['partitions']:
+        raise IndexError('{0} has no partitions'.format(manifest['image']))
+    return manifest['partitions'][-1]
@@ -0,0 +1,363 @@
+"""Read and write MBR and GPT partition tables, no parted required.
+
+Everything comes back as plain dicts (JSON friendly, so they can go in
+a manifest or over to the privileged helper), with offsets in bytes and
+ends exclusive, same as block map ranges:
+
+    {
+        'type': 'mbr',
+        'disk_id': '6c586e13',
+        'sector_size': 512,
+        'partitions': [
+            {'number': 1, 'start': 4194304, 'end': 272629760,
+             'type': '0c', 'bootable': False, 'name': None,
+             'uuid': '6c586e13-01'},
+            ...
+        ],
+    }
+
+For MBR, type is the partition type byte in hex and uuid is the PARTUUID
+Linux makes up for it. For GPT they're the type and partition GUIDs.
+Only primary MBR partitions are read; Pi images don't use logical ones.
+
+write_layout goes the other way: hand it the partitions you want (same
+dicts) and the whole table goes down in one write, then one BLKRRPART
+so the kernel picks it up. Works on image files too, minus the
+BLKRRPART, which is how it's tested.
+"""
+import os
+import struct
+import uuid
+import zlib
+
+from .blockdev import reread_partitions
+
+
+SECTOR = 512
+
+# How much of the start of a disk we read. Enough for a GPT with its
+# usual 128 entries, with plenty to spare.
+HEAD_BYTES = 1024 * 1024
+
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_DISK_ID = 440
+MBR_ENTRIES = 446
+MBR_ENTRY = struct.Struct('<B3sB3sII')
+
+GPT_PROTECTIVE = 0xee
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+
+# CHS fields we don't fill in, the "use the LBA fields" marker.
+MBR_NO_CHS = b'\xfe\xff\xff'
+MBR_MAX_SECTORS = 0xffffffff
+
+GPT_REVISION = 0x10000
+GPT_ENTRY_COUNT = 128
+# Protective MBR, header, and 128 entries of 128 bytes.
+GPT_HEAD_SECTORS = 2 + GPT_ENTRY_COUNT * GPT_ENTRY.size // SECTOR
+
+
+def _mbr_partitions(head, disk_id):
+    partitions = []
+    for index in range(4):
+        status, _, kind, _, first, count = MBR_ENTRY.unpack_from(
+            head, MBR_ENTRIES + index * MBR_ENTRY.size)
+        if kind == 0 or count == 0 or kind in EXTENDED_TYPES:
+            continue
+        partitions.append({
+            'number': index + 1,
+            'start': first * SECTOR,
+            'end': (first + count) * SECTOR,
+            'type': '{0:02x}'.format(kind),
+            'bootable': status == 0x80,
+            'name': None,
+            'uuid': '{0}-{1:02x}'.format(disk_id, index + 1),
+        })
+    return partitions
+
+
+def _gpt(head):
+    header = GPT_HEADER.unpack_from(head, SECTOR)
+    (signature, _, _, _, _, _, _, _, _, disk_guid, entries_lba,
+     entry_count, entry_size, _) = header
+    if signature != GPT_SIGNATURE:
+        raise ValueError('Protective MBR, but no GPT header')
+
+    entries_end = entries_lba * SECTOR + entry_count * entry_size
+    if entries_end > len(head):
+        raise ValueError('GPT entries run past the first {0} bytes'.format(
+            len(head)))
+
+    partitions = []
+    for index in range(entry_count):
+        offset = entries_lba * SECTOR + index * entry_size
+        type_guid, part_guid, first, last, attributes, name = (
+            GPT_ENTRY.unpack_from(head, offset))
+        if type_guid == bytes(16):
+            continue
+        partitions.append({
+            'number': index + 1,
+            'start': first * SECTOR,
+            'end': (last + 1) * SECTOR,
+            'type': str(uuid.UUID(bytes_le=type_guid)),
+            # Legacy BIOS bootable attribute.
+            'bootable': bool(attributes & 4),
+            'name': name.decode('utf-16-le').rstrip('\0'),
+            'uuid': str(uuid.UUID(bytes_le=part_guid)),
+        })
+    return {
+        'type': 'gpt',
+        'disk_id': str(uuid.UUID(bytes_le=disk_guid)),
+        'sector_size': SECTOR,
+        'partitions': partitions,
+    }
+
+
+def parse_partition_table(head):
+    """Parse the partition table out of the first bytes of a disk.
+
+    Parameters
+    ----------
+    head : bytes
+        Start of the disk or image. HEAD_BYTES is always enough.
+
+    Returns
+    -------
+    dict : see the module docstring. Partitions are in number order.
+
+    Raises
+    ------
+    ValueError : if there's no partition table we understand.
+    """
+    head = bytes(head)
+    if len(head) < SECTOR or head[510:512] != MBR_SIGNATURE:
+        raise ValueError('No partition table')
+
+    partitions = _mbr_partitions(head, '')
+    if any(int(p['type'], 16) == GPT_PROTECTIVE for p in partitions):
+        return _gpt(head)
+
+    disk_id = '{0:08x}'.format(
+        struct.unpack_from('<I', head, MBR_DISK_ID)[0])
+    return {
+        'type': 'mbr',
+        'disk_id': disk_id,
+        'sector_size': SECTOR,
+        'partitions': _mbr_partitions(head, disk_id),
+    }
+
+
+def read_partition_table(path):
+    """parse_partition_table, for an image file or device."""
+    with open(path, 'rb') as f:
+        return parse_partition_table(f.read(HEAD_BYTES))
+
+
+def sectors(offset):
+    """A byte offset the way parted likes it, like '8192s'."""
+    return '{0}s'.format(offset // SECTOR)
+
+
+def disk_size(fd):
+    """Size in bytes of an open device or image file."""
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _fill_ends(table, size):
+    """Partitions with end None run to the last usable byte."""
+    if table['type'] == 'gpt':
+        last = size - (GPT_HEAD_SECTORS - 1) * SECTOR
+    else:
+        last = min(size, MBR_MAX_SECTORS * SECTOR)
+    last -= last % SECTOR
+    partitions = []
+    for partition in table['partitions']:
+        partition = dict(partition)
+        if partition.get('end') is None:
+            partition['end'] = last
+        partitions.append(partition)
+    return partitions, last
+
+
+def _check_layout(table, partitions, last):
+    first = GPT_HEAD_SECTORS * SECTOR if table['type'] == 'gpt' else SECTOR
+    slots = GPT_ENTRY_COUNT if table['type'] == 'gpt' else 4
+    previous = None
+    for partition in sorted(partitions, key=lambda p: p['start']):
+        if not 1 <= partition['number'] <= slots:
+            raise ValueError('No slot for partition {0}'.format(
+                partition['number']))
+        if partition['start'] % SECTOR or partition['end'] % SECTOR:
+            raise ValueError('Partition {0} is not sector aligned'.format(
+                partition['number']))
+        if not first <= partition['start'] < partition['end'] <= last:
+            raise ValueError(
+                'Partition {0} ({1}-{2}) does not fit in {3}-{4}'.format(
+                    partition['number'], partition['start'],
+                    partition['end'], first, last))
+        if previous is not None and partition['start'] < previous['end']:
+            raise ValueError('Partitions {0} and {1} overlap'.format(
+                previous['number'], partition['number']))
+        previous = partition
+    numbers = [partition['number'] for partition in partitions]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError('Partition numbers repeat: {0}'.format(numbers))
+
+
+def _build_mbr(head, table, partitions):
+    """The first sector, with our partitions in it. Boot code is kept."""
+    sector = bytearray(head[:SECTOR].ljust(SECTOR, b'\0'))
+    struct.pack_into('<I', sector, MBR_DISK_ID, int(table['disk_id'], 16))
+    sector[MBR_ENTRIES:510] = bytes(510 - MBR_ENTRIES)
+    for partition in partitions:
+        MBR_ENTRY.pack_into(
+            sector, MBR_ENTRIES + (partition['number'] - 1) * MBR_ENTRY.size,
+            0x80 if partition.get('bootable') else 0, MBR_NO_CHS,
+            int(partition['type'], 16), MBR_NO_CHS,
+            partition['start'] // SECTOR,
+            (partition['end'] - partition['start']) // SECTOR)
+    sector[510:512] = MBR_SIGNATURE
+    return bytes(sector)
+
+
+def _gpt_header(disk_guid, current, backup, last_usable, entries_lba,
+                entries_crc):
+    fields = [
+        GPT_SIGNATURE, GPT_REVISION, GPT_HEADER.size, 0, 0, current, backup,
+        GPT_HEAD_SECTORS, last_usable, disk_guid, entries_lba,
+        GPT_ENTRY_COUNT, GPT_ENTRY.size, entries_crc]
+    fields[3] = zlib.crc32(GPT_HEADER.pack(*fields))
+    return GPT_HEADER.pack(*fields).ljust(SECTOR, b'\0')
+
+
+def _build_gpt(head, table, partitions, size):
+    """(primary, backup): the protective MBR, header and entries for the
+    start of the disk, and the entries and header for the end of it."""
+    entries = bytearray(GPT_ENTRY_COUNT * GPT_ENTRY.size)
+    for partition in partitions:
+        attributes = 4 if partition.get('bootable') else 0
+        GPT_ENTRY.pack_into(
+            entries, (partition['number'] - 1) * GPT_ENTRY.size,
+            uuid.UUID(partition['type']).bytes_le,
+            uuid.UUID(partition.get('uuid') or str(uuid.uuid4())).bytes_le,
+            partition['start'] // SECTOR,
+            partition['end'] // SECTOR - 1,
+            attributes,
+            (partition.get('name') or '').encode('utf-16-le'))
+    entries = bytes(entries)
+    entries_crc = zlib.crc32(entries)
+
+    sectors_total = size // SECTOR
+    backup_lba = sectors_total - 1
+    last_usable = sectors_total - GPT_HEAD_SECTORS
+    disk_guid = uuid.UUID(table['disk_id']).bytes_le
+    backup_entries_lba = backup_lba - len(entries) // SECTOR
+
+    protective = {
+        'disk_id': '00000000',
+        'partitions': [{
+            'number': 1, 'start': SECTOR, 'type': '{0:02x}'.format(
+                GPT_PROTECTIVE),
+            'end': min(sectors_total, MBR_MAX_SECTORS) * SECTOR}],
+    }
+    # The protective partition can't start where _check_layout wants
+    # MBR partitions to, so it skips the check.
+    primary = (
+        _build_mbr(head, protective, protective['partitions']) +
+        _gpt_header(disk_guid, 1, backup_lba, last_usable, 2, entries_crc) +
+        entries)
+    backup = entries + _gpt_header(
+        disk_guid, backup_lba, 1, last_usable, backup_entries_lba,
+        entries_crc)
+    return primary, backup
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+def write_layout(path, partitions, type=None, disk_id=None):
+    """Replace the partition table on a device or image file.
+
+    Everything not in partitions is gone afterwards, so to delete a
+    partition leave it out, to grow one give it a bigger end.
+
+    Parameters
+    ----------
+    path : str
+        Device or image file.
+
+    partitions : list
+        Partition dicts, as parse_partition_table hands back. type and
+        start are required; end None means as far as the disk goes.
+        bootable, name and uuid are optional (GPT partitions with no
+        uuid get a new one).
+
+    type : str
+        'mbr' or 'gpt'. Defaults to what's there already, or MBR for a
+        blank disk.
+
+    disk_id : str
+        Defaults to what's there already, if the type's staying the
+        same, else a new random one.
+
+    Returns
+    -------
+    dict : the table as it now reads back.
+
+    Raises
+    ------
+    ValueError : if the partitions overlap, or don't fit.
+    OSError : if the kernel won't reread the table, usually because
+        something on the device is mounted.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = disk_size(fd)
+        head = os.pread(fd, HEAD_BYTES, 0)
+        try:
+            current = parse_partition_table(head)
+        except ValueError:
+            current = {'type': 'mbr', 'disk_id': None}
+
+        type = type or current['type']
+        if disk_id is None:
+            if type == current['type'] and current['disk_id']:
+                disk_id = current['disk_id']
+            elif type == 'gpt':
+                disk_id = str(uuid.uuid4())
+            else:
+                disk_id = '{0:08x}'.format(
+                    struct.unpack('<I', os.urandom(4))[0])
+        table = {'type': type, 'disk_id': disk_id, 'sector_size': SECTOR,
+                 'partitions': partitions}
+
+        partitions, last = _fill_ends(table, size)
+        _check_layout(table, partitions, last)
+
+        if type == 'gpt':
+            primary, backup = _build_gpt(head, table, partitions, size)
+            _pwrite_all(fd, primary, 0)
+            _pwrite_all(fd, backup, size // SECTOR * SECTOR - len(backup))
+        else:
+            if current['type'] == 'gpt':
+                # Don't leave a GPT behind for anything to find later.
+                _pwrite_all(fd, _build_mbr(head, table, partitions) +
+                            bytes(SECTOR), 0)
+                _pwrite_all(fd, bytes(SECTOR), size // SECTOR * SECTOR - SECTOR)
+            else:
+                _pwrite_all(fd, _build_mbr(head, table, partitions), 0)
+        os.fsync(fd)
+        reread_partitions(fd)
+
+        return parse_partition_table(os.pread(fd, HEAD_BYTES, 0))
+    finally:
+        os.close(fd)
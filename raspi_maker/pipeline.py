@@ -0,0 +1,153 @@
+"""Run provisioning steps as a dependency graph instead of a list.
+
+Most of what main() does only depends on one or two earlier steps, so
+there's no reason to wait for the thumb drive to finish before starting
+on the SD card. Each step names the steps it needs, and anything whose
+requirements are done gets started on a thread pool.
+
+Example:
+
+    pipeline = Pipeline()
+    pipeline.add('clear_sd', clear_device, args=(sd_card,))
+    pipeline.add('clear_thumb', clear_device, args=(thumb_drive,))
+    pipeline.add('flash', flash_image, args=(image, thumb_drive),
+                 requires=['clear_thumb'])
+    results = pipeline.run()
+
+A step can take another step's return value as an argument by passing
+StepResult('that_step'). It gets swapped in right before the step runs,
+and the step automatically requires that_step.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from .timing import labelled
+
+
+class StepResult(object):
+    """Placeholder for the return value of another step."""
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'StepResult({0!r})'.format(self.name)
+
+
+def _resolve(value, results):
+    if isinstance(value, StepResult):
+        return results[value.name]
+    return value
+
+
+class Step(object):
+    """One node in the graph."""
+    def __init__(self, name, func, args=(), kwargs=None, requires=(),
+                 description=None, label=None):
+        self.name = name
+        self.label = label or name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.requires = tuple(requires)
+        self.description = description or name
+
+    def placeholders(self):
+        """Names of the steps whose results this step takes as arguments."""
+        values = list(self.args) + list(self.kwargs.values())
+        return [v.name for v in values if isinstance(v, StepResult)]
+
+    def __call__(self, results=None):
+        results = results or {}
+        args = [_resolve(arg, results) for arg in self.args]
+        kwargs = dict(
+            (key, _resolve(value, results))
+            for key, value in self.kwargs.items())
+
+        print('[{0}] {1}'.format(self.label, self.description))
+        start = time.monotonic()
+        with labelled(self.label):
+            result = self.func(*args, **kwargs)
+        print('[{0}] done in {1:.1f}s'.format(
+            self.label, time.monotonic() - start))
+        return result
+
+    def __repr__(self):
+        return 'Step({0!r}, requires={1!r})'.format(self.name, self.requires)
+
+
+class Pipeline(object):
+    """A bunch of steps, and the order they're allowed to run in.
+
+    name, if given, prefixes every step's output. Useful when several
+    pipelines are running at once.
+    """
+    def __init__(self, max_workers=4, name=None):
+        self.max_workers = max_workers
+        self.name = name
+        self.steps = {}
+
+    def add(self, name, func, args=(), kwargs=None, requires=(),
+            description=None):
+        """Add a step. Steps it requires have to be added first.
+
+        Which also means there's no way to build a cycle.
+        """
+        if name in self.steps:
+            raise ValueError('Step {0} already exists'.format(name))
+        label = '{0} {1}'.format(self.name, name) if self.name else name
+        step = Step(
+            name, func, args=args, kwargs=kwargs, requires=requires,
+            description=description, label=label)
+        step.requires += tuple(
+            n for n in step.placeholders() if n not in step.requires)
+        for requirement in step.requires:
+            if requirement not in self.steps:
+                raise ValueError('Step {0} requires unknown step {1}'.format(
+                    name, requirement))
+        self.steps[name] = step
+        return step
+
+    def run(self):
+        """Run everything, as concurrently as the graph allows.
+
+        Returns
+        -------
+        dict : step name to whatever that step returned.
+
+        Raises
+        ------
+        Whatever the first failing step raised. Steps already running are
+        allowed to finish, nothing new gets started.
+        """
+        results = {}
+        pending = dict(self.steps)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [
+                        step for step in pending.values()
+                        if all(r in results for r in step.requires)]
+                    for step in ready:
+                        del pending[step.name]
+                        running[executor.submit(step, results)] = step.name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+
+        if error is not None:
+            raise error
+        return results
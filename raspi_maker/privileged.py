@@ -0,0 +1,336 @@
+"""One privileged helper per run, instead of one sudo per command.
+
+Every sudo costs a fork/exec plus PAM, which adds up over a few hundred
+commands. So start `sudo python -m raspi_maker.privileged` once and
+send it work over a pipe, one JSON line per request:
+
+    {"id": 1, "op": "run", "kwargs": {"argv": ["umount", "/mnt"]}}
+    {"id": 2, "batch": [{"op": "apply_plan", "kwargs": {...}}, ...]}
+
+and get one JSON line back per request, with the result (or the error)
+and how long it took. Requests run on their own threads in the helper,
+so a long flash doesn't hold up a quick mount on another device.
+
+File edits, chowns, copies and partition tables happen inside the
+helper. Things like mount and e2fsck are still commands, but without
+sudo in front.
+
+If we're root already there's no point in a second process, and
+get_helper hands back a LocalHelper that just calls the operations.
+"""
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from .console import run
+from .console import run_many
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import copy_image
+from .copy_engine import copy_range
+from .copy_engine import copy_ranges
+from .copy_engine import copy_stream
+from .copy_engine import print_progress
+from .decompress import DecompressingReader
+from .decompress import decompress_range
+from .decompress import is_compressed
+from .edits import apply_plan
+from .errors import PrivilegedError
+from .fanout import ProgressBoard
+from .fanout import fan_out
+from .partition_table import write_layout
+from .timing import Recorder
+from .timing import add_subprocesses
+from .timing import span
+from .verify import verify_ranges
+from .wipe import wipe_device
+
+
+def _run(argv, check=True, echo=True):
+    """Run a command. Output goes to the terminal as well as back to us."""
+    if echo:
+        print('Running:', ' '.join(argv))
+    result = run(argv, echo=echo)
+    if check and not result.ok:
+        raise subprocess.CalledProcessError(
+            result.returncode, argv, output=result.output)
+    return {'returncode': result.returncode, 'output': result.output}
+
+
+def _run_many(argvs, limit=None):
+    """Run commands all at once. Failures are reported, not raised."""
+    return [
+        {'returncode': result.returncode, 'output': result.output}
+        for result in run_many(argvs, limit=limit)]
+
+
+def _copy_image(source, target, progress=True, **kwargs):
+    return copy_image(
+        source, target, progress=print_progress if progress else None,
+        **kwargs)
+
+
+def _copy_ranges(source, target, ranges, progress=True, **kwargs):
+    return copy_ranges(
+        source, target, ranges, progress=print_progress if progress else None,
+        **kwargs)
+
+
+def _copy_range(source, target, start, end, progress=True, **kwargs):
+    copy = decompress_range if is_compressed(source) else copy_range
+    return copy(
+        source, target, start, end,
+        progress=print_progress if progress else None, **kwargs)
+
+
+def _copy_compressed(source, target, progress=True,
+                     block_size=DEFAULT_BLOCK_SIZE, **kwargs):
+    with DecompressingReader(source, block_size=block_size) as reader:
+        return copy_stream(
+            reader, target, total=reader.size,
+            progress=print_progress if progress else None, **kwargs)
+
+
+def _fan_out(source, targets, progress=True, **kwargs):
+    return fan_out(
+        source, targets, progress=ProgressBoard() if progress else None,
+        **kwargs)
+
+
+def _verify(target, ranges, progress=True, **kwargs):
+    return verify_ranges(
+        target, ranges, progress=print_progress if progress else None,
+        **kwargs)
+
+
+def _apply_plan(plan):
+    apply_plan(plan)
+
+
+OPERATIONS = {
+    'run': _run,
+    'run_many': _run_many,
+    'apply_plan': _apply_plan,
+    'copy_image': _copy_image,
+    'copy_ranges': _copy_ranges,
+    'copy_range': _copy_range,
+    'copy_compressed': _copy_compressed,
+    'fan_out': _fan_out,
+    'verify': _verify,
+    'write_layout': write_layout,
+    'wipe': wipe_device,
+}
+
+
+def execute(op, kwargs):
+    """Run one operation by name."""
+    if op not in OPERATIONS:
+        raise ValueError('No such privileged operation: {0}'.format(op))
+    return OPERATIONS[op](**kwargs)
+
+
+def _respond(request):
+    """Work out the response to one request.
+
+    Commands run for it are counted (see raspi_maker.timing) and sent
+    back, so the client can put them down to whatever asked for them.
+    """
+    start = time.monotonic()
+    response = {'id': request['id']}
+    # Not recorded here. Run in process, the counts roll up into the
+    # caller's span anyway.
+    with span('privileged', recorder=Recorder()) as counted:
+        try:
+            if 'batch' in request:
+                response['result'] = [
+                    execute(call['op'], call.get('kwargs', {}))
+                    for call in request['batch']]
+            else:
+                response['result'] = execute(
+                    request['op'], request.get('kwargs', {}))
+        except Exception as e:
+            response['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    response['seconds'] = time.monotonic() - start
+    response['subprocesses'] = counted.subprocesses
+    response['subprocess_seconds'] = counted.subprocess_seconds
+    return response
+
+
+def serve(infile, outfile):
+    """The helper's main loop. Runs until infile closes.
+
+    Each request gets a thread, responses are written whole, one per
+    line, as they finish.
+    """
+    lock = threading.Lock()
+    threads = []
+
+    def handle(request):
+        response = json.dumps(_respond(request))
+        with lock:
+            outfile.write(response + '\n')
+            outfile.flush()
+
+    for line in infile:
+        if not line.strip():
+            continue
+        thread = threading.Thread(target=handle, args=(json.loads(line),))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+class LocalHelper(object):
+    """Same interface as PrivilegedHelper, for when we're root already."""
+    def __init__(self):
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def _record(self, op, response):
+        with self._lock:
+            self.timings.append((op, response['seconds']))
+        if 'error' in response:
+            raise PrivilegedError(response['error'])
+        return response['result']
+
+    def call(self, op, **kwargs):
+        """Run one operation, return its result.
+
+        Raises
+        ------
+        raspi_maker.errors.PrivilegedError : if it fails.
+        """
+        return self._record(op, _respond({'id': 0, 'op': op, 'kwargs': kwargs}))
+
+    def batch(self, calls):
+        """Run (op, kwargs) pairs in order, in one go. Stops at the first
+        failure. Returns a list of results."""
+        request = {
+            'id': 0,
+            'batch': [{'op': op, 'kwargs': kwargs} for op, kwargs in calls]}
+        return self._record('batch', _respond(request))
+
+    def close(self):
+        pass
+
+
+class PrivilegedHelper(LocalHelper):
+    """Client end of a helper process started with sudo."""
+    def __init__(self, sudo=True):
+        super(PrivilegedHelper, self).__init__()
+        cmd = [
+            'env',
+            'PYTHONPATH={0}'.format(_package_parent()),
+            sys.executable,
+            '-m',
+            'raspi_maker.privileged',
+        ]
+        if sudo:
+            cmd.insert(0, 'sudo')
+        self._process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self._pending = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_responses(self):
+        for line in self._process.stdout:
+            response = json.loads(line)
+            with self._lock:
+                op, future = self._pending.pop(response['id'])
+            future.set_result((op, response))
+        # Helper's gone. Anybody still waiting isn't getting an answer.
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for op, future in pending:
+            future.set_exception(PrivilegedError('Privileged helper died'))
+
+    def _send(self, op, request):
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            request['id'] = self._next_id
+            self._pending[request['id']] = (op, future)
+            self._process.stdin.write(json.dumps(request) + '\n')
+            self._process.stdin.flush()
+        op, response = future.result()
+        # The commands ran in the helper process, count them here.
+        add_subprocesses(
+            response.get('subprocesses', 0),
+            response.get('subprocess_seconds', 0.0))
+        return self._record(op, response)
+
+    def call(self, op, **kwargs):
+        return self._send(op, {'op': op, 'kwargs': kwargs})
+
+    def batch(self, calls):
+        return self._send('batch', {
+            'batch': [{'op': op, 'kwargs': kwargs} for op, kwargs in calls]})
+
+    def close(self):
+        """Let the helper finish what it's doing and exit."""
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+
+
+def _package_parent():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+_helper = None
+_helper_lock = threading.Lock()
+
+
+def get_helper():
+    """The helper for this run, started the first time it's asked for."""
+    global _helper
+    with _helper_lock:
+        if _helper is None:
+            if os.geteuid() == 0:
+                _helper = LocalHelper()
+            else:
+                print('Starting privileged helper (sudo, just the once).')
+                _helper = PrivilegedHelper()
+                atexit.register(_helper.close)
+        return _helper
+
+
+def run_privileged(argv, check=True, echo=True):
+    """Run one command as root, through the helper.
+
+    Returns
+    -------
+    dict : returncode and output.
+
+    Raises
+    ------
+    raspi_maker.errors.PrivilegedError : if check and it exits non zero.
+    """
+    return get_helper().call('run', argv=argv, check=check, echo=echo)
+
+
+def main():
+    """Entry point of the helper process itself.
+
+    The real stdout is kept for talking to the client. Everything else
+    that would print to stdout (progress bars, command output) goes to
+    stderr, which is still the user's terminal.
+    """
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin, channel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""What we work out about an image once, and keep next to it.
+
+Block maps (raspi_maker.bmap) and manifests (raspi_maker.manifest) are
+both JSON files sitting next to the image they describe, say
+`<image>.bmap.json`. Each one remembers the size and mtime of the image
+it was made from, and stops counting once either changes, so a new
+download with the same name gets looked at again and an old one never
+does.
+"""
+import hashlib
+import json
+import os
+
+
+def image_key(image):
+    """(size, mtime_ns) of image, what a sidecar is good for."""
+    stat = os.stat(image)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def hash_file(path):
+    """sha256 of a whole file, as it sits on disk."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(4 * 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_sidecar(image, suffix, version):
+    """Return the saved sidecar for image, or None if stale/missing."""
+    try:
+        with open(image + suffix) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    size, mtime_ns = image_key(image)
+    if (sidecar.get('version') != version or
+            sidecar.get('image_size') != size or
+            sidecar.get('image_mtime_ns') != mtime_ns):
+        return None
+    return sidecar
+
+
+def save_sidecar(image, suffix, sidecar):
+    """Write the sidecar next to the image, atomically."""
+    path = image + suffix
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(temp_path, path)
+
+
+def get_sidecar(image, suffix, version, generate, what, announce):
+    """Load the sidecar for an image, generating it first if we have to.
+
+    If it can't be saved next to the image (read only mount, say) it
+    still gets returned, we'll just generate it again next time.
+
+    Parameters
+    ----------
+    image : str
+        Path to the image.
+
+    suffix : str
+        Added to the image's path to get the sidecar's.
+
+    version : int
+        Sidecars of any other version are stale.
+
+    generate : callable
+        Called as generate(image), returns the sidecar. Its version,
+        image_size and image_mtime_ns are what load_sidecar checks.
+
+    what : str
+        What it is, for the message when it can't be saved.
+
+    announce : str
+        Printed before generating, formatted with the image's path.
+    """
+    sidecar = load_sidecar(image, suffix, version)
+    if sidecar is not None:
+        return sidecar
+
+    print(announce.format(image))
+    sidecar = generate(image)
+    try:
+        save_sidecar(image, suffix, sidecar)
+    except OSError as e:
+        print('Could not save {0}: {1}'.format(what, e))
+    return sidecar
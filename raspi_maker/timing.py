@@ -0,0 +1,231 @@
+"""Where the time goes, step by step.
+
+Every action worth knowing about is wrapped with @timed, and every
+command run through raspi_maker.console is counted against whatever
+action is running at the time. Each finished action becomes a record:
+
+    {"name": "flash_image", "label": "node-01 flash", "start": ...,
+     "seconds": 41.2, "bytes": 1862270976, "mb_per_sec": 43.1,
+     "subprocesses": 0, "subprocess_seconds": 0.0, "error": null}
+
+which goes out as a JSON line (if there's somewhere to put them, see
+Recorder.open_log), and into a summary table at the end of the run.
+
+Which action is running is a context variable, so it follows the code
+onto asyncio tasks, and each pipeline step's thread has its own. Numbers
+are inclusive: an action's bytes and subprocesses include those of any
+action it calls.
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+MiB = 1024 * 1024
+
+_span = contextvars.ContextVar('raspi_maker_span', default=None)
+_label = contextvars.ContextVar('raspi_maker_label', default=None)
+
+
+class Span(object):
+    """One timed action, while it runs."""
+    def __init__(self, name, label=None, parent=None):
+        self.name = name
+        self.label = label
+        self.parent = parent
+        self.start = time.time()
+        self.seconds = None
+        self.bytes = 0
+        self.subprocesses = 0
+        self.subprocess_seconds = 0.0
+        self.error = None
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, bytes=0, subprocesses=0, subprocess_seconds=0.0):
+        """Count some work against this span and everything above it."""
+        span = self
+        while span is not None:
+            with span._lock:
+                span.bytes += bytes
+                span.subprocesses += subprocesses
+                span.subprocess_seconds += subprocess_seconds
+            span = span.parent
+
+    def finish(self, error=None):
+        self.seconds = time.monotonic() - self._started
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'label': self.label,
+            'start': self.start,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'mb_per_sec': _mb_per_sec(self.bytes, self.seconds),
+            'subprocesses': self.subprocesses,
+            'subprocess_seconds': self.subprocess_seconds,
+            'error': self.error,
+        }
+
+
+def _mb_per_sec(num_bytes, seconds):
+    if not num_bytes or not seconds:
+        return None
+    return num_bytes / MiB / seconds
+
+
+class Recorder(object):
+    """Collects finished spans, and writes them out as they finish."""
+    def __init__(self):
+        self.records = []
+        self._log = None
+        self._lock = threading.Lock()
+
+    def open_log(self, path):
+        """Append a JSON line per finished span to path from now on."""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+            self._log = open(path, 'a')
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def record(self, span):
+        record = span.to_dict()
+        with self._lock:
+            self.records.append(record)
+            if self._log is not None:
+                self._log.write(json.dumps(record) + '\n')
+                self._log.flush()
+        return record
+
+    def summary(self):
+        """Totals per action name, slowest first.
+
+        Returns
+        -------
+        list : dicts of name, count, seconds, max_seconds, bytes,
+            mb_per_sec, subprocesses and errors.
+        """
+        rows = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            row = rows.setdefault(record['name'], {
+                'name': record['name'],
+                'count': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'bytes': 0,
+                'subprocesses': 0,
+                'errors': 0,
+            })
+            row['count'] += 1
+            row['seconds'] += record['seconds']
+            row['max_seconds'] = max(row['max_seconds'], record['seconds'])
+            row['bytes'] += record['bytes']
+            row['subprocesses'] += record['subprocesses']
+            row['errors'] += record['error'] is not None
+        for row in rows.values():
+            row['mb_per_sec'] = _mb_per_sec(row['bytes'], row['seconds'])
+        return sorted(rows.values(), key=lambda row: -row['seconds'])
+
+    def print_summary(self):
+        """The summary as a table. Prints nothing if nothing was timed."""
+        rows = self.summary()
+        if not rows:
+            return
+        line = '{0:<28} {1:>5} {2:>9} {3:>9} {4:>10} {5:>8} {6:>6}'
+        print(line.format(
+            'step', 'runs', 'total s', 'max s', 'MiB', 'MiB/s', 'procs'))
+        for row in rows:
+            print(line.format(
+                row['name'] + (' !' if row['errors'] else ''),
+                row['count'],
+                '{0:.1f}'.format(row['seconds']),
+                '{0:.1f}'.format(row['max_seconds']),
+                '{0:.1f}'.format(row['bytes'] / MiB) if row['bytes'] else '-',
+                '{0:.1f}'.format(row['mb_per_sec'])
+                if row['mb_per_sec'] else '-',
+                row['subprocesses']))
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    """The recorder for this run."""
+    return _recorder
+
+
+@contextmanager
+def span(name, recorder=None):
+    """Time a block of code as the action name. Yields the Span."""
+    current = Span(name, label=_label.get(), parent=_span.get())
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish('{0}: {1}'.format(type(e).__name__, e))
+        raise
+    else:
+        current.finish()
+    finally:
+        _span.reset(token)
+        (recorder or _recorder).record(current)
+
+
+def timed(func):
+    """Decorator: time every call of func as a span named after it.
+
+    A dict result with written or bytes in it (copy and verify stats)
+    counts those bytes as moved. written wins, skipped zeros don't count.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__) as current:
+            result = func(*args, **kwargs)
+            if isinstance(result, dict):
+                moved = result.get('written', result.get('bytes'))
+                current.add(bytes=moved or 0)
+            return result
+    return wrapper
+
+
+@contextmanager
+def labelled(label):
+    """Spans started inside get this label. Which pipeline step (and
+    pair) they belong to, usually."""
+    token = _label.set(label)
+    try:
+        yield
+    finally:
+        _label.reset(token)
+
+
+def current_span():
+    """The span we're inside of, or None."""
+    return _span.get()
+
+
+def add_bytes(num_bytes):
+    """Count bytes moved against the current span, if there is one."""
+    current = _span.get()
+    if current is not None:
+        current.add(bytes=num_bytes)
+
+
+def add_subprocesses(count, seconds):
+    """Count commands run against the current span, if there is one."""
+    current = _span.get()
+    if current is not None:
+        current.add(subprocesses=count, subprocess_seconds=seconds)
@@ -0,0 +1,126 @@
+"""Read back what we wrote and make sure it stuck.
+
+Cheap cards lie. They take the writes, say thanks, and hand back
+something else on the next read (or on the Pi's first boot). Every copy
+in raspi_maker.copy_engine and raspi_maker.fanout hands back a sha256
+for each range it wrote, so after a flash we read those ranges straight
+back off the device and compare.
+
+The read back has to come off the device, not out of the page cache
+(which would happily give us back what we just wrote), so it's O_DIRECT
+where we can get it, and posix_fadvise(DONTNEED) on the way in and out
+where we can't.
+"""
+import errno
+import hashlib
+import os
+
+from .copy_engine import ALIGNMENT
+from .copy_engine import DEFAULT_BLOCK_SIZE
+from .copy_engine import Progress
+from .copy_engine import read_chunk
+from .copy_engine import pooled_buffer
+
+
+def _open_for_verify(path, direct=True):
+    """Open path to read back. Returns (fd, is_direct)."""
+    o_direct = getattr(os, 'O_DIRECT', 0)
+    if direct and o_direct:
+        try:
+            return os.open(path, os.O_RDONLY | o_direct), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, os.O_RDONLY), False
+
+
+def _drop_cache(fd, offset, length):
+    """Ask the kernel to forget its cached copy of a range."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _read_range(fd, direct, view, start, end, digest, tracker):
+    """Hash start to end of fd into digest, a buffer at a time."""
+    block_size = len(view)
+    offset = start
+    while offset < end:
+        n = min(block_size, end - offset)
+        # O_DIRECT reads have to be whole blocks, so round up and only
+        # hash what we asked for.
+        length = n + (-n % ALIGNMENT) if direct else n
+        got = read_chunk(fd, view[:length], offset)
+        if got < n:
+            raise EOFError('Target ends at {0}, before {1}'.format(
+                offset + got, end))
+        digest.update(view[:n])
+        tracker.update(n)
+        offset += n
+
+
+def verify_ranges(target, ranges, block_size=DEFAULT_BLOCK_SIZE, direct=True,
+                  progress=None):
+    """Read ranges back off target and check each one's sha256.
+
+    Every range gets checked, even after one fails, so you know how bad
+    it is.
+
+    Parameters
+    ----------
+    target : str
+        Device (or file) to read back.
+
+    ranges : list
+        (start, end, sha256 hexdigest), as handed back by the copy.
+
+    block_size : int
+        Bytes per read. The buffer comes out of the same pool the
+        copies use, see copy_engine.BufferPool.
+
+    direct : bool
+        O_DIRECT reads where supported.
+
+    progress : callable
+        Called as progress(bytes_done, bytes_total, bytes_per_sec).
+
+    Returns
+    -------
+    dict : bytes, seconds and bytes_per_sec of the read back, plus
+        mismatches: [start, end] of every range that came back wrong.
+    """
+    tracker = Progress(sum(end - start for start, end, _ in ranges), progress)
+    mismatches = []
+
+    with pooled_buffer(block_size) as view:
+        fd, is_direct = _open_for_verify(target, direct=direct)
+        try:
+            for start, end, checksum in ranges:
+                if is_direct and start % ALIGNMENT:
+                    is_direct = False
+                    os.close(fd)
+                    fd, _ = _open_for_verify(target, direct=False)
+                if not is_direct:
+                    _drop_cache(fd, start, end - start)
+
+                digest = hashlib.sha256()
+                try:
+                    _read_range(
+                        fd, is_direct, view, start, end, digest, tracker)
+                except EOFError:
+                    mismatches.append([start, end])
+                    continue
+                if not is_direct:
+                    _drop_cache(fd, start, end - start)
+                if digest.hexdigest() != checksum:
+                    mismatches.append([start, end])
+        finally:
+            os.close(fd)
+
+    tracker.finish()
+    stats = tracker.stats()
+    del stats['written']
+    stats['mismatches'] = mismatches
+    return stats
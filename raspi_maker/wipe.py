@@ -0,0 +1,191 @@
+"""Reset a card properly, and fast.
+
+Deleting partition entries leaves everything else behind: the old
+filesystems' superblocks, a backup GPT at the end of the card. Then
+e2fsck or resize2fs (or blkid, or the kernel) finds them later and gets
+ideas. Two ways to get rid of them, neither of which means writing
+zeros over the whole card:
+
+    signatures
+        Look for anything that says "I'm a filesystem" or "I'm a
+        partition table" where those things live (the start of the disk,
+        the start of each partition, the end of the disk) and zero just
+        those sectors, like wipefs. A few KiB of writes.
+
+    full
+        Discard the whole device (BLKDISCARD, the same thing as TRIM),
+        which takes seconds on anything that supports it. Cards that
+        don't get BLKZEROOUT, which the kernel does as cheaply as the
+        hardware lets it. Then a signatures pass anyway, since a
+        discarded range doesn't have to read back as zeros.
+
+Image files work too: discard is a punched hole.
+"""
+import errno
+import os
+import time
+
+from .blockdev import SECTOR
+from .blockdev import discard_range
+from .blockdev import reread_partitions
+from .blockdev import write_zeros
+from .blockdev import zero_range
+from .partition_table import HEAD_BYTES
+from .partition_table import parse_partition_table
+
+
+WIPE_MODES = ('signatures', 'full')
+
+# (name, offset into the filesystem or disk, magic). Offsets are from
+# wherever the thing starts.
+SIGNATURES = (
+    ('mbr', 510, b'\x55\xaa'),
+    ('gpt', 512, b'EFI PART'),
+    ('ext', 1080, b'\x53\xef'),
+    ('vfat', 54, b'FAT1'),
+    ('vfat', 82, b'FAT32   '),
+    ('swap', 4086, b'SWAPSPACE2'),
+    ('xfs', 0, b'XFSB'),
+    ('btrfs', 65600, b'_BHRfS_M'),
+    ('luks', 0, b'LUKS\xba\xbe'),
+    ('iso9660', 32769, b'CD001'),
+)
+
+# Enough to see every signature above.
+PROBE_BYTES = 68 * 1024
+
+
+def _probe(fd, start, size):
+    """Signatures found in the thing starting at start.
+
+    Returns
+    -------
+    list : dicts of name, offset (on the disk) and length.
+    """
+    data = os.pread(fd, min(PROBE_BYTES, max(size - start, 0)), start)
+    found = []
+    for name, offset, magic in SIGNATURES:
+        if data[offset:offset + len(magic)] == magic:
+            found.append({
+                'name': name, 'offset': start + offset, 'length': len(magic)})
+    return found
+
+
+def scan_signatures(fd):
+    """Find filesystem and partition table signatures on a device.
+
+    Looks at the start of the disk, the start of every partition the
+    partition table knows about, and the last sector (backup GPT).
+
+    Parameters
+    ----------
+    fd : int
+        Open device or image file.
+
+    Returns
+    -------
+    list : dicts of name, offset and length, sorted by offset.
+    """
+    size = os.lseek(fd, 0, os.SEEK_END)
+    starts = set([0])
+    try:
+        table = parse_partition_table(os.pread(fd, HEAD_BYTES, 0))
+        starts.update(partition['start'] for partition in table['partitions'])
+    except ValueError:
+        pass
+
+    found = []
+    for start in sorted(starts):
+        found.extend(_probe(fd, start, size))
+    last = size - size % SECTOR - SECTOR
+    if last > 0 and os.pread(fd, 8, last) == b'EFI PART':
+        found.append({'name': 'gpt', 'offset': last, 'length': 8})
+
+    # Partition 1's start and disk start can find the same bytes twice.
+    unique = dict(
+        ((signature['offset'], signature['name']), signature)
+        for signature in found)
+    return [unique[key] for key in sorted(unique)]
+
+
+def wipe_signatures(fd, signatures=None):
+    """Zero the sector each signature is in.
+
+    Returns
+    -------
+    list : the signatures that were wiped.
+    """
+    if signatures is None:
+        signatures = scan_signatures(fd)
+    sectors = set()
+    for signature in signatures:
+        first = signature['offset'] // SECTOR
+        last = (signature['offset'] + signature['length'] - 1) // SECTOR
+        sectors.update(range(first, last + 1))
+    for sector in sorted(sectors):
+        write_zeros(fd, sector * SECTOR, SECTOR)
+    return signatures
+
+
+def _discard_or_zero(fd, size):
+    """Discard the whole device, zero it if it can't. Returns which."""
+    try:
+        discard_range(fd, 0, size)
+        return 'discard'
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+            raise
+    zero_range(fd, 0, size)
+    return 'zeroout'
+
+
+def wipe_device(path, mode='signatures'):
+    """Wipe a device or image file.
+
+    Parameters
+    ----------
+    path : str
+
+    mode : str
+        'signatures' or 'full', see the module docstring.
+
+    Returns
+    -------
+    dict : mode, method (signatures, discard or zeroout), bytes (how much
+        of the device got discarded or zeroed outright), seconds, and
+        the signatures found and zeroed.
+
+    Raises
+    ------
+    ValueError : for a mode we don't know.
+    OSError : if the kernel won't reread the (now empty) partition
+        table, usually because something on the device is mounted.
+    """
+    if mode not in WIPE_MODES:
+        raise ValueError('Wipe mode is one of {0}, not {1}'.format(
+            ', '.join(WIPE_MODES), mode))
+
+    start = time.monotonic()
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        # Find them before a discard can hide them behind garbage.
+        signatures = scan_signatures(fd)
+        method = 'signatures'
+        wiped = 0
+        if mode == 'full':
+            method = _discard_or_zero(fd, size)
+            wiped = size
+        wipe_signatures(fd, signatures + scan_signatures(fd))
+        os.fsync(fd)
+        reread_partitions(fd)
+    finally:
+        os.close(fd)
+
+    return {
+        'mode': mode,
+        'method': method,
+        'bytes': wiped,
+        'seconds': time.monotonic() - start,
+        'signatures': signatures,
+    }
@@ -0,0 +1,96 @@
+"""Tests for the provisioning actions, with the devices stubbed out."""
+import os
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker import actions
+from raspi_maker.errors import PrivilegedError
+from raspi_maker.partition_table import write_layout
+
+
+MiB = 1024 * 1024
+
+
+class FakeLoop(object):
+    def __init__(self, image):
+        self.path = '/dev/loop7'
+
+    def partition(self, number):
+        return '{0}p{1}'.format(self.path, number)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@mark.unit
+def test_polish_image_finds_root_in_the_manifest(tmp_path, monkeypatch):
+    image = str(tmp_path / 'three.img')
+    with open(image, 'wb') as f:
+        f.truncate(8 * MiB)
+    # Boot, some vendor partition, then root.
+    write_layout(image, [
+        {'number': 1, 'start': MiB, 'end': 2 * MiB, 'type': '0c'},
+        {'number': 2, 'start': 2 * MiB, 'end': 3 * MiB, 'type': '83'},
+        {'number': 3, 'start': 3 * MiB, 'end': None, 'type': '83'},
+    ], type='mbr')
+
+    polished = []
+    monkeypatch.setattr(actions, 'LoopDevice', FakeLoop)
+    monkeypatch.setattr(
+        actions, '_polish_partition',
+        lambda partition, *args, **kwargs: polished.append(partition))
+
+    result = actions.polish_image(image, 'ssid', 'psk', 'admin', 'node-01')
+    try:
+        assert polished == ['/dev/loop7p3']
+    finally:
+        actions.discard_polished_image(result)
+
+
+class BrokenHelper(object):
+    def call(self, op, **kwargs):
+        raise PrivilegedError('{0} broke'.format(op))
+
+
+@mark.unit
+def test_failed_polish_still_unmounts(monkeypatch):
+    ran = []
+    monkeypatch.setattr(
+        actions, 'run_privileged', lambda argv: ran.append(argv))
+    monkeypatch.setattr(actions, 'get_helper', BrokenHelper)
+
+    with raises(PrivilegedError):
+        actions._polish_partition(
+            '/dev/loop7p2', 'ssid', 'psk', 'admin', 'node-01')
+
+    assert [argv[0] for argv in ran] == ['mount', 'umount']
+    mount_dir = ran[1][1]
+    assert ran[0][2] == mount_dir
+    assert not os.path.exists(mount_dir)
+
+
+@mark.unit
+def test_failed_polish_image_cleans_up(tmp_path, monkeypatch):
+    image = str(tmp_path / 'base.img')
+    with open(image, 'wb') as f:
+        f.truncate(4 * MiB)
+    write_layout(image, [
+        {'number': 1, 'start': MiB, 'end': 2 * MiB, 'type': '0c'},
+        {'number': 2, 'start': 2 * MiB, 'end': None, 'type': '83'},
+    ], type='mbr')
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+
+    def broken(*args, **kwargs):
+        raise PrivilegedError('mount broke')
+    monkeypatch.setattr(actions, 'LoopDevice', FakeLoop)
+    monkeypatch.setattr(actions, '_polish_partition', broken)
+
+    with raises(PrivilegedError):
+        actions.polish_image(
+            image, 'ssid', 'psk', 'admin', 'node-01', work_dir=str(work_dir))
+    assert os.listdir(str(work_dir)) == []
@@ -0,0 +1,78 @@
+"""Tests for block maps, using small made up images."""
+import os
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.bmap import bmap_path
+from raspi_maker.bmap import get_bmap
+from raspi_maker.bmap import load_bmap
+from raspi_maker.copy_engine import copy_ranges
+from raspi_maker.errors import ChecksumMismatch
+
+
+MiB = 1024 * 1024
+
+
+def _make_image(path):
+    """Two islands of data with a lot of nothing between them."""
+    with open(path, 'wb') as f:
+        f.write(os.urandom(8192))
+        f.seek(4 * MiB)
+        f.write(os.urandom(4096))
+        f.truncate(6 * MiB)
+
+
+@mark.unit
+def test_get_bmap_finds_the_data(tmp_path):
+    image = str(tmp_path / 'test.img')
+    _make_image(image)
+
+    bmap = get_bmap(image)
+
+    assert [r[:2] for r in bmap['ranges']] == [
+        [0, 8192], [4 * MiB, 4 * MiB + 4096]]
+    assert bmap['mapped_bytes'] == 8192 + 4096
+    assert os.path.exists(bmap_path(image))
+
+
+@mark.unit
+def test_bmap_is_cached_until_the_image_changes(tmp_path):
+    image = str(tmp_path / 'test.img')
+    _make_image(image)
+
+    get_bmap(image)
+    assert load_bmap(image) is not None
+
+    with open(image, 'ab') as f:
+        f.write(b'more')
+    assert load_bmap(image) is None
+
+
+@mark.unit
+def test_copy_ranges_writes_the_image(tmp_path):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+    _make_image(image)
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * 8 * MiB)
+
+    bmap = get_bmap(image)
+    stats = copy_ranges(image, target, bmap['ranges'], block_size=MiB)
+
+    with open(image, 'rb') as f:
+        expected = f.read()
+    with open(target, 'rb') as f:
+        assert f.read(len(expected)) == expected
+    assert stats['written'] == bmap['mapped_bytes']
+
+
+@mark.unit
+def test_copy_ranges_catches_bad_checksums(tmp_path):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+    _make_image(image)
+
+    ranges = [[0, 8192, '0' * 64]]
+    with raises(ChecksumMismatch):
+        copy_ranges(image, target, ranges, block_size=MiB, create=True)
@@ -0,0 +1,157 @@
+"""Tests for the polished image cache."""
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from pytest import mark
+
+from raspi_maker import actions
+from raspi_maker import cache as cache_module
+from raspi_maker.cache import PolishCache
+from raspi_maker.image_store import ImageStore
+
+
+def _image(path, contents=b'raspbian'):
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return str(path)
+
+
+@mark.unit
+def test_key_depends_on_image_and_params(tmp_path):
+    cache = PolishCache(str(tmp_path / 'cache'))
+    image = _image(tmp_path / 'base.img')
+    key_file = str(tmp_path / 'id_rsa.pub')
+    with open(key_file, 'w') as f:
+        f.write('ssh-rsa AAAA me@home')
+
+    key = cache.key(image, 'ssid', 'psk', 'me', 'node-01', key_file)
+
+    assert key == cache.key(image, 'ssid', 'psk', 'me', 'node-01', key_file)
+    assert key != cache.key(image, 'ssid', 'psk', 'me', 'node-02', key_file)
+    assert key != cache.key(
+        image, 'ssid', 'psk', 'me', 'node-01', key_file, grow_on_boot=True)
+
+    _image(tmp_path / 'base.img', b'raspbian, but newer')
+    assert key != cache.key(image, 'ssid', 'psk', 'me', 'node-01', key_file)
+
+
+@mark.unit
+def test_compressed_images_get_fingerprinted(tmp_path):
+    store = ImageStore([str(tmp_path)], catalog=str(tmp_path / 'images.json'))
+    cache = PolishCache(str(tmp_path / 'cache'), store=store)
+    image = _image(tmp_path / 'base.img.xz', b'not really xz')
+
+    fingerprint = cache.fingerprint(image)
+    assert fingerprint == hashlib.sha256(b'not really xz').hexdigest()
+    # Out of the catalog, not hashed again.
+    assert store.by_hash(fingerprint[:12]) == [image]
+    assert PolishCache(
+        str(tmp_path / 'cache'), store=ImageStore(
+            [], catalog=str(tmp_path / 'images.json'))).fingerprint(
+                image) == fingerprint
+
+
+@mark.unit
+def test_put_and_get(tmp_path):
+    cache = PolishCache(str(tmp_path / 'cache'))
+    polished = _image(tmp_path / 'polished.img')
+
+    assert cache.get('abc') is None
+    path = cache.put('abc', polished)
+
+    assert cache.get('abc') == path
+    assert not os.path.exists(polished)
+
+
+@mark.unit
+def test_evicts_least_recently_used(tmp_path):
+    cache = PolishCache(str(tmp_path / 'cache'), max_bytes=10 * 4096)
+    for name in ('old', 'new'):
+        cache.put(name, _image(tmp_path / name, os.urandom(6 * 4096)))
+        time.sleep(0.01)
+
+    assert cache.get('old') is None
+    assert cache.get('new') is not None
+
+
+@mark.unit
+def test_put_from_another_filesystem_stays_sparse(tmp_path, monkeypatch):
+    cache = PolishCache(str(tmp_path / 'cache'))
+    polished = str(tmp_path / 'polished.img')
+    with open(polished, 'wb') as f:
+        f.write(b'boot')
+        f.truncate(64 * 1024 * 1024)
+
+    def rename(source, target):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(cache_module.os, 'rename', rename)
+    path = cache.put('abc', polished)
+
+    assert os.path.getsize(path) == 64 * 1024 * 1024
+    assert os.stat(path).st_blocks * 512 < 1024 * 1024
+    assert not os.path.exists(polished)
+
+
+@mark.unit
+def test_cached_polish_happens_in_the_cache(tmp_path, monkeypatch):
+    cache = PolishCache(str(tmp_path / 'cache'))
+    image = _image(tmp_path / 'base.img')
+    seen = []
+
+    def polish_image(disk_image, ssid, psk, user, hostname, work_dir=None,
+                     grow_on_boot=False):
+        seen.append(work_dir)
+        return _image(os.path.join(
+            tempfile.mkdtemp(dir=work_dir), 'polished.img'))
+
+    def working_copy(image, target):
+        raise AssertionError('should have been a rename')
+
+    monkeypatch.setattr(actions, 'polish_image', polish_image)
+    monkeypatch.setattr(cache_module, 'working_copy', working_copy)
+    path = actions.cached_polish_image(
+        image, 'ssid', 'psk', 'me', 'node-01', cache=cache)
+
+    assert seen == [cache.directory]
+    assert path == cache.path_for(
+        cache.key(image, 'ssid', 'psk', 'me', 'node-01'))
+    assert os.listdir(cache.directory) == [os.path.basename(path)]
+
+
+@mark.unit
+def test_pairs_share_one_cache_and_polish_once(tmp_path, monkeypatch):
+    image = _image(tmp_path / 'base.img')
+    monkeypatch.setattr(cache_module, '_cache', None)
+    monkeypatch.setattr(cache_module, 'PolishCache', lambda: PolishCache(
+        str(tmp_path / 'cache'), store=ImageStore(
+            [], catalog=str(tmp_path / 'images.json'))))
+    polished = []
+
+    def polish_image(disk_image, ssid, psk, user, hostname, work_dir=None,
+                     grow_on_boot=False):
+        polished.append(disk_image)
+        time.sleep(0.1)
+        return _image(os.path.join(
+            tempfile.mkdtemp(dir=work_dir), 'polished.img'))
+
+    monkeypatch.setattr(actions, 'polish_image', polish_image)
+    results = []
+
+    def pair():
+        results.append(actions.cached_polish_image(
+            image, 'ssid', 'psk', 'me', 'node-01'))
+
+    threads = [threading.Thread(target=pair) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert polished == [image]
+    assert results[0] == results[1]
+    assert cache_module.get_polish_cache() is cache_module.get_polish_cache()
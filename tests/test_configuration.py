@@ -0,0 +1,176 @@
+"""Tests for reading config files."""
+import json
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.configuration import is_batch_config
+from raspi_maker.configuration import parse_batch_config
+from raspi_maker.configuration import parse_config
+from raspi_maker.configuration import parse_polish
+from raspi_maker.configuration import parse_run_spec
+
+
+single = '''[devices]
+sd_card=mmcblk0
+thumb_drive=sdb
+'''
+
+batch = '''[batch]
+user=admin
+hostname=node-{n:02d}
+workers=2
+
+[pair.1]
+sd_card=mmcblk0
+thumb_drive=sdb
+
+[pair.7]
+sd_card=sdc
+thumb_drive=sdd
+user=bob
+hostname=special
+
+[wireless]
+ssid=home
+psk=hunter2
+'''
+
+
+def _write(tmp_path, text, name='config.ini'):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+@mark.unit
+def test_parse_config_without_wireless(tmp_path):
+    path = _write(tmp_path, single)
+    assert parse_config(path) == ('mmcblk0', 'sdb', None, None)
+    assert not is_batch_config(path)
+
+
+@mark.unit
+def test_parse_batch_config(tmp_path):
+    path = _write(tmp_path, batch)
+    assert is_batch_config(path)
+
+    pairs, ssid, psk, workers = parse_batch_config(path)
+
+    assert (ssid, psk, workers) == ('home', 'hunter2', 2)
+    assert pairs == [
+        {'n': 1, 'sd_card': 'mmcblk0', 'thumb_drive': 'sdb',
+         'user': 'admin', 'hostname': 'node-01'},
+        {'n': 7, 'sd_card': 'sdc', 'thumb_drive': 'sdd',
+         'user': 'bob', 'hostname': 'special'},
+    ]
+
+
+@mark.unit
+def test_parse_batch_config_rejects_reused_devices(tmp_path):
+    path = _write(tmp_path, batch.replace('thumb_drive=sdd', 'thumb_drive=sdb'))
+    with raises(ValueError):
+        parse_batch_config(path)
+
+
+spec_toml = '''[run]
+image = "/images/lite.img.xz"
+workers = 2
+block_size = "4M"
+verify = true
+wipe = "none"
+
+[polish]
+user = "admin"
+hostname = "node-{n:02d}"
+
+[[pairs]]
+sd_card = "mmcblk0"
+thumb_drive = "sdb"
+
+[[pairs]]
+sd_card = "sdc"
+thumb_drive = "sdd"
+hostname = "the-odd-one"
+'''
+
+
+@mark.unit
+def test_parse_run_spec_toml(tmp_path):
+    spec = parse_run_spec(_write(tmp_path, spec_toml, 'run.toml'))
+
+    assert spec['image'] == '/images/lite.img.xz'
+    assert spec['workers'] == 2
+    assert (spec['ssid'], spec['psk']) == (None, None)
+    assert spec['pairs'] == [
+        {'n': 1, 'sd_card': 'mmcblk0', 'thumb_drive': 'sdb',
+         'user': 'admin', 'hostname': 'node-01'},
+        {'n': 2, 'sd_card': 'sdc', 'thumb_drive': 'sdd',
+         'user': 'admin', 'hostname': 'the-odd-one'},
+    ]
+    assert spec['settings'] == {
+        'full': False, 'verify': True, 'offline_polish': False,
+        'polish_cache': True, 'wipe': None, 'grow_on_boot': False,
+        'block_size': 4 * 1024 * 1024,
+    }
+
+
+@mark.unit
+def test_parse_run_spec_json_matches_toml(tmp_path):
+    spec = {
+        'run': {'image': '/images/lite.img.xz', 'workers': 2,
+                'block_size': 4194304, 'verify': True, 'wipe': 'none'},
+        'polish': {'user': 'admin', 'hostname': 'node-{n:02d}'},
+        'pairs': [
+            {'sd_card': 'mmcblk0', 'thumb_drive': 'sdb'},
+            {'sd_card': 'sdc', 'thumb_drive': 'sdd',
+             'hostname': 'the-odd-one'},
+        ],
+    }
+    path = _write(tmp_path, json.dumps(spec), 'run.json')
+    assert parse_run_spec(path) == parse_run_spec(
+        _write(tmp_path, spec_toml, 'run.toml'))
+
+
+@mark.unit
+def test_parse_run_spec_ini(tmp_path):
+    # A plain config plus [polish] is a spec, and so is a batch one.
+    path = _write(tmp_path, single + '''
+[polish]
+user=admin
+hostname=pi-one
+
+[run]
+full=yes
+block_size=1M
+''')
+    spec = parse_run_spec(path)
+    assert spec['image'] is None
+    assert spec['pairs'] == [
+        {'n': 1, 'sd_card': 'mmcblk0', 'thumb_drive': 'sdb',
+         'user': 'admin', 'hostname': 'pi-one'}]
+    assert spec['settings']['full'] is True
+    assert spec['settings']['block_size'] == 1024 * 1024
+    assert spec['settings']['wipe'] == 'signatures'
+    assert parse_polish(path) == ('admin', 'pi-one')
+
+    spec = parse_run_spec(_write(tmp_path, batch, 'batch.ini'))
+    assert spec['workers'] == 2
+    assert spec['pairs'] == parse_batch_config(
+        _write(tmp_path, batch, 'batch.ini'))[0]
+
+
+@mark.unit
+@mark.parametrize('change', [
+    # Nobody to ask for a hostname.
+    lambda s: s.replace('hostname = "node-{n:02d}"\n', ''),
+    lambda s: s.replace('"sdd"', '"sdb"'),
+    lambda s: s.replace('"4M"', '"5000"'),
+    lambda s: s.replace('"none"', '"shred"'),
+    lambda s: s.replace('verify = true', 'verify = "maybe"'),
+    lambda s: s.replace('verify = true', 'verfiy = true'),
+])
+def test_parse_run_spec_rejects(tmp_path, change):
+    path = _write(tmp_path, change(spec_toml), 'run.toml')
+    with raises(ValueError):
+        parse_run_spec(path)
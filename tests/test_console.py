@@ -0,0 +1,48 @@
+"""Tests for running commands."""
+import time
+
+from pytest import mark
+
+from raspi_maker.console import console
+from raspi_maker.console import interactive_console
+from raspi_maker.console import run
+from raspi_maker.console import run_many
+
+
+@mark.unit
+def test_run_captures_output_and_exit_code():
+    result = run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+    assert result.returncode == 3
+    assert not result.ok
+    assert result.output == 'out\nerr\n'
+
+
+@mark.unit
+def test_run_sends_inputs():
+    assert run(['cat'], inputs=['y', 'n']).output == 'y\nn\n'
+
+
+@mark.unit
+def test_console_returns_output():
+    assert console(['echo', 'hello']) == 'hello\n'
+
+
+@mark.unit
+def test_interactive_console_does_not_sleep():
+    start = time.monotonic()
+    assert interactive_console(['true'], verbose=False)
+    assert time.monotonic() - start < 0.5
+
+
+@mark.unit
+def test_run_many_is_concurrent():
+    start = time.monotonic()
+    results = run_many([['sleep', '0.3']] * 5)
+    assert all(result.ok for result in results)
+    assert time.monotonic() - start < 1.2
+
+
+@mark.unit
+def test_run_many_keeps_order():
+    results = run_many([['echo', str(n)] for n in range(5)], limit=2)
+    assert [r.output for r in results] == ['0\n', '1\n', '2\n', '3\n', '4\n']
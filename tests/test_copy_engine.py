@@ -0,0 +1,261 @@
+"""Tests for the in process copy engine, using files as devices."""
+import errno
+import fcntl
+import hashlib
+import os
+import threading
+
+from pytest import mark
+from pytest import raises
+from pytest import skip
+
+from raspi_maker import copy_engine
+from raspi_maker.blockdev import write_zeros
+from raspi_maker.blockdev import zeroes_cheaply
+from raspi_maker.copy_engine import BufferPool
+from raspi_maker.copy_engine import allocate_buffer
+from raspi_maker.copy_engine import copy_image
+from raspi_maker.copy_engine import copy_range
+from raspi_maker.copy_engine import copy_ranges
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _make_image(path, size):
+    data = os.urandom(size)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+@mark.unit
+def test_copy_image_round_trip(tmp_path):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+
+    # Not a multiple of the block size, and not even sector aligned.
+    data = _make_image(image, 3 * 8192 + 123)
+
+    calls = []
+    stats = copy_image(
+        image, target, block_size=8192, create=True,
+        progress=lambda done, total, rate: calls.append((done, total)))
+
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert stats['bytes'] == len(data)
+    assert len(calls) == 4
+    assert calls[-1] == (len(data), len(data))
+
+
+@mark.unit
+def test_copy_image_overwrites_start_of_bigger_target(tmp_path):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+
+    data = _make_image(image, 4096)
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * 8192)
+
+    copy_image(image, target, block_size=4096)
+
+    with open(target, 'rb') as f:
+        written = f.read()
+    assert written[:4096] == data
+    assert written[4096:] == b'\xff' * 4096
+
+
+@mark.unit
+def test_missing_target_is_not_created(tmp_path):
+    image = str(tmp_path / 'test.img')
+    _make_image(image, 4096)
+    # A typo'd /dev/sdX, as far as the copy is concerned.
+    target = str(tmp_path / 'sdx')
+
+    with raises(FileNotFoundError):
+        copy_image(image, target, block_size=4096)
+    assert not os.path.exists(target)
+
+    copy_image(image, target, block_size=4096, create=True)
+    assert os.path.getsize(target) == 4096
+
+
+@mark.unit
+def test_allocate_buffer_rejects_unaligned_sizes():
+    with raises(ValueError):
+        allocate_buffer(1000)
+    assert len(allocate_buffer(4096)) == 4096
+
+
+@mark.unit
+def test_buffer_pool_hands_buffers_back_across_threads():
+    # Like the helper, every request on its own thread.
+    pool = BufferPool(size=1)
+    seen = []
+
+    def borrow():
+        with pool.buffer(4096) as view:
+            seen.append(view)
+
+    for _ in range(2):
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+    assert seen[0] is seen[1]
+
+    with pool.buffer(4096) as first:
+        with pool.buffer(4096) as second:
+            assert first is not second
+    with pool.buffer(8192) as bigger:
+        assert len(bigger) == 8192
+    # Only the newest is kept.
+    assert pool._idle == [bigger]
+
+
+@mark.unit
+def test_copy_image_sparse_skips_zeros(tmp_path):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+
+    data = os.urandom(4096) + bytes(3 * 4096) + os.urandom(4096)
+    with open(image, 'wb') as f:
+        f.write(data)
+    # Stale junk on the "device" has to read back as zeros afterwards.
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * len(data))
+
+    stats = copy_image(image, target, block_size=4096, sparse=True)
+
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert stats['bytes'] == len(data)
+    assert stats['written'] == 2 * 4096
+
+
+@mark.unit
+@mark.parametrize('offload', [True, False])
+def test_sparse_copies_only_zero_the_gaps(tmp_path, monkeypatch, offload):
+    image = str(tmp_path / 'test.img')
+    target = str(tmp_path / 'device')
+    data = os.urandom(4096) + bytes(3 * 4096) + os.urandom(4096)
+    with open(image, 'wb') as f:
+        f.write(data)
+
+    zeroed = []
+    real_zero_range = copy_engine.zero_range
+
+    def zero_range(fd, offset, length):
+        zeroed.append((offset, length))
+        real_zero_range(fd, offset, length)
+
+    monkeypatch.setattr(copy_engine, 'zero_range', zero_range)
+    # A card that can't zero without writing gets the zeros written out.
+    monkeypatch.setattr(copy_engine, 'zeroes_cheaply', lambda fd: offload)
+
+    for copy in (
+            lambda: copy_image(image, target, block_size=4096, sparse=True),
+            lambda: copy_ranges(image, target, [
+                (0, 4096, _sha256(data[:4096])),
+                (4 * 4096, 5 * 4096, _sha256(data[4 * 4096:]))],
+                block_size=4096)):
+        with open(target, 'wb') as f:
+            f.write(b'\xff' * len(data))
+        del zeroed[:]
+        stats = copy()
+
+        with open(target, 'rb') as f:
+            assert f.read() == data
+        # Just the gap, never the data about to go on top of it.
+        assert stats['zeroed'] == 3 * 4096
+        assert stats['zero_offload'] is offload
+        assert zeroed == ([(4096, 3 * 4096)] if offload else [])
+
+
+@mark.unit
+def test_zeroes_cheaply(tmp_path):
+    with open(str(tmp_path / 'file'), 'wb') as f:
+        assert zeroes_cheaply(f.fileno())
+    with open(os.devnull, 'wb') as f:
+        assert not zeroes_cheaply(f.fileno())
+
+
+@mark.unit
+def test_write_zeros_on_o_direct(tmp_path):
+    path = str(tmp_path / 'device')
+    with open(path, 'wb') as f:
+        f.write(b'\xff' * 3 * 4096)
+    try:
+        fd = os.open(path, os.O_WRONLY | getattr(os, 'O_DIRECT', 0))
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        skip('no O_DIRECT here')
+    try:
+        write_zeros(fd, 0, 4096)
+        # Not whole sectors, like zero_range's tail.
+        write_zeros(fd, 4096, 4096 + 100)
+        assert fcntl.fcntl(fd, fcntl.F_GETFL) & getattr(os, 'O_DIRECT', 0)
+    finally:
+        os.close(fd)
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(2 * 4096 + 100) + b'\xff' * (4096 - 100)
+
+
+@mark.unit
+def test_copy_image_sparse_file_holes(tmp_path):
+    image = str(tmp_path / 'sparse.img')
+    target = str(tmp_path / 'device')
+
+    with open(image, 'wb') as f:
+        f.write(b'boot')
+        f.seek(1024 * 1024)
+        f.write(b'root')
+
+    copy_image(image, target, block_size=4096, sparse=True, create=True)
+
+    with open(image, 'rb') as f:
+        expected = f.read()
+    with open(target, 'rb') as f:
+        assert f.read() == expected
+
+
+@mark.unit
+def test_copy_range(tmp_path):
+    data = os.urandom(3 * 4096 + 100)
+    image = str(tmp_path / 'image.img')
+    with open(image, 'wb') as f:
+        f.write(data)
+    target = str(tmp_path / 'partition.img')
+
+    stats = copy_range(image, target, 4096, 3 * 4096 + 50, block_size=4096,
+                       checksum='abc', create=True)
+    with open(target, 'rb') as f:
+        assert f.read() == data[4096:3 * 4096 + 50]
+    assert stats['bytes'] == 2 * 4096 + 50
+    assert stats['ranges'] == [[0, 2 * 4096 + 50, 'abc']]
+
+    with raises(EOFError):
+        copy_range(image, target, 4096, 8 * 4096)
+
+
+@mark.unit
+def test_copy_range_falls_back(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EINVAL, 'nope')
+
+    monkeypatch.setattr(os, 'copy_file_range', unsupported)
+    monkeypatch.setattr(os, 'sendfile', unsupported)
+
+    data = os.urandom(5 * 4096)
+    image = str(tmp_path / 'image.img')
+    with open(image, 'wb') as f:
+        f.write(data)
+    target = str(tmp_path / 'partition.img')
+
+    stats = copy_range(
+        image, target, 4096, 5 * 4096, block_size=8192, create=True)
+    assert stats['method'] == 'pwrite'
+    with open(target, 'rb') as f:
+        assert f.read() == data[4096:]
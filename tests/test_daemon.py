@@ -0,0 +1,233 @@
+"""Tests for the provisioning daemon, with a runner that only pretends."""
+import os
+import threading
+import time
+
+from pytest import mark
+from pytest import raises
+
+import raspi_maker
+from raspi_maker import debugging
+from raspi_maker.daemon import BusLimits
+from raspi_maker.daemon import ProvisioningDaemon
+from raspi_maker.daemon import request
+from raspi_maker.daemon import provision
+from raspi_maker.daemon import serve
+from raspi_maker.daemon import usb_bus
+
+
+def _job(sd_card, thumb_drive, hostname='node-01'):
+    return {
+        'sd_card': sd_card,
+        'thumb_drive': thumb_drive,
+        'user': 'bob',
+        'hostname': hostname,
+    }
+
+
+def _fake_sys_block(tmp_path, devices):
+    """/sys/class/block style symlinks into a made up device tree."""
+    sys_block = tmp_path / 'block'
+    sys_block.mkdir()
+    for name, location in devices.items():
+        real = tmp_path / 'devices' / location / 'block' / name
+        real.mkdir(parents=True)
+        os.symlink(str(real), str(sys_block / name))
+    return str(sys_block)
+
+
+@mark.unit
+def test_usb_bus(tmp_path):
+    sys_block = _fake_sys_block(tmp_path, {
+        'sdc': 'pci0000:00/usb2/2-1/2-1:1.0/host6',
+        'mmcblk0': 'platform/mmc_host/mmc0',
+    })
+    assert usb_bus('sdc', sys_block) == 'usb2'
+    assert usb_bus('mmcblk0', sys_block) == 'mmcblk0'
+
+
+@mark.unit
+def test_bus_limits():
+    limits = BusLimits(per_bus=1)
+    running = []
+    most = [0]
+    lock = threading.Lock()
+
+    def job():
+        with limits.hold(['usb1', 'usb1']):
+            with lock:
+                running.append(1)
+                most[0] = max(most[0], len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=job) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most[0] == 1
+
+
+@mark.unit
+def test_daemon_runs_jobs_and_refuses_busy_devices(tmp_path):
+    sys_block = _fake_sys_block(tmp_path, {})
+    release = threading.Event()
+    ran = []
+
+    def runner(disk_image, params):
+        release.wait(1)
+        ran.append((disk_image, params['hostname'], params['ssid']))
+        if params['hostname'] == 'broken':
+            raise OSError('card died')
+
+    daemon = ProvisioningDaemon(
+        'image.img', workers=2, defaults={'ssid': 'home'}, runner=runner,
+        sys_block=sys_block)
+    first = daemon.submit(_job('sdc', 'sdd'))
+    with raises(ValueError):
+        daemon.submit(_job('sdd', 'sde'))
+    with raises(ValueError):
+        daemon.submit({'sd_card': 'sdf'})
+    second = daemon.submit(_job('sdf', 'sdg', hostname='broken'))
+
+    release.set()
+    daemon.close()
+    assert first.state == 'done'
+    assert second.state == 'failed'
+    assert second.error == 'card died'
+    assert sorted(ran) == [
+        ('image.img', 'broken', 'home'), ('image.img', 'node-01', 'home')]
+
+    # Devices are free again once their job is over.
+    daemon = ProvisioningDaemon('image.img', runner=runner, sys_block=sys_block)
+    daemon.submit(_job('sdc', 'sdd'))
+    daemon.close()
+
+
+def _serve(daemon, socket_path):
+    server = threading.Thread(
+        target=serve, args=(daemon, socket_path), kwargs={'watch': False})
+    server.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.01)
+    return server
+
+
+def _wait_for(socket_path, job_id):
+    for _ in range(100):
+        status = request({'op': 'status', 'id': job_id}, socket_path)
+        if status['job']['state'] in ('done', 'failed'):
+            break
+        time.sleep(0.01)
+    return status['job']
+
+
+@mark.unit
+def test_daemon_socket(tmp_path):
+    socket_path = str(tmp_path / 'daemon.sock')
+    daemon = ProvisioningDaemon(
+        'image.img', runner=lambda *args: None,
+        sys_block=_fake_sys_block(tmp_path, {}))
+    server = _serve(daemon, socket_path)
+
+    job = request({'op': 'submit', 'job': _job('sdc', 'sdd')}, socket_path)
+    job_id = job['job']['id']
+    for _ in range(100):
+        status = request({'op': 'status', 'id': job_id}, socket_path)
+        if status['job']['state'] == 'done':
+            break
+        time.sleep(0.01)
+    assert status['job']['state'] == 'done'
+    assert 'error' in request({'op': 'status', 'id': 99}, socket_path)
+    assert 'error' in request(
+        {'op': 'submit', 'job': _job('sda', 'sdd')}, socket_path)
+    assert len(request({'op': 'list'}, socket_path)['jobs']) == 1
+
+    assert request({'op': 'shutdown'}, socket_path) == {'ok': True}
+    server.join(2)
+    assert not server.is_alive()
+    assert not os.path.exists(socket_path)
+
+
+@mark.unit
+def test_failing_action_fails_the_job_without_a_prompt(tmp_path, monkeypatch):
+    prompted = []
+    monkeypatch.setattr(
+        debugging.pdb, 'set_trace', lambda: prompted.append(True))
+
+    @debugging.PromptOnError
+    def runner(disk_image, params):
+        raise OSError('card died')
+
+    socket_path = str(tmp_path / 'daemon.sock')
+    daemon = ProvisioningDaemon(
+        'image.img', runner=runner, sys_block=_fake_sys_block(tmp_path, {}))
+    server = _serve(daemon, socket_path)
+
+    job = request({'op': 'submit', 'job': _job('sdc', 'sdd')}, socket_path)
+    job = _wait_for(socket_path, job['job']['id'])
+    request({'op': 'shutdown'}, socket_path)
+    server.join(2)
+
+    assert job['state'] == 'failed'
+    assert job['error'] == 'card died'
+    assert not prompted
+    assert debugging.PromptOnError.interactive
+
+
+@mark.unit
+def test_daemon_forgets_old_jobs(tmp_path):
+    daemon = ProvisioningDaemon(
+        'image.img', runner=lambda *args: None, keep_finished=2,
+        sys_block=_fake_sys_block(tmp_path, {}))
+    for n in range(5):
+        daemon.submit(_job('sd{0}'.format(n), 'thumb{0}'.format(n)))
+    daemon.close()
+    assert sorted(daemon.jobs) == [4, 5]
+
+
+@mark.unit
+def test_reading_jobs_waits_for_forgetting_them(tmp_path):
+    daemon = ProvisioningDaemon(
+        'image.img', runner=lambda *args: None, keep_finished=2,
+        sys_block=_fake_sys_block(tmp_path, {}))
+    for n in range(3):
+        daemon.submit(_job('sd{0}'.format(n), 'thumb{0}'.format(n)))
+    daemon.close()
+
+    responses = []
+    readers = [
+        threading.Thread(target=lambda request=request: responses.append(
+            daemon.handle(request)))
+        for request in ({'op': 'list'}, {'op': 'status', 'id': 3})]
+    # As if a worker were in the middle of _forget_old_jobs.
+    with daemon._lock:
+        for reader in readers:
+            reader.start()
+            reader.join(0.1)
+            assert reader.is_alive()
+    for reader in readers:
+        reader.join()
+    assert all('error' not in response for response in responses)
+
+
+@mark.unit
+def test_provision_passes_everything_on(monkeypatch):
+    seen = {}
+
+    class Pipeline(object):
+        def run(self):
+            pass
+
+    def build_pipeline(*args, **kwargs):
+        seen.update(kwargs)
+        return Pipeline()
+
+    monkeypatch.setattr(raspi_maker, 'build_pipeline', build_pipeline)
+    monkeypatch.setattr('raspi_maker.device.Device', lambda blk_id: blk_id)
+    provision('image.img', dict(_job('sdc', 'sdd'), block_size=4194304))
+    assert seen['block_size'] == 4194304
@@ -0,0 +1,83 @@
+"""Tests for streaming compressed images."""
+import gzip
+import lzma
+import os
+import zipfile
+
+from pytest import mark
+
+from raspi_maker.copy_engine import copy_stream
+from raspi_maker.decompress import DecompressingReader
+from raspi_maker.decompress import decompress_range
+from raspi_maker.decompress import is_compressed
+
+
+def _data():
+    return os.urandom(3 * 4096) + bytes(5 * 4096) + os.urandom(100)
+
+
+@mark.unit
+def test_is_compressed():
+    assert is_compressed('raspios.img.xz')
+    assert is_compressed('raspios.zip')
+    assert not is_compressed('raspios.img')
+
+
+@mark.unit
+def test_reader_chunks_reassemble(tmp_path):
+    data = _data()
+    path = str(tmp_path / 'test.img.xz')
+    with lzma.open(path, 'wb') as f:
+        f.write(data)
+
+    with DecompressingReader(path, block_size=4096, depth=2) as reader:
+        chunks = [bytes(chunk) for chunk in reader]
+
+    assert b''.join(chunks) == data
+    assert all(len(chunk) == 4096 for chunk in chunks[:-1])
+
+
+@mark.unit
+def test_copy_stream_gz_sparse(tmp_path):
+    data = _data()
+    path = str(tmp_path / 'test.img.gz')
+    with gzip.open(path, 'wb') as f:
+        f.write(data)
+    target = str(tmp_path / 'device')
+    with open(target, 'wb') as f:
+        f.write(b'\xff' * len(data))
+
+    with DecompressingReader(path, block_size=4096) as reader:
+        stats = copy_stream(reader, target, sparse=True, block_size=4096)
+
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert stats['bytes'] == len(data)
+    assert stats['written'] == len(data) - 5 * 4096
+
+
+@mark.unit
+def test_zip_size_is_known(tmp_path):
+    data = _data()
+    path = str(tmp_path / 'test.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('test.img', data)
+
+    with DecompressingReader(path, block_size=4096) as reader:
+        assert reader.size == len(data)
+        assert b''.join(bytes(chunk) for chunk in reader) == data
+
+
+@mark.unit
+def test_decompress_range(tmp_path):
+    data = os.urandom(10 * 4096)
+    image = str(tmp_path / 'image.img.gz')
+    with gzip.open(image, 'wb') as f:
+        f.write(data)
+    target = str(tmp_path / 'partition.img')
+
+    stats = decompress_range(
+        image, target, 4096 + 7, 9 * 4096, block_size=8192, create=True)
+    with open(target, 'rb') as f:
+        assert f.read() == data[4096 + 7:9 * 4096]
+    assert stats['bytes'] == 8 * 4096 - 7
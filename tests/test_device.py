@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Tests for the old block devices."""
 
+import json
 import os
 from pytest import mark
 
@@ -14,7 +15,9 @@ from raspi_maker.device import _get_vendor
 from raspi_maker.device import _partition_details
 from raspi_maker.device import _device_partitions
 from raspi_maker.device import _get_partitions
+from raspi_maker.device import _parse_mountinfo
 from raspi_maker.device import Device
+from raspi_maker.device import DeviceInventory
 
 
 @mark.unit
@@ -82,21 +85,50 @@ Number  Start    End       Size      Type     File system  Flags
     assert None == _partition_details(sample_input, 2)['Flags']
 
 
-lsblk_example = '''NAME                    MAJ:MIN RM   SIZE RO TYPE  MOUNTPOINT
-sda                       8:0    0 931.5G  0 disk  
-├─sda1                    8:1    0   512M  0 part  /boot/efi
-├─sda2                    8:2    0   488M  0 part  /boot
-└─sda3                    8:3    0 930.5G  0 part  
-  └─sda3_crypt          252:0    0 930.5G  0 crypt 
-    ├─ubuntu--vg-root   252:1    0 898.7G  0 lvm   /
-    └─ubuntu--vg-swap_1 252:2    0  31.9G  0 lvm   [SWAP]
-sdc                       8:32   1  14.9G  0 disk  
-├─sdc1                    8:33   1    63M  0 part  
-└─sdc2                    8:34   1     4G  0 part  
-sr0                      11:0    1  1024M  0 rom   
-mmcblk0                 179:0    0    29G  0 disk  
-└─mmcblk0p1             179:1    0    63M  0 part  
-'''
+def _disk(name, size, children=(), vendor=None, model=None):
+    return {
+        'name': name, 'path': '/dev/' + name, 'size': size, 'type': 'disk',
+        'mountpoint': None, 'partuuid': None, 'vendor': vendor,
+        'model': model, 'children': list(children)}
+
+
+def _part(name, size, partuuid=None, type='part', mountpoint=None,
+          children=()):
+    entry = {
+        'name': name, 'path': '/dev/' + name, 'size': size, 'type': type,
+        'mountpoint': mountpoint, 'partuuid': partuuid, 'vendor': None,
+        'model': None}
+    if children:
+        entry['children'] = list(children)
+    return entry
+
+
+lsblk_example = json.dumps({'blockdevices': [
+    _disk('sda', 1000204886016, [
+        _part('sda1', 536870912, mountpoint='/boot/efi'),
+        _part('sda2', 511705088, mountpoint='/boot'),
+        _part('sda3', 999156400128, children=[
+            _part('sda3_crypt', 999154302976, type='crypt', children=[
+                _part('ubuntu--vg-root', 964966170624, type='lvm',
+                      mountpoint='/'),
+            ]),
+        ]),
+    ], vendor='ATA     ', model='Samsung SSD'),
+    _disk('sdc', 16008609792, [
+        _part('sdc1', 66060288, partuuid='6c586e13-01'),
+        _part('sdc2', 4294967296, partuuid='6c586e13-02'),
+    ], vendor='SanDisk ', model='Cruzer Fit'),
+    {'name': 'sr0', 'path': '/dev/sr0', 'size': 1073741312, 'type': 'rom',
+     'mountpoint': None, 'partuuid': None, 'vendor': None, 'model': None},
+    _disk('mmcblk0', 31104958464, [_part('mmcblk0p1', 66060288)]),
+]})
+
+mountinfo_example = """23 28 0:22 / /proc rw,relatime - proc proc rw
+28 1 8:3 / / rw,relatime - ext4 /dev/mapper/ubuntu--vg-root rw
+40 28 8:1 / /boot/efi rw,relatime - vfat /dev/sda1 rw
+41 28 8:33 / /media/pi/boot\\040disk rw,relatime shared:1 - vfat /dev/sdc1 rw
+42 28 8:33 / /mnt rw,relatime - vfat /dev/sdc1 rw
+"""
 
 
 @mark.unit
@@ -114,6 +146,42 @@ def test__get_partitions_fancy():
     assert _get_partitions(lsblk_example, 'mmcblk0', full_paths=True) == ['/dev/mmcblk0p1']
 
 
+@mark.unit
+def test__parse_mountinfo():
+    mounts = _parse_mountinfo(mountinfo_example)
+    assert mounts['/dev/sdc1'] == ['/media/pi/boot disk', '/mnt']
+    assert mounts['/dev/sda1'] == ['/boot/efi']
+
+
+@mark.unit
+def test_inventory_lookups():
+    inventory = DeviceInventory(lsblk_example, mountinfo_example)
+    assert inventory.disks() == ['mmcblk0', 'sda', 'sdc']
+    assert inventory.lookup('sdc2') is inventory.lookup('/dev/sdc2')
+    assert inventory.lookup('6c586e13-02')['name'] == 'sdc2'
+    assert inventory.lookup('sdc2')['parent'] == 'sdc'
+    assert inventory.lookup('nope') is None
+    assert inventory.partitions('sda') == ['sda1', 'sda2', 'sda3']
+    assert inventory.mounts('sdc1') == ['/media/pi/boot disk', '/mnt']
+    assert inventory.mounts('sdc2') == []
+
+
+@mark.unit
+def test_inventory_snapshots_once_until_invalidated():
+    inventory = DeviceInventory(lsblk_example, mountinfo_example)
+    device = Device('sdc', inventory=inventory)
+    assert device.vendor == 'SanDisk'
+    assert device.model == 'Cruzer Fit'
+    assert device.hr_size == '14GB'
+    assert device.mount_points == ['/media/pi/boot disk', '/mnt']
+    assert device.partitions(full_paths=True) == ['/dev/sdc1', '/dev/sdc2']
+    assert inventory.snapshots == 1
+
+    device.invalidate()
+    assert device.partitions() == ['sdc1', 'sdc2']
+    assert inventory.snapshots == 2
+
+
 @mark.functional
 def test_get_devices():
     assert get_devices(), 'Cant find any devices, maybe this is broke.'
@@ -168,4 +236,18 @@ def test__device_partitions():
 
 @mark.functional
 def test__get_lsblk_output():
-    assert _get_lsblk_output()
\ No newline at end of file
+    assert _get_lsblk_output()
+
+@mark.unit
+def test_inventory_refresh_swaps_whole_snapshots():
+    inventory = DeviceInventory(lsblk_example, mountinfo_example)
+    before = inventory._fresh()
+    inventory._lsblk_output = json.dumps({'blockdevices': []})
+    inventory.invalidate()
+
+    after = inventory._fresh()
+    assert after is not before
+    # Whoever was still reading the old one sees all of it, unchanged.
+    assert before.children['sdc'] == ['sdc1', 'sdc2']
+    assert before.by_name['sdc1']['parent'] == 'sdc'
+    assert inventory.partitions('sdc') == []
@@ -0,0 +1,129 @@
+"""Tests for declarative file edits, against a made up root filesystem."""
+import os
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.actions import boot_commands_plan
+from raspi_maker.actions import polish_plan
+from raspi_maker.edits import EditPlan
+from raspi_maker.edits import apply_plan
+
+
+def _write(root, path, text):
+    full = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, 'w') as f:
+        f.write(text)
+
+
+def _read(root, path):
+    with open(os.path.join(root, path)) as f:
+        return f.read()
+
+
+@mark.unit
+def test_substitute_is_sed_like(tmp_path):
+    root = str(tmp_path)
+    _write(root, 'etc/passwd', 'pi:x:1000:1000::/home/pi:/bin/bash\nroot:x:0\n')
+
+    plan = EditPlan(root)
+    plan.substitute('etc/passwd', 'pi', 'bob')
+    apply_plan(plan.to_dict())
+
+    assert _read(root, 'etc/passwd') == (
+        'bob:x:1000:1000::/home/pi:/bin/bash\nroot:x:0\n')
+
+
+@mark.unit
+def test_edits_to_a_file_are_grouped(tmp_path):
+    plan = EditPlan(str(tmp_path))
+    plan.substitute('etc/hosts', 'a', 'b')
+    plan.mkdir('home')
+    plan.append('etc/hosts', 'more\n')
+
+    assert [op['op'] for op in plan.ops] == ['edit', 'mkdir']
+    assert len(plan.ops[0]['edits']) == 2
+
+
+@mark.unit
+def test_plan_cannot_escape_root(tmp_path):
+    plan = EditPlan(str(tmp_path / 'mnt'))
+    plan.write('../outside', 'nope')
+    with raises(ValueError):
+        apply_plan(plan.to_dict())
+
+
+@mark.unit
+def test_boot_commands_plan(tmp_path):
+    root = str(tmp_path)
+    _write(root, 'cmdline.txt', (
+        'console=tty1 root=PARTUUID=abcd-02 rootfstype=ext4 '
+        'init=/usr/lib/raspi-config/init_resize.sh quiet\n'))
+
+    apply_plan(boot_commands_plan(root).to_dict())
+
+    assert _read(root, 'cmdline.txt') == (
+        'console=tty1 root=/dev/sda2 rootfstype=ext4 quiet\n')
+
+
+@mark.unit
+@mark.skipif(os.geteuid() != 0, reason='chowns to uid 1000')
+def test_polish_plan(tmp_path):
+    root = str(tmp_path / 'root')
+    key = str(tmp_path / 'id_rsa.pub')
+    with open(key, 'w') as f:
+        f.write('ssh-rsa AAAA me@home\n')
+
+    _write(root, 'etc/passwd', 'pi:x:1000:1000:,,,:/home/pi:/bin/bash\n')
+    _write(root, 'etc/group', 'pi:x:1000:\nsudo:x:27:pi\n')
+    _write(root, 'etc/hosts', '127.0.1.1\traspberrypi raspberrypi.local\n')
+    _write(root, 'etc/hostname', 'raspberrypi\n')
+    _write(root, 'etc/fstab', 'PARTUUID=abcd-01 /boot\nPARTUUID=abcd-02 /\n')
+    _write(root, 'etc/wpa_supplicant/wpa_supplicant.conf', 'country=US\n')
+    _write(root, 'home/pi/.bashrc', '')
+    os.makedirs(os.path.join(root, 'etc/systemd/system/multi-user.target.wants'))
+
+    plan = polish_plan(
+        root, 'home', 'hunter2', 'bob', 'node-01', key, grow_on_boot=True)
+    apply_plan(plan.to_dict())
+
+    assert _read(root, 'etc/passwd') == (
+        'bob:x:1000:1000:,,,:/home/bob:/bin/bash\n')
+    assert _read(root, 'etc/group') == 'bob:x:1000:\nsudo:x:27:bob\n'
+    assert _read(root, 'etc/hosts') == '127.0.1.1\tnode-01 node-01.local\n'
+    assert _read(root, 'etc/fstab') == '/dev/mmcblk0p1 /boot\n/dev/sda2 /\n'
+    assert 'ssid="home"' in _read(root, 'etc/wpa_supplicant/wpa_supplicant.conf')
+    assert _read(root, 'home/bob/.ssh/authorized_keys') == 'ssh-rsa AAAA me@home\n'
+    assert os.readlink(os.path.join(
+        root, 'etc/systemd/system/multi-user.target.wants/ssh.service')) == (
+            '/lib/systemd/system/ssh.service')
+    assert 'resize2fs /dev/sda2' in _read(
+        root, 'etc/systemd/system/raspi-maker-grow-root.service')
+    assert os.path.lexists(os.path.join(
+        root, 'etc/systemd/system/multi-user.target.wants/'
+        'raspi-maker-grow-root.service'))
+
+
+@mark.unit
+def test_polish_plan_only_grows_on_boot_when_asked(tmp_path):
+    unit = 'etc/systemd/system/raspi-maker-grow-root.service'
+    wants = ('etc/systemd/system/multi-user.target.wants/'
+             'raspi-maker-grow-root.service')
+    key = str(tmp_path / 'id_rsa.pub')
+
+    def paths(grow_on_boot):
+        plan = polish_plan(
+            str(tmp_path), 'home', 'hunter2', 'bob', 'node-01', key,
+            grow_on_boot=grow_on_boot)
+        return dict((op['path'], op) for op in plan.ops)
+
+    ops = paths(grow_on_boot=False)
+    assert unit not in ops
+    assert wants not in ops
+    # Everything else still happens.
+    assert 'etc/systemd/system/multi-user.target.wants/ssh.service' in ops
+
+    ops = paths(grow_on_boot=True)
+    assert 'resize2fs /dev/sda2' in ops[unit]['text']
+    assert ops[wants]['target'] == '/' + unit
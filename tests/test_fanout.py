@@ -0,0 +1,88 @@
+"""Tests for writing one image to many targets."""
+import lzma
+import os
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.bmap import get_bmap
+from raspi_maker.errors import ChecksumMismatch
+from raspi_maker.fanout import fan_out
+
+
+MiB = 1024 * 1024
+
+
+def _make_image(path):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(8192))
+        f.seek(2 * MiB)
+        f.write(os.urandom(3 * 4096 + 17))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@mark.unit
+def test_fan_out_full_copy(tmp_path):
+    image = str(tmp_path / 'test.img')
+    data = _make_image(image)
+    targets = [str(tmp_path / 'sd{0}'.format(i)) for i in range(3)]
+
+    calls = []
+    stats = fan_out(
+        image, targets, block_size=4096, depth=2, create=True,
+        progress=lambda *args: calls.append(args))
+
+    for target in targets:
+        with open(target, 'rb') as f:
+            assert f.read() == data
+        assert stats[target]['error'] is None
+        assert stats[target]['bytes'] == len(data)
+    assert set(call[0] for call in calls) == set(targets)
+
+
+@mark.unit
+def test_fan_out_block_map(tmp_path):
+    image = str(tmp_path / 'test.img')
+    data = _make_image(image)
+    targets = [str(tmp_path / 'sd{0}'.format(i)) for i in range(2)]
+    for target in targets:
+        with open(target, 'wb') as f:
+            f.write(b'\xff' * len(data))
+
+    bmap = get_bmap(image)
+    stats = fan_out(image, targets, ranges=bmap['ranges'], block_size=MiB)
+
+    for target in targets:
+        with open(target, 'rb') as f:
+            assert f.read() == data
+        assert stats[target]['written'] == bmap['mapped_bytes']
+        assert stats[target]['bytes'] == len(data)
+
+
+@mark.unit
+def test_fan_out_bad_checksum(tmp_path):
+    image = str(tmp_path / 'test.img')
+    _make_image(image)
+
+    with raises(ChecksumMismatch):
+        fan_out(image, [str(tmp_path / 'sd')], ranges=[[0, 4096, 'nope']])
+
+
+@mark.unit
+def test_fan_out_compressed_with_a_dead_target(tmp_path):
+    data = os.urandom(5 * 4096) + bytes(4096)
+    image = str(tmp_path / 'test.img.xz')
+    with lzma.open(image, 'wb') as f:
+        f.write(data)
+    good = str(tmp_path / 'good')
+    dead = str(tmp_path / 'no_such_dir' / 'dead')
+
+    # Even asked to, there's no creating a file in a missing directory.
+    stats = fan_out(image, [good, dead], sparse=True, block_size=4096,
+                    depth=2, create=True)
+
+    with open(good, 'rb') as f:
+        assert f.read() == data
+    assert stats[good]['error'] is None
+    assert stats[dead]['error']
@@ -0,0 +1,87 @@
+"""Tests for hotplug events, with made up devices."""
+import os
+import time
+from queue import Queue
+
+from pytest import mark
+
+from raspi_maker.hotplug import DeviceEvent
+from raspi_maker.hotplug import InotifySource
+from raspi_maker.hotplug import SimulatedSource
+from raspi_maker.hotplug import Watcher
+from raspi_maker.hotplug import parse_uevent
+
+
+@mark.unit
+def test_parse_uevent():
+    data = (
+        b'add@/devices/usb1/1-1/host6/block/sdc\0ACTION=add\0'
+        b'DEVPATH=/devices/usb1/1-1/host6/block/sdc\0SUBSYSTEM=block\0'
+        b'MAJOR=8\0MINOR=32\0DEVNAME=sdc\0DEVTYPE=disk\0SEQNUM=4242\0')
+    assert parse_uevent(data) == DeviceEvent('add', 'sdc', 'disk')
+
+
+@mark.unit
+def test_parse_uevent_ignores_the_rest():
+    assert parse_uevent(b'libudev\0\xfe\xed\xca\xfe') is None
+    assert parse_uevent(
+        b'add@/devices/usb1\0ACTION=add\0SUBSYSTEM=usb\0DEVNAME=bus/usb/001'
+    ) is None
+    assert parse_uevent(
+        b'change@/block/sdc\0ACTION=change\0SUBSYSTEM=block\0DEVNAME=sdc'
+    ) is None
+
+
+@mark.unit
+def test_watcher_delivers_simulated_events():
+    received = Queue()
+    source = SimulatedSource()
+    with Watcher(received.put, source=source):
+        start = time.monotonic()
+        source.emit('add', 'sdc')
+        source.emit('add', 'sdc1', devtype='partition')
+        source.emit('remove', 'sdc')
+        assert received.get(timeout=1) == DeviceEvent('add', 'sdc', 'disk')
+        assert time.monotonic() - start < 0.1
+        assert received.get(timeout=1) == DeviceEvent('remove', 'sdc', 'disk')
+    assert received.empty()
+
+
+@mark.unit
+def test_watcher_survives_a_bad_callback():
+    received = Queue()
+
+    def callback(event):
+        if event.name == 'sdc':
+            raise ValueError('nope')
+        received.put(event)
+
+    source = SimulatedSource()
+    with Watcher(callback, source=source):
+        source.emit('add', 'sdc')
+        source.emit('add', 'sdd')
+        assert received.get(timeout=1).name == 'sdd'
+
+
+@mark.unit
+def test_inotify_source(tmp_path):
+    dev_dir = tmp_path / 'dev'
+    sys_block = tmp_path / 'block'
+    dev_dir.mkdir()
+    sys_block.mkdir()
+
+    received = Queue()
+    with Watcher(received.put, source=InotifySource(str(dev_dir), str(sys_block)),
+                 devtypes=None):
+        (dev_dir / 'tty9').touch()
+        os.makedirs(str(sys_block / 'sdq'))
+        (dev_dir / 'sdq').touch()
+        os.makedirs(str(sys_block / 'sdq1'))
+        (sys_block / 'sdq1' / 'partition').touch()
+        (dev_dir / 'sdq1').touch()
+        os.remove(str(dev_dir / 'sdq'))
+
+        assert received.get(timeout=1) == DeviceEvent('add', 'sdq', 'disk')
+        assert received.get(timeout=1) == DeviceEvent(
+            'add', 'sdq1', 'partition')
+        assert received.get(timeout=1) == DeviceEvent('remove', 'sdq', 'disk')
@@ -0,0 +1,156 @@
+"""Tests for the image store and its catalog."""
+import gzip
+import os
+import shutil
+import subprocess
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.image_handlers import check_image
+from raspi_maker import image_handlers
+from raspi_maker import image_store
+from raspi_maker.image_store import ImageStore
+from raspi_maker.image_store import is_image
+from raspi_maker.partition_table import write_layout
+
+
+MiB = 1024 * 1024
+
+OS_RELEASE = 'PRETTY_NAME="Raspbian GNU/Linux 11 (bullseye)"\nID=raspbian\n'
+
+has_e2fsprogs = bool(shutil.which('mkfs.ext4') and shutil.which('debugfs'))
+
+
+def _make_image(path, tmp_path):
+    """A boot partition of noise, and an ext4 root with an os-release."""
+    tree = tmp_path / 'tree'
+    (tree / 'usr' / 'lib').mkdir(parents=True, exist_ok=True)
+    (tree / 'usr' / 'lib' / 'os-release').write_text(OS_RELEASE)
+    root = str(tmp_path / 'root.fs')
+    with open(root, 'wb') as f:
+        f.truncate(8 * MiB)
+    subprocess.check_call(
+        ['mkfs.ext4', '-q', '-F', '-d', str(tree), root])
+
+    with open(path, 'wb') as f:
+        f.truncate(10 * MiB)
+    write_layout(path, [
+        {'number': 1, 'start': MiB, 'end': 2 * MiB, 'type': '0c'},
+        {'number': 2, 'start': 2 * MiB, 'end': None, 'type': '83'},
+    ], type='mbr')
+    with open(path, 'r+b') as f, open(root, 'rb') as fs:
+        f.seek(MiB)
+        f.write(os.urandom(MiB))
+        f.write(fs.read())
+    return path
+
+
+def _blank_image(path):
+    with open(path, 'wb') as f:
+        f.truncate(2 * MiB)
+    write_layout(path, [
+        {'number': 1, 'start': MiB, 'end': None, 'type': '83'}], type='mbr')
+    return path
+
+
+@mark.unit
+def test_is_image():
+    assert is_image('raspios.img')
+    assert is_image('raspios.img.xz')
+    assert is_image('raspios.zip')
+    assert not is_image('raspios.img.bmap.json')
+    assert not is_image('raspios.img.manifest.json')
+    assert not is_image('notes.txt')
+
+
+@mark.unit
+@mark.skipif(not has_e2fsprogs, reason='needs mkfs.ext4 and debugfs')
+def test_catalog(tmp_path, capsys):
+    documents = tmp_path / 'documents'
+    downloads = tmp_path / 'downloads'
+    documents.mkdir()
+    downloads.mkdir()
+    raw = _make_image(str(documents / 'pi.img'), tmp_path)
+    with open(raw, 'rb') as f, gzip.open(raw + '.gz', 'wb') as out:
+        out.write(f.read())
+    copy = str(downloads / 'renamed.img')
+    shutil.copyfile(raw, copy)
+    catalog = str(tmp_path / 'images.json')
+
+    store = ImageStore([str(documents), str(downloads)], catalog=catalog)
+    assert sorted(store.refresh()) == sorted([raw, raw + '.gz', copy])
+    assert store.refresh() == []
+
+    # Names and paths don't need anything read.
+    assert store.resolve('renamed.img') == copy
+    assert store.resolve(raw) == raw
+    assert store.resolve('nope.img') is None
+    assert all(entry['sha256'] is None for entry in store.images.values())
+
+    # Same bytes, same image, wherever it is and whatever it's called.
+    digest = store.sha256(raw)
+    assert store.by_hash(digest[:12]) == [raw, copy]
+    assert store.resolve(digest[:12]) == raw
+    assert store.duplicates() == [[raw, copy]]
+    assert store.images[raw]['partitions'] is None
+    with raises(ValueError):
+        store.by_hash('abc')
+    with raises(ValueError):
+        store.by_hash('not-a-hash')
+
+    store.print_catalog()
+    assert '(same as {0})'.format(raw) in capsys.readouterr().out
+    entry = store.images[raw]
+    assert entry['error'] is None
+    assert entry['partition_table']['type'] == 'mbr'
+    assert [p['number'] for p in entry['partitions']] == [1, 2]
+    assert entry['os_release']['ID'] == 'raspbian'
+    compressed = store.images[raw + '.gz']
+    assert compressed['compressed']
+    assert compressed['partitions'] == entry['partitions']
+    assert compressed['os_release'] is None
+    # Nothing left next to the images.
+    assert sorted(os.listdir(str(documents))) == ['pi.img', 'pi.img.gz']
+
+    # Straight out of the catalog next time.
+    again = ImageStore([str(documents), str(downloads)], catalog=catalog)
+    assert again.refresh() == []
+    assert again.images[raw] == entry
+
+    with open(copy, 'ab') as f:
+        f.write(b'more')
+    os.remove(raw + '.gz')
+    assert store.refresh() == [copy]
+    assert raw + '.gz' not in store.images
+    assert store.duplicates() == []
+
+
+@mark.unit
+def test_check_image_prefers_raw(tmp_path, monkeypatch):
+    name = '2022-04-04-raspios-bullseye-arm64-lite.img'
+    monkeypatch.setattr(image_handlers, 'IMAGE_NAME', name)
+
+    def never(*args):
+        raise AssertionError('finding an image by name reads nothing')
+    monkeypatch.setattr(image_store, 'hash_file', never)
+    monkeypatch.setattr(image_store, 'read_layout', never)
+
+    raw = _blank_image(str(tmp_path / 'staging.img'))
+    with open(raw, 'rb') as f, gzip.open(
+            str(tmp_path / (name + '.gz')), 'wb') as out:
+        out.write(f.read())
+    store = ImageStore([str(tmp_path)], catalog=str(tmp_path / 'c.json'))
+
+    assert check_image(store) == str(tmp_path / (name + '.gz'))
+
+    os.rename(raw, str(tmp_path / name))
+    assert check_image(store) == str(tmp_path / name)
+
+    # Found by name, whatever's in it, same as ever.
+    with open(str(tmp_path / name), 'wb') as f:
+        f.truncate(MiB)
+    assert check_image(store) == str(tmp_path / name)
+    os.remove(str(tmp_path / name))
+    os.remove(str(tmp_path / (name + '.gz')))
+    assert check_image(store) is False
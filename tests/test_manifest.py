@@ -0,0 +1,71 @@
+"""Tests for image manifests."""
+import gzip
+import hashlib
+import os
+import struct
+
+from pytest import mark
+
+from raspi_maker.manifest import get_manifest
+from raspi_maker.manifest import load_manifest
+from raspi_maker.manifest import manifest_path
+from raspi_maker.manifest import partition
+
+
+MiB = 1024 * 1024
+
+
+def _make_image(path):
+    """1MiB of MBR and gap, then a 1MiB and a 2MiB partition."""
+    boot = os.urandom(MiB)
+    root = os.urandom(2 * MiB)
+    head = bytearray(MiB)
+    struct.pack_into('<I', head, 440, 0xdeadbeef)
+    struct.pack_into('<B3sB3sII', head, 446, 0, bytes(3), 0x0c, bytes(3),
+                     2048, 2048)
+    struct.pack_into('<B3sB3sII', head, 462, 0, bytes(3), 0x83, bytes(3),
+                     4096, 4096)
+    head[510:512] = b'\x55\xaa'
+    with open(path, 'wb') as f:
+        f.write(bytes(head) + boot + root)
+    return boot, root
+
+
+@mark.unit
+def test_manifest(tmp_path):
+    image = str(tmp_path / 'test.img')
+    boot, root = _make_image(image)
+
+    manifest = get_manifest(image)
+
+    assert manifest['partition_table']['type'] == 'mbr'
+    assert partition(manifest, 1)['start'] == MiB
+    assert partition(manifest, 1)['end'] == 2 * MiB
+    assert partition(manifest, 1)['sha256'] == hashlib.sha256(boot).hexdigest()
+    assert partition(manifest, 2)['sha256'] == hashlib.sha256(root).hexdigest()
+    assert partition(manifest, 2)['uuid'] == 'deadbeef-02'
+    assert load_manifest(image) == manifest
+    assert os.path.exists(manifest_path(image))
+
+
+@mark.unit
+def test_manifest_goes_stale(tmp_path):
+    image = str(tmp_path / 'test.img')
+    _make_image(image)
+    get_manifest(image)
+
+    with open(image, 'ab') as f:
+        f.write(b'more')
+    assert load_manifest(image) is None
+
+
+@mark.unit
+def test_manifest_of_compressed_image(tmp_path):
+    image = str(tmp_path / 'test.img')
+    boot, root = _make_image(image)
+    with open(image, 'rb') as f, gzip.open(image + '.gz', 'wb') as out:
+        out.write(f.read())
+
+    manifest = get_manifest(image + '.gz')
+    assert partition(manifest, 1)['sha256'] == hashlib.sha256(boot).hexdigest()
+    assert partition(manifest, 2)['sha256'] == hashlib.sha256(root).hexdigest()
@@ -0,0 +1,185 @@
+"""Tests for reading partition tables, off hand built disk heads, and
+writing them to image files."""
+import struct
+import uuid
+import zlib
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.partition_table import HEAD_BYTES
+from raspi_maker.partition_table import parse_partition_table
+from raspi_maker.partition_table import read_partition_table
+from raspi_maker.partition_table import sectors
+from raspi_maker.partition_table import write_layout
+
+MiB = 1024 * 1024
+LINUX = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+
+
+def _mbr(entries, disk_id=0x6c586e13):
+    """entries are (status, type, first sector, sector count)."""
+    head = bytearray(HEAD_BYTES)
+    struct.pack_into('<I', head, 440, disk_id)
+    for index, (status, kind, first, count) in enumerate(entries):
+        struct.pack_into(
+            '<B3sB3sII', head, 446 + 16 * index,
+            status, bytes(3), kind, bytes(3), first, count)
+    head[510:512] = b'\x55\xaa'
+    return head
+
+
+def _gpt(entries, disk_guid):
+    """entries are (type guid, partition guid, first, last, name)."""
+    head = _mbr([(0, 0xee, 1, 0xffffffff)])
+    struct.pack_into(
+        '<8sIIIIQQQQ16sQIII', head, 512,
+        b'EFI PART', 0x10000, 92, 0, 0, 1, 0, 34, 0,
+        disk_guid.bytes_le, 2, 128, 128, 0)
+    for index, (type_guid, part_guid, first, last, name) in enumerate(entries):
+        struct.pack_into(
+            '<16s16sQQQ72s', head, 1024 + 128 * index,
+            type_guid.bytes_le, part_guid.bytes_le, first, last, 0,
+            name.encode('utf-16-le'))
+    return head
+
+
+@mark.unit
+def test_parse_mbr():
+    head = _mbr([(0x80, 0x0c, 8192, 524288), (0, 0x83, 532480, 3620864)])
+    table = parse_partition_table(head)
+
+    assert table['type'] == 'mbr'
+    assert table['disk_id'] == '6c586e13'
+    boot, root = table['partitions']
+    assert boot == {
+        'number': 1, 'start': 8192 * 512, 'end': (8192 + 524288) * 512,
+        'type': '0c', 'bootable': True, 'name': None, 'uuid': '6c586e13-01'}
+    assert root['number'] == 2
+    assert root['type'] == '83'
+    assert root['uuid'] == '6c586e13-02'
+    assert sectors(root['start']) == '532480s'
+
+
+@mark.unit
+def test_parse_mbr_skips_empty_and_extended():
+    head = _mbr([(0, 0x0c, 8192, 100), (0, 0, 0, 0), (0, 0x05, 9000, 100)])
+    assert [p['number'] for p in parse_partition_table(head)['partitions']] == [1]
+
+
+@mark.unit
+def test_parse_gpt():
+    esp = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+    linux = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+    disk = uuid.uuid4()
+    parts = [uuid.uuid4(), uuid.uuid4()]
+    head = _gpt([
+        (esp, parts[0], 2048, 526335, 'boot'),
+        (linux, parts[1], 526336, 4194270, 'root'),
+    ], disk)
+
+    table = parse_partition_table(head)
+    assert table['type'] == 'gpt'
+    assert table['disk_id'] == str(disk)
+    boot, root = table['partitions']
+    assert boot['start'] == 2048 * 512
+    assert boot['end'] == 526336 * 512
+    assert boot['type'] == str(esp)
+    assert boot['name'] == 'boot'
+    assert root['uuid'] == str(parts[1])
+
+
+@mark.unit
+def test_parse_garbage():
+    with raises(ValueError):
+        parse_partition_table(bytes(HEAD_BYTES))
+
+
+def _image(tmp_path, size=64 * MiB):
+    path = str(tmp_path / 'disk.img')
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return path
+
+
+@mark.unit
+def test_write_mbr_layout(tmp_path):
+    path = _image(tmp_path)
+    with open(path, 'r+b') as f:
+        f.write(b'boot code')
+
+    table = write_layout(path, [
+        {'number': 1, 'start': 4 * MiB, 'end': 20 * MiB, 'type': '0c',
+         'bootable': True},
+        {'number': 2, 'start': 20 * MiB, 'end': None, 'type': '83'},
+    ], disk_id='6c586e13')
+    assert table == read_partition_table(path)
+    assert table['type'] == 'mbr'
+    assert table['disk_id'] == '6c586e13'
+    boot, root = table['partitions']
+    assert (boot['start'], boot['end'], boot['bootable']) == (
+        4 * MiB, 20 * MiB, True)
+    assert root['end'] == 64 * MiB
+
+    # Drop the first, keep the disk id and the boot code.
+    table = write_layout(path, [dict(root, end=None)])
+    assert [p['number'] for p in table['partitions']] == [2]
+    assert table['disk_id'] == '6c586e13'
+    with open(path, 'rb') as f:
+        assert f.read(9) == b'boot code'
+
+    assert write_layout(path, [])['partitions'] == []
+
+
+@mark.unit
+def test_write_gpt_layout(tmp_path):
+    path = _image(tmp_path)
+    table = write_layout(path, [
+        {'number': 1, 'start': MiB, 'end': 8 * MiB,
+         'type': 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b', 'name': 'boot'},
+        {'number': 2, 'start': 8 * MiB, 'end': None, 'type': LINUX,
+         'name': 'root'},
+    ], type='gpt')
+    assert table['type'] == 'gpt'
+    boot, root = table['partitions']
+    assert boot['name'] == 'boot'
+    # Room left at the end for the backup entries and header.
+    assert root['end'] == 64 * MiB - 33 * 512
+
+    with open(path, 'rb') as f:
+        head = f.read(34 * 512)
+        f.seek(-33 * 512, 2)
+        tail = f.read()
+    fields = list(struct.unpack_from('<8sIIIIQQQQ16sQIII', head, 512))
+    crc, fields[3] = fields[3], 0
+    assert zlib.crc32(struct.pack('<8sIIIIQQQQ16sQIII', *fields)) == crc
+    assert fields[-1] == zlib.crc32(head[1024:])
+    # The backup has the same entries, and points back at the primary.
+    assert tail[:-512] == head[1024:]
+    backup = struct.unpack_from('<8sIIIIQQQQ16sQIII', tail, 32 * 512)
+    assert backup[5:7] == (64 * MiB // 512 - 1, 1)
+
+    # Back to MBR, and the GPT is gone.
+    table = write_layout(path, [
+        {'number': 1, 'start': MiB, 'end': None, 'type': '83'}], type='mbr')
+    assert table['type'] == 'mbr'
+    with open(path, 'rb') as f:
+        assert b'EFI PART' not in f.read()
+
+
+@mark.unit
+def test_write_layout_refuses_bad_layouts(tmp_path):
+    path = _image(tmp_path)
+    with raises(ValueError):
+        write_layout(path, [
+            {'number': 1, 'start': MiB, 'end': 10 * MiB, 'type': '0c'},
+            {'number': 2, 'start': 9 * MiB, 'end': None, 'type': '83'}])
+    with raises(ValueError):
+        write_layout(path, [
+            {'number': 1, 'start': MiB, 'end': 65 * MiB, 'type': '83'}])
+    with raises(ValueError):
+        write_layout(path, [
+            {'number': 5, 'start': MiB, 'end': None, 'type': '83'}])
+    with raises(ValueError):
+        write_layout(path, [
+            {'number': 1, 'start': MiB + 1, 'end': None, 'type': '83'}])
@@ -0,0 +1,75 @@
+"""Tests for the step scheduler."""
+import threading
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.pipeline import Pipeline
+from raspi_maker.pipeline import StepResult
+
+
+@mark.unit
+def test_pipeline_respects_requirements():
+    finished = []
+
+    def step(name):
+        finished.append(name)
+        return name.upper()
+
+    pipeline = Pipeline()
+    pipeline.add('a', step, args=('a',))
+    pipeline.add('b', step, args=('b',), requires=['a'])
+    pipeline.add('c', step, args=('c',), requires=['a'])
+    pipeline.add('d', step, args=('d',), requires=['b', 'c'])
+
+    results = pipeline.run()
+
+    assert results == {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+    assert finished[0] == 'a'
+    assert finished[-1] == 'd'
+
+
+@mark.unit
+def test_pipeline_runs_independent_steps_together():
+    # Each step waits for the other, so this only finishes if they overlap.
+    barrier = threading.Barrier(2, timeout=5)
+
+    pipeline = Pipeline(max_workers=2)
+    pipeline.add('sd', barrier.wait)
+    pipeline.add('thumb', barrier.wait)
+
+    assert set(pipeline.run()) == {'sd', 'thumb'}
+
+
+@mark.unit
+def test_pipeline_stops_after_a_failure():
+    ran = []
+
+    def boom():
+        raise RuntimeError('boom')
+
+    pipeline = Pipeline()
+    pipeline.add('boom', boom)
+    pipeline.add('after', ran.append, args=('after',), requires=['boom'])
+
+    with raises(RuntimeError):
+        pipeline.run()
+    assert ran == []
+
+
+@mark.unit
+def test_pipeline_rejects_unknown_requirements():
+    pipeline = Pipeline()
+    with raises(ValueError):
+        pipeline.add('a', print, requires=['nope'])
+
+
+@mark.unit
+def test_pipeline_passes_results_along():
+    pipeline = Pipeline()
+    pipeline.add('image', lambda: 'polished.img')
+    step = pipeline.add('flash', lambda image: 'flashed ' + image,
+                        args=(StepResult('image'),))
+
+    assert step.requires == ('image',)
+    assert pipeline.run()['flash'] == 'flashed polished.img'
@@ -0,0 +1,98 @@
+"""Tests for the privileged helper, run without sudo."""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pytest import fixture
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.edits import EditPlan
+from raspi_maker.errors import PrivilegedError
+from raspi_maker.privileged import LocalHelper
+from raspi_maker.privileged import PrivilegedHelper
+
+
+@fixture
+def helper():
+    helper = PrivilegedHelper(sudo=False)
+    yield helper
+    helper.close()
+
+
+@mark.unit
+def test_helper_runs_commands(helper):
+    result = helper.call('run', argv=['echo', 'hello'], echo=False)
+    assert result == {'returncode': 0, 'output': 'hello\n'}
+    assert helper.timings[0][0] == 'run'
+
+
+@mark.unit
+def test_helper_reports_failures_and_keeps_going(helper):
+    with raises(PrivilegedError):
+        helper.call('run', argv=['false'], echo=False)
+    with raises(PrivilegedError):
+        helper.call('no_such_op')
+    result = helper.call('run', argv=['false'], check=False, echo=False)
+    assert result['returncode'] == 1
+
+
+@mark.unit
+def test_helper_batch_stops_at_first_failure(helper, tmp_path):
+    marker = str(tmp_path / 'marker')
+    with raises(PrivilegedError):
+        helper.batch([
+            ('run', {'argv': ['false'], 'echo': False}),
+            ('run', {'argv': ['touch', marker], 'echo': False}),
+        ])
+    assert not os.path.exists(marker)
+
+
+@mark.unit
+def test_helper_applies_plans_and_copies(helper, tmp_path):
+    root = str(tmp_path)
+    source = os.path.join(root, 'source.img')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+
+    plan = EditPlan(root).write('hostname', 'pi-1\n')
+    results = helper.batch([
+        ('apply_plan', {'plan': plan.to_dict()}),
+        ('copy_image', {
+            'source': source,
+            'target': os.path.join(root, 'target.img'),
+            'create': True,
+            'progress': False}),
+    ])
+
+    assert results[0] is None
+    assert results[1]['bytes'] == 1024 * 1024
+    with open(os.path.join(root, 'hostname')) as f:
+        assert f.read() == 'pi-1\n'
+    with open(source, 'rb') as a, open(os.path.join(root, 'target.img'), 'rb') as b:
+        assert a.read() == b.read()
+
+
+@mark.unit
+def test_helper_handles_requests_concurrently(helper):
+    start = time.monotonic()
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(
+            lambda _: helper.call('run', argv=['sleep', '0.3'], echo=False),
+            range(4)))
+    assert all(result['returncode'] == 0 for result in results)
+    assert time.monotonic() - start < 1.0
+
+
+@mark.unit
+def test_local_helper_matches(tmp_path):
+    helper = LocalHelper()
+    assert helper.batch([
+        ('run', {'argv': ['echo', 'a'], 'echo': False}),
+        ('run_many', {'argvs': [['echo', 'b'], ['echo', 'c']]}),
+    ]) == [
+        {'returncode': 0, 'output': 'a\n'},
+        [{'returncode': 0, 'output': 'b\n'}, {'returncode': 0, 'output': 'c\n'}],
+    ]
+    with raises(PrivilegedError):
+        helper.call('run', argv=['false'], echo=False)
@@ -0,0 +1,171 @@
+"""Tests for the top level: how the provisioning steps hang together."""
+import threading
+
+from pytest import mark
+from pytest import raises
+
+import raspi_maker
+from raspi_maker import build_pipeline
+from raspi_maker import debugging
+from raspi_maker import provision_pairs
+from raspi_maker.image_store import ImageStore
+
+
+ACTIONS = (
+    'get_manifest', 'clear_device', 'cached_polish_image', 'polish_image',
+    'flash_image', 'discard_polished_image', 'verify_flash',
+    'copy_boot_partition', 'update_sdcard_boot_commands',
+    'expand_second_partition', 'polish_drive')
+
+
+class Device(object):
+    def __init__(self, path):
+        self.path = path
+
+
+def _stub_actions(monkeypatch, fail=()):
+    """Swap every action build_pipeline uses for one that just notes it
+    ran (and what on). Any named in fail raise instead."""
+    ran = []
+    lock = threading.Lock()
+
+    def stub(name):
+        def action(*args, **kwargs):
+            with lock:
+                ran.append(name)
+            if name in fail:
+                raise OSError('{0} broke'.format(name))
+            return {'action': name, 'ranges': []}
+        return action
+
+    for name in ACTIONS:
+        monkeypatch.setattr(raspi_maker, name, stub(name))
+    return ran
+
+
+def _pipeline(**kwargs):
+    return build_pipeline(
+        'image.img', Device('/dev/sdc'), Device('/dev/sdb'), 'ssid', 'psk',
+        'admin', 'node-01', **kwargs)
+
+
+def _requires(pipeline):
+    return dict(
+        (name, set(step.requires)) for name, step in pipeline.steps.items())
+
+
+@mark.unit
+def test_pipeline_graph(monkeypatch):
+    _stub_actions(monkeypatch)
+    requires = _requires(_pipeline(verify=True))
+
+    assert requires['flash'] == set(['clear_thumb'])
+    assert requires['verify'] == set(['flash'])
+    # Expanding rewrites the partition table, so it waits for verify.
+    assert requires['expand'] == set(['manifest', 'flash', 'verify'])
+    assert requires['polish'] == set(['expand'])
+    # The SD card never waits on the thumb drive.
+    assert requires['copy_boot'] == set(['manifest', 'clear_sd'])
+    assert requires['sd_boot_commands'] == set(['copy_boot'])
+
+    requires = _requires(_pipeline())
+    assert 'verify' not in requires
+    assert requires['expand'] == set(['manifest', 'flash'])
+
+
+@mark.unit
+def test_pipeline_graph_offline_polish(monkeypatch):
+    _stub_actions(monkeypatch)
+    pipeline = _pipeline(offline_polish=True, polish_cache=False)
+    requires = _requires(pipeline)
+
+    assert 'polish' not in requires
+    assert requires['flash'] == set(['clear_thumb', 'polish_image'])
+    assert requires['discard_polished_image'] == set(['flash', 'polish_image'])
+
+
+@mark.unit
+def test_pipeline_graph_already_flashed(monkeypatch):
+    _stub_actions(monkeypatch)
+    requires = _requires(_pipeline(
+        flashed=True, sd_ready=True, verify=True, flash_stats={'ranges': []}))
+
+    assert set(requires) == set(['manifest', 'verify', 'expand', 'polish'])
+    assert requires['verify'] == set()
+    assert requires['expand'] == set(['manifest', 'verify'])
+
+
+@mark.unit
+def test_failing_step_stops_its_dependents(monkeypatch):
+    ran = _stub_actions(monkeypatch, fail=('flash_image',))
+
+    with raises(OSError):
+        _pipeline(verify=True).run()
+
+    # Nothing downstream of the flash ran.
+    assert 'verify_flash' not in ran
+    assert 'expand_second_partition' not in ran
+    assert 'polish_drive' not in ran
+
+
+@mark.unit
+def test_failing_pair_drops_out_of_batch(monkeypatch):
+    ran = _stub_actions(monkeypatch)
+    monkeypatch.setattr(raspi_maker, 'Device', Device)
+    prompted = []
+    # Somebody typing `c` at the prompt, which hands back None.
+    monkeypatch.setattr(
+        debugging.pdb, 'set_trace', lambda: prompted.append(True))
+
+    def clear_device(device, wipe='signatures'):
+        if device.path == '/dev/sdd':
+            raise OSError('card died')
+
+    def flash_images(disk_image, devices, full=False, block_size=None):
+        return dict(
+            (device.path, {'error': None, 'ranges': []})
+            for device in devices)
+
+    # The real PromptOnError wrapper around a clear that fails.
+    monkeypatch.setattr(raspi_maker, 'clear_device',
+                        debugging.PromptOnError(clear_device))
+    monkeypatch.setattr(raspi_maker, 'flash_images', flash_images)
+
+    pairs = [
+        {'sd_card': '/dev/sdc', 'thumb_drive': '/dev/sdd',
+         'user': 'admin', 'hostname': 'node-01'},
+        {'sd_card': '/dev/sde', 'thumb_drive': '/dev/sdf',
+         'user': 'admin', 'hostname': 'node-02'},
+    ]
+    settings = {
+        'full': False, 'offline_polish': False, 'polish_cache': True,
+        'verify': False, 'wipe': 'signatures', 'grow_on_boot': False,
+        'block_size': None,
+    }
+
+    assert provision_pairs('image.img', pairs, None, None, 2, settings) == 1
+    assert not prompted
+    assert debugging.PromptOnError.interactive
+    # node-02 still got all the way through, node-01 didn't start.
+    assert ran.count('copy_boot_partition') == 1
+    assert ran.count('polish_drive') == 1
+
+
+@mark.unit
+def test_no_local_image_is_a_clean_failure(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(raspi_maker, 'get_store', lambda: ImageStore(
+        [str(tmp_path)], catalog=str(tmp_path / 'images.json')))
+    spec = {
+        'image': None,
+        'pairs': [{'sd_card': '/dev/sdc', 'thumb_drive': '/dev/sdb'}],
+        'ssid': None, 'psk': None, 'workers': 1, 'settings': {},
+    }
+
+    assert raspi_maker.run_headless(spec) == 1
+    out = capsys.readouterr().out
+    assert raspi_maker.IMAGE_NAME in out
+    assert str(tmp_path) in out
+
+    spec['image'] = 'nope.img'
+    assert raspi_maker.run_headless(spec) == 1
+    assert 'No image nope.img' in capsys.readouterr().out
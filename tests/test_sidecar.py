@@ -0,0 +1,48 @@
+"""Tests for the JSON files kept next to images."""
+import hashlib
+import os
+
+from pytest import mark
+
+from raspi_maker.sidecar import get_sidecar
+from raspi_maker.sidecar import hash_file
+from raspi_maker.sidecar import image_key
+
+
+def _generate(image):
+    size, mtime_ns = image_key(image)
+    return {'version': 1, 'image_size': size, 'image_mtime_ns': mtime_ns}
+
+
+@mark.unit
+def test_get_sidecar_only_generates_when_stale(tmp_path):
+    image = str(tmp_path / 'test.img')
+    with open(image, 'wb') as f:
+        f.write(b'\x01' * 4096)
+    calls = []
+
+    def generate(image):
+        calls.append(image)
+        return _generate(image)
+
+    for _ in range(2):
+        get_sidecar(image, '.test.json', 1, generate, 'test', 'Reading {0}')
+    assert len(calls) == 1
+    assert os.path.exists(image + '.test.json')
+
+    os.utime(image, ns=(0, 0))
+    get_sidecar(image, '.test.json', 1, generate, 'test', 'Reading {0}')
+    assert len(calls) == 2
+
+    # Other versions don't count either.
+    get_sidecar(image, '.test.json', 2, generate, 'test', 'Reading {0}')
+    assert len(calls) == 3
+
+
+@mark.unit
+def test_hash_file(tmp_path):
+    path = str(tmp_path / 'test.img')
+    data = os.urandom(5 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert hash_file(path) == hashlib.sha256(data).hexdigest()
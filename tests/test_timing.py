@@ -0,0 +1,136 @@
+"""Tests for timing spans, and what gets counted against them."""
+import json
+import threading
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker import timing
+from raspi_maker.console import run
+from raspi_maker.console import run_many
+from raspi_maker.pipeline import Pipeline
+from raspi_maker.privileged import LocalHelper
+from raspi_maker.privileged import _respond
+from raspi_maker.timing import Recorder
+from raspi_maker.timing import labelled
+from raspi_maker.timing import span
+from raspi_maker.timing import timed
+
+
+@mark.unit
+def test_span_counts_commands_and_rolls_up():
+    recorder = Recorder()
+    with span('outer', recorder=recorder) as outer:
+        with span('inner', recorder=recorder) as inner:
+            run(['true'])
+            run_many([['true'], ['true']])
+            timing.add_bytes(100)
+        run(['true'])
+
+    assert inner.subprocesses == 3
+    assert inner.bytes == 100
+    assert outer.subprocesses == 4
+    assert outer.bytes == 100
+    assert outer.subprocess_seconds >= inner.subprocess_seconds > 0
+    assert [r['name'] for r in recorder.records] == ['inner', 'outer']
+    # Nothing running, nothing to count against.
+    assert timing.current_span() is None
+    run(['true'])
+
+
+@mark.unit
+def test_timed_records_errors_and_stats(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(timing, '_recorder', recorder)
+
+    @timed
+    def copy():
+        return {'bytes': 4096, 'written': 1024, 'seconds': 1}
+
+    @timed
+    def broken():
+        raise OSError('card died')
+
+    with labelled('node-01 flash'):
+        assert copy()['written'] == 1024
+    with raises(OSError):
+        broken()
+
+    first, second = recorder.records
+    assert first['name'] == 'copy'
+    assert first['label'] == 'node-01 flash'
+    assert first['bytes'] == 1024
+    assert first['error'] is None
+    assert second['label'] is None
+    assert second['error'] == 'OSError: card died'
+
+    rows = dict((row['name'], row) for row in recorder.summary())
+    assert rows['copy']['bytes'] == 1024
+    assert rows['broken']['errors'] == 1
+    recorder.print_summary()
+
+
+@mark.unit
+def test_pipeline_steps_label_their_spans(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(timing, '_recorder', recorder)
+
+    @timed
+    def step():
+        run(['true'])
+
+    pipeline = Pipeline(name='node-01')
+    pipeline.add('one', step)
+    pipeline.add('two', step, requires=['one'])
+    pipeline.run()
+
+    assert sorted(r['label'] for r in recorder.records) == [
+        'node-01 one', 'node-01 two']
+    assert all(r['subprocesses'] == 1 for r in recorder.records)
+
+
+@mark.unit
+def test_spans_stay_on_their_own_thread():
+    recorder = Recorder()
+    seen = []
+
+    def work():
+        seen.append(timing.current_span())
+
+    with span('main', recorder=recorder):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    assert seen == [None]
+
+
+@mark.unit
+def test_json_log(tmp_path):
+    path = str(tmp_path / 'timings.jsonl')
+    recorder = Recorder()
+    recorder.open_log(path)
+    with span('one', recorder=recorder):
+        pass
+    with span('two', recorder=recorder):
+        pass
+    recorder.close()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['name'] for r in records] == ['one', 'two']
+    assert records[0]['seconds'] >= 0
+
+
+@mark.unit
+def test_helper_responses_count_commands():
+    response = _respond({'id': 1, 'batch': [
+        {'op': 'run', 'kwargs': {'argv': ['true'], 'echo': False}},
+        {'op': 'run_many', 'kwargs': {'argvs': [['true'], ['true']]}},
+    ]})
+    assert response['subprocesses'] == 3
+
+    # In process, they land on the caller's span once, not twice.
+    recorder = Recorder()
+    with span('caller', recorder=recorder) as caller:
+        LocalHelper().call('run', argv=['true'], echo=False)
+    assert caller.subprocesses == 1
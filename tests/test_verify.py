@@ -0,0 +1,87 @@
+"""Tests for reading back what got written."""
+import os
+
+from pytest import mark
+
+from raspi_maker.copy_engine import copy_image
+from raspi_maker.copy_engine import copy_stream
+from raspi_maker.fanout import fan_out
+from raspi_maker.verify import verify_ranges
+
+
+def _image(tmp_path):
+    """Data, a hole, more data, and a short tail."""
+    data = os.urandom(8192) + bytes(3 * 4096) + os.urandom(4096) + b'tail'
+    image = str(tmp_path / 'image.img')
+    with open(image, 'wb') as f:
+        f.write(data)
+    return image, data
+
+
+def _corrupt(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+@mark.unit
+def test_verify_after_copy_image(tmp_path):
+    image, data = _image(tmp_path)
+    target = str(tmp_path / 'target.img')
+    stats = copy_image(
+        image, target, block_size=4096, sparse=True, create=True)
+
+    result = verify_ranges(target, stats['ranges'], block_size=4096)
+    assert result['mismatches'] == []
+    assert result['bytes'] == len(data)
+
+    _corrupt(target, 4096 * 4 + 10)
+    result = verify_ranges(target, stats['ranges'], block_size=4096)
+    assert len(result['mismatches']) == 1
+
+
+@mark.unit
+def test_verify_after_sparse_stream_skips_zeros(tmp_path):
+    image, data = _image(tmp_path)
+    target = str(tmp_path / 'target.img')
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+    stats = copy_stream(
+        chunks, target, direct=False, sparse=True, block_size=4096,
+        create=True)
+
+    assert [(start, end) for start, end, _ in stats['ranges']] == [
+        (0, 8192), (4096 * 5, len(data))]
+    assert verify_ranges(target, stats['ranges'])['mismatches'] == []
+
+    # Scribbling on the zeros isn't something we check for.
+    _corrupt(target, 8192)
+    assert verify_ranges(target, stats['ranges'])['mismatches'] == []
+    _corrupt(target, len(data) - 1)
+    assert verify_ranges(target, stats['ranges'])['mismatches'] == [
+        [4096 * 5, len(data)]]
+
+
+@mark.unit
+def test_verify_after_fan_out(tmp_path):
+    image, data = _image(tmp_path)
+    targets = [str(tmp_path / 'a.img'), str(tmp_path / 'b.img')]
+    stats = fan_out(
+        image, targets, sparse=True, block_size=4096, create=True)
+
+    _corrupt(targets[1], 0)
+    assert verify_ranges(targets[0], stats[targets[0]]['ranges'])[
+        'mismatches'] == []
+    assert verify_ranges(targets[1], stats[targets[1]]['ranges'])[
+        'mismatches']
+
+
+@mark.unit
+def test_verify_short_target(tmp_path):
+    image, data = _image(tmp_path)
+    target = str(tmp_path / 'target.img')
+    stats = copy_image(image, target, create=True)
+    os.truncate(target, 4096)
+    assert verify_ranges(target, stats['ranges'])['mismatches'] == [
+        [0, len(data)]]
@@ -0,0 +1,94 @@
+"""Tests for wiping, against image files."""
+import os
+import struct
+
+from pytest import mark
+from pytest import raises
+
+from raspi_maker.partition_table import read_partition_table
+from raspi_maker.partition_table import write_layout
+from raspi_maker.wipe import scan_signatures
+from raspi_maker.wipe import wipe_device
+
+MiB = 1024 * 1024
+
+
+def _used_image(tmp_path):
+    """An image with a partition table, a FAT boot partition and an ext4
+    root partition, or enough of them to be recognized."""
+    path = str(tmp_path / 'card.img')
+    with open(path, 'wb') as f:
+        f.truncate(16 * MiB)
+    write_layout(path, [
+        {'number': 1, 'start': MiB, 'end': 4 * MiB, 'type': '0c'},
+        {'number': 2, 'start': 4 * MiB, 'end': None, 'type': '83'},
+    ])
+    with open(path, 'r+b') as f:
+        f.seek(MiB + 82)
+        f.write(b'FAT32   ')
+        f.seek(4 * MiB + 1080)
+        f.write(struct.pack('<H', 0xef53))
+        # Some data that isn't a signature.
+        f.seek(8 * MiB)
+        f.write(b'precious')
+    return path
+
+
+def _signatures(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return [(s['name'], s['offset']) for s in scan_signatures(fd)]
+    finally:
+        os.close(fd)
+
+
+@mark.unit
+def test_scan_signatures(tmp_path):
+    path = _used_image(tmp_path)
+    assert _signatures(path) == [
+        ('mbr', 510), ('vfat', MiB + 82), ('ext', 4 * MiB + 1080)]
+
+
+@mark.unit
+def test_wipe_signatures(tmp_path):
+    path = _used_image(tmp_path)
+    stats = wipe_device(path)
+    assert stats['method'] == 'signatures'
+    assert stats['bytes'] == 0
+    assert len(stats['signatures']) == 3
+
+    assert _signatures(path) == []
+    with raises(ValueError):
+        read_partition_table(path)
+    with open(path, 'rb') as f:
+        f.seek(8 * MiB)
+        assert f.read(8) == b'precious'
+
+
+@mark.unit
+def test_wipe_full(tmp_path):
+    path = _used_image(tmp_path)
+    stats = wipe_device(path, mode='full')
+    assert stats['method'] == 'discard'
+    assert stats['bytes'] == 16 * MiB
+    assert os.path.getsize(path) == 16 * MiB
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(16 * MiB)
+
+
+@mark.unit
+def test_wipe_gpt_backup(tmp_path):
+    path = str(tmp_path / 'card.img')
+    with open(path, 'wb') as f:
+        f.truncate(16 * MiB)
+    write_layout(path, [], type='gpt')
+    assert [name for name, _ in _signatures(path)] == ['mbr', 'gpt', 'gpt']
+    wipe_device(path)
+    with open(path, 'rb') as f:
+        assert b'EFI PART' not in f.read()
+
+
+@mark.unit
+def test_wipe_mode():
+    with raises(ValueError):
+        wipe_device('/nonexistent', mode='thoroughly')